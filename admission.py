@@ -0,0 +1,184 @@
+"""Admission control for Earth Engine work, in front of the queries that are not cached.
+
+Every query that has to ask EE for something is admitted with an estimate of
+its cost (server.EstimateQueryCost, images * pixels like GetReduceSettings)
+before its work starts, in one of two lanes:
+
+    interactive    /graph, /overlay and /batch requests of the app
+    bulk           background work (exports, overlay refreshes)
+
+An instance runs queries up to INSTANCE_BUDGET cost at once, bulk work up to
+BULK_SHARE of it. Bulk work also waits while interactive queries wait, so
+the app stays responsive while an export runs. A query is charged at most
+QUERY_SHARE of the budget, so one huge query can not lock out cheap ones, and
+a query is always admitted when nothing else runs.
+
+All instances share GLOBAL_BUDGET cost per GLOBAL_WINDOW seconds, counted in
+memcache, the EE quota of the account. A query that does not fit, or that
+waited longer than MAX_WAIT for its lane, is refused with Busy, which the
+handlers answer with a 503 and a Retry-After header. Tasks raise it again so
+the task queue retries them later.
+"""
+
+import math
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import config
+import metrics
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# Cost that runs at once per instance, eight reductions at the COST_BUDGET of
+# server.GetReduceSettings. Bulk work gets BULK_SHARE of it, a single query
+# is charged at most QUERY_SHARE.
+INSTANCE_BUDGET = getattr(config, 'ADMISSION_INSTANCE_BUDGET', 4e9)
+BULK_SHARE = 0.5
+QUERY_SHARE = 0.5
+
+# Cost all instances together start per GLOBAL_WINDOW seconds, bulk work only
+# while less than BULK_SHARE of it is used.
+GLOBAL_BUDGET = getattr(config, 'ADMISSION_GLOBAL_BUDGET', 1e11)
+GLOBAL_WINDOW = 60
+
+# Seconds a query waits for room on the instance before it is refused, and
+# the Retry-After of a refused query. Tasks have a 10 minute deadline.
+MAX_WAIT = {INTERACTIVE: 5, BULK: 60}
+RETRY_AFTER = 5
+
+
+class Busy(Exception):
+    """The query does not fit in the budget now, retry_after is the number of seconds to wait."""
+
+    def __init__(self, message, retry_after):
+        super(Busy, self).__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class Scheduler(object):
+    """Admits queries on this instance while their costs fit the budget, interactive ones first."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.running = 0.0
+        self.queries = 0
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+        self.condition = threading.Condition()
+
+    def Acquire(self, cost, lane, timeout):
+        """Waits until the cost fits in the lane, returns False when that took longer than timeout."""
+        deadline = time.time() + timeout
+        with self.condition:
+            self.waiting[lane] += 1
+            try:
+                while not self.Fits(cost, lane):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.running += cost
+                self.queries += 1
+                return True
+            finally:
+                self.waiting[lane] -= 1
+
+    def Fits(self, cost, lane):
+        if self.queries == 0:
+            return True
+        if lane == BULK:
+            return self.waiting[INTERACTIVE] == 0 and self.running + cost <= self.budget * BULK_SHARE
+        return self.running + cost <= self.budget
+
+    def Release(self, cost):
+        with self.condition:
+            self.running -= cost
+            self.queries -= 1
+            self.condition.notify_all()
+
+    def GetStats(self):
+        with self.condition:
+            return {'budget': self.budget, 'running': self.running, 'queries': self.queries,
+                    'waiting': dict(self.waiting)}
+
+
+SCHEDULER = Scheduler(INSTANCE_BUDGET)
+
+
+class Ticket(object):
+    """An admitted query, released when its EE work is done. Can be used as a context manager."""
+
+    def __init__(self, cost):
+        self.cost = cost
+        self.released = cost == 0
+
+    def Release(self):
+        if self.released:
+            return
+        self.released = True
+        SCHEDULER.Release(self.cost)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Release()
+        return False
+
+
+def Acquire(cost, lane=INTERACTIVE):
+    """Admits a query of the estimated cost in the lane, returns its Ticket. Raises Busy.
+
+    Queries without cost (everything they need is cached or stored) are
+    admitted right away.
+    """
+    if cost <= 0:
+        metrics.Count('admission.{}.free'.format(lane))
+        return Ticket(0)
+    key, charge = _ChargeGlobal(cost, lane)
+    charged = min(cost, INSTANCE_BUDGET * QUERY_SHARE)
+    with metrics.Span('admission.wait'):
+        admitted = SCHEDULER.Acquire(charged, lane, MAX_WAIT[lane])
+    if not admitted:
+        _RefundGlobal(key, charge)
+        metrics.Count('admission.{}.busy'.format(lane))
+        raise Busy('Earth Engine is busy, please try again in a moment', RETRY_AFTER)
+    metrics.Count('admission.{}.admitted'.format(lane))
+    return Ticket(charged)
+
+
+def GetStats():
+    return SCHEDULER.GetStats()
+
+
+def _ChargeGlobal(cost, lane):
+    """Adds the cost to the window's counter in memcache, returns (key, charge) to refund it. Raises Busy.
+
+    When memcache is unavailable only the instance budget applies.
+    """
+    now = time.time()
+    window = int(now // GLOBAL_WINDOW)
+    key = 'admission:{}'.format(window)
+    charge = int(cost)
+    total = memcache.incr(key, charge)
+    if total is None:
+        if memcache.add(key, charge, GLOBAL_WINDOW * 2):
+            total = charge
+        else:  # Another instance started the window, or memcache is down
+            total = memcache.incr(key, charge)
+            if total is None:
+                return None, 0
+    budget = GLOBAL_BUDGET if lane == INTERACTIVE else GLOBAL_BUDGET * BULK_SHARE
+    if total > budget and total > charge:  # The first query of a window always fits
+        _RefundGlobal(key, charge)
+        metrics.Count('admission.{}.quota'.format(lane))
+        raise Busy('The Earth Engine quota is used up, please try again in a moment',
+                   (window + 1) * GLOBAL_WINDOW - now)
+    return key, charge
+
+
+def _RefundGlobal(key, charge):
+    if key is not None:
+        memcache.decr(key, charge)
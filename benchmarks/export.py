@@ -0,0 +1,110 @@
+"""Runs a bulk export (see exports.py) offline, against the fake EE in fake_ee.py.
+
+The task queue stub of the testbed stands in for the task queue: its tasks
+are run in order until the queue is empty, a task that fails is run again
+later with its retry count, like App Engine does. The export is started and
+downloaded through the handlers, the EE calls, tasks and size of the download
+are reported. Run from the app directory with the App Engine SDK:
+
+    python benchmarks/export.py --area-type regions --products CHIRPS,TRMM --output /tmp/regions.csv
+    python benchmarks/export.py --error-rate 0.3 --resume
+
+With --error-rate EE calls fail transiently, so units run out of attempts and
+fail, --resume then resumes the job until it is done.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import run
+
+# A task that keeps failing is dropped after this many attempts, like task_retry_limit in queue.yaml
+MAX_TASK_ATTEMPTS = 10
+
+
+def DrainQueue(stub, queue):
+    """Runs the tasks of the queue until it is empty, returns the number of attempts."""
+    from google.appengine.ext import deferred
+
+    retries = {}
+    attempts = 0
+    while True:
+        tasks = stub.get_filtered_tasks(queue_names=[queue])
+        if not tasks:
+            return attempts
+        for task in tasks:
+            attempts += 1
+            os.environ['HTTP_X_APPENGINE_TASKRETRYCOUNT'] = str(retries.get(task.name, 0))
+            try:
+                deferred.run(task.payload)
+            except deferred.PermanentTaskFailure as ex:
+                print('Task {} failed permanently: {}'.format(task.name, ex))
+            except Exception as ex:
+                retries[task.name] = retries.get(task.name, 0) + 1
+                if retries[task.name] < MAX_TASK_ATTEMPTS:
+                    continue
+                print('Task {} dropped after {} attempts: {}'.format(task.name, retries[task.name], ex))
+            stub.DeleteTask(queue, task.name)
+
+
+def RunExport(server, fake_ee, spec, resume):
+    from google.appengine.api import apiproxy_stub_map
+
+    stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+    fake_ee.Reset()
+    started = time.time()
+    response = server.app.get_response('/export', method='POST', body=json.dumps(spec))
+    if response.status_int != 202:
+        sys.exit('Export not started: {} {}'.format(response.status, response.body))
+    job_id = json.loads(response.body)['id']
+    tasks = DrainQueue(stub, server.exports.EXPORT_QUEUE)
+    status = json.loads(server.app.get_response('/export/{}'.format(job_id)).body)
+    while resume and status['status'] == server.exports.FAILED and status['units']:
+        print('Resuming, {} of {} units failed'.format(len(status['failed']), status['units']))
+        server.app.get_response('/export/{}/resume'.format(job_id), method='POST')
+        tasks += DrainQueue(stub, server.exports.EXPORT_QUEUE)
+        status = json.loads(server.app.get_response('/export/{}'.format(job_id)).body)
+    download = server.app.get_response('/export/{}/download'.format(job_id))
+    calls = fake_ee.GetCalls()
+    return status, download, {
+        'tasks': tasks,
+        'ee_calls': len(calls),
+        'ee_errors': len([call for call in calls if call['error']]),
+        'reductions': sum(call['ops'].get('reduceRegion', 0) for call in calls),
+        'ee_seconds': sum(call['latency'] for call in calls),
+        'wall': time.time() - started
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a bulk export against a fake EE.')
+    parser.add_argument('--sdk', help='App Engine SDK directory, when it is not on the PYTHONPATH')
+    parser.add_argument('--area-type', default='regions')
+    parser.add_argument('--products', default='CHIRPS,PERSIANN')
+    parser.add_argument('--start', default='2010-01-01')
+    parser.add_argument('--end', default='2014-12-31')
+    parser.add_argument('--timestep', default='month')
+    parser.add_argument('--statistic', default='sum')
+    parser.add_argument('--format', default='csv', choices=('csv', 'columns'))
+    parser.add_argument('--error-rate', type=float, help='Fraction of EE calls that fail transiently')
+    parser.add_argument('--resume', action='store_true', help='Resume the job until no unit fails')
+    parser.add_argument('--output', help='Write the download to this file')
+    args = parser.parse_args()
+
+    server, fake_ee = run.SetUp(args.sdk, False)
+    if args.error_rate is not None:
+        fake_ee.Configure(error_rate=args.error_rate)
+    spec = {'areaType': args.area_type, 'products': args.products.split(','), 'startDate': args.start,
+            'endDate': args.end, 'timestep': args.timestep, 'statistic': args.statistic, 'format': args.format}
+    status, download, result = RunExport(server, fake_ee, spec, args.resume)
+    print('status {}: {} of {} units done, {} failed'.format(status['status'], status['done'], status['units'],
+                                                            len(status['failed'])))
+    print('tasks {tasks}, EE calls {ee_calls} ({ee_errors} errors), reductions {reductions}, '
+          'EE {ee_seconds:.2f}s, wall {wall:.2f}s'.format(**result))
+    print('download HTTP {}, {} bytes'.format(download.status_int, len(download.body)))
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(download.body)
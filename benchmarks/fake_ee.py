@@ -0,0 +1,755 @@
+"""Local stand-in for the parts of the Earth Engine API the app uses.
+
+Objects are evaluated eagerly on the client: dates, sequences and mapped
+functions are plain Python, images know how many source images they cover and
+reductions know how many pixels they read. Nothing happens until a terminal
+call (getInfo, getMapId, getDownloadURL), which is recorded in CALLS together
+with a histogram of the operations in its graph and its simulated work
+(images * pixels). The call then sleeps for a latency derived from SETTINGS
+and fails the way EE does when its work does not fit the deadline.
+
+Reduced values are pseudo random but deterministic, so payload sizes are the
+same from run to run.
+"""
+
+import calendar
+import datetime
+import hashlib
+import math
+import random
+import threading
+import time
+
+SETTINGS = {
+    # Seconds of a call without any work, per terminal method
+    'latency': {'getInfo': 0.3, 'getMapId': 0.5, 'getDownloadURL': 0.2},
+    # images * pixels EE reduces per second
+    'throughput': 2e9,
+    # Calls with more work than this fail with a timeout after 'deadline' seconds
+    'deadline_work': 5e10,
+    'deadline': 60.0,
+    # Fraction of the calls that fail with a timeout or a transient error anyway
+    'deadline_rate': 0.0,
+    'error_rate': 0.0,
+    # Simulated seconds are slept as seconds * time_scale
+    'time_scale': 0.05,
+    'seed': 0
+}
+
+# Asset id -> (images per day, band name)
+COLLECTIONS = {
+    'TRMM/3B42': (8, 'precipitation'),
+    'NOAA/PERSIANN-CDR': (1, 'precipitation'),
+    'UCSB-CHG/CHIRPS/DAILY': (1, 'precipitation'),
+    'NOAA/CFSV2/FOR6H': (4, 'Precipitation_rate_surface_6_Hour_Average'),
+    'NASA/GLDAS/V021/NOAH/G025/T3H': (8, 'Rainf_tavg'),
+}
+# Collections without a date filter cover this many days
+UNFILTERED_DAYS = 365 * 20
+
+# Area and bounds of geometries that are not sent inline (assets)
+DEFAULT_AREA_KM2 = 10000.0
+DEFAULT_BBOX = (92.2, 9.8, 101.2, 28.5)
+
+CALLS = []
+_LOCK = threading.Lock()
+_RANDOM = random.Random(SETTINGS['seed'])
+
+
+class EEException(Exception):
+    pass
+
+
+def Configure(**settings):
+    """Updates SETTINGS, latency can be a number (getInfo) or a dict per method."""
+    latency = settings.pop('latency', None)
+    if isinstance(latency, dict):
+        SETTINGS['latency'].update(latency)
+    elif latency is not None:
+        SETTINGS['latency']['getInfo'] = latency
+    SETTINGS.update(settings)
+    _RANDOM.seed(SETTINGS['seed'])
+
+
+def Reset():
+    with _LOCK:
+        del CALLS[:]
+
+
+def GetCalls():
+    with _LOCK:
+        return list(CALLS)
+
+
+def ServiceAccountCredentials(account, key_file):
+    return None
+
+
+def Initialize(credentials=None):
+    pass
+
+
+###############################################################################
+#                                 Evaluation.                                 #
+###############################################################################
+class ComputedObject(object):
+    """Base of every fake EE object, tracks the operations and work that built it."""
+
+    def __init__(self, op=None, inputs=(), work=0.0):
+        self.ops = {}
+        self.work = work
+        for value in inputs:
+            for name, count in getattr(value, 'ops', {}).items():
+                self.ops[name] = self.ops.get(name, 0) + count
+            self.work += getattr(value, 'work', 0.0)
+        if op is not None:
+            self.ops[op] = self.ops.get(op, 0) + 1
+
+    def _Inherit(self, parent, op):
+        """Takes the operations and work of parent, for objects that rearrange its contents."""
+        self.ops = dict(parent.ops)
+        self.ops[op] = self.ops.get(op, 0) + 1
+        self.work = parent.work
+        return self
+
+    def getInfo(self):
+        return _Terminal('getInfo', self, lambda: _Resolve(self._Info()))
+
+    def _Info(self):
+        raise NotImplementedError(type(self).__name__)
+
+
+def _Terminal(method, obj, compute):
+    with _LOCK:
+        roll = _RANDOM.random()
+    latency = SETTINGS['latency'][method] + obj.work / SETTINGS['throughput']
+    error = None
+    if obj.work > SETTINGS['deadline_work'] or roll < SETTINGS['deadline_rate']:
+        latency = min(latency, SETTINGS['deadline'])
+        error = EEException('Computation timed out.')
+    elif roll < SETTINGS['deadline_rate'] + SETTINGS['error_rate']:
+        error = EEException('Too many concurrent aggregations.')
+    started = time.time()
+    time.sleep(latency * SETTINGS['time_scale'])
+    with _LOCK:
+        CALLS.append({
+            'method': method,
+            'type': type(obj).__name__,
+            'ops': dict(obj.ops),
+            'work': obj.work,
+            'latency': latency,
+            'error': str(error) if error else None,
+            'thread': threading.current_thread().name,
+            'started': started
+        })
+    if error is not None:
+        raise error
+    return compute()
+
+
+def _Resolve(value):
+    if isinstance(value, Value):
+        return value.Resolve()
+    if isinstance(value, Number):
+        return value.value
+    if isinstance(value, Date):
+        return value.millis()
+    if isinstance(value, ComputedObject):
+        return _Resolve(value._Info())
+    if isinstance(value, dict):
+        return {key: _Resolve(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_Resolve(item) for item in value]
+    return value
+
+
+def _Number(value):
+    return value.value if isinstance(value, Number) else value
+
+
+def _Hash(text):
+    return hashlib.md5(text.encode('utf-8') if isinstance(text, unicode) else text).hexdigest()
+
+
+###############################################################################
+#                              Numbers and dates.                             #
+###############################################################################
+class Number(ComputedObject):
+
+    def __init__(self, value):
+        super(Number, self).__init__()
+        self.value = value
+
+    def toInt(self):
+        return Number(int(self.value))
+
+    def floor(self):
+        return Number(math.floor(self.value))
+
+    def _Info(self):
+        return self.value
+
+
+class Step(Number):
+    """Index of the timestep of the image a function is mapped over, since start in unit."""
+
+    def __init__(self, start, unit):
+        super(Step, self).__init__(None)
+        self.start = start
+        self.unit = unit
+
+    def toInt(self):
+        return self
+
+    def floor(self):
+        return self
+
+
+class Value(ComputedObject):
+    """A number computed by EE, only known once the call it is part of is evaluated."""
+
+    def __init__(self, key, op=None, inputs=(), work=0.0, minimum=0.0, maximum=500.0):
+        super(Value, self).__init__(op, inputs, work)
+        self.key = key
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def Resolve(self):
+        fraction = int(_Hash(self.key)[:8], 16) / float(0xffffffff)
+        return round(self.minimum + fraction * (self.maximum - self.minimum), 4)
+
+    def _Info(self):
+        return self.Resolve()
+
+
+class Date(ComputedObject):
+    """A date, or without one the 'system:time_start' of the image a function is mapped over."""
+
+    def __init__(self, date, tz=None):
+        super(Date, self).__init__()
+        if isinstance(date, Date):
+            date = date.date
+        elif isinstance(date, basestring):
+            date = datetime.datetime.strptime(date[:10], '%Y-%m-%d')
+        elif isinstance(date, (int, long, float)):
+            date = datetime.datetime.utcfromtimestamp(date / 1000.0)
+        elif isinstance(date, datetime.date) and not isinstance(date, datetime.datetime):
+            date = datetime.datetime(date.year, date.month, date.day)
+        self.date = date
+
+    def advance(self, delta, unit):
+        delta = int(_Number(delta))
+        if unit == 'day':
+            return Date(self.date + datetime.timedelta(days=delta))
+        if unit == 'week':
+            return Date(self.date + datetime.timedelta(weeks=delta))
+        months = delta * 12 if unit == 'year' else delta
+        month_index = self.date.month - 1 + months
+        year, month = self.date.year + month_index // 12, month_index % 12 + 1
+        return Date(self.date.replace(year=year, month=month,
+                                      day=min(self.date.day, calendar.monthrange(year, month)[1])))
+
+    def difference(self, start, unit):
+        if self.date is None:
+            return Step(Date(start), unit)
+        start = Date(start).date
+        if unit == 'day':
+            return Number((self.date - start).days)
+        months = (self.date.year - start.year) * 12 + self.date.month - start.month
+        if self.date.day < start.day:
+            months -= 1
+        return Number(months / 12.0 if unit == 'year' else months)
+
+    def format(self, pattern=None):
+        pattern = pattern or 'yyyy-MM-dd'
+        for token, value in (('YYYY', '%04d' % self.date.year), ('yyyy', '%04d' % self.date.year),
+                             ('MM', '%02d' % self.date.month), ('dd', '%02d' % self.date.day)):
+            pattern = pattern.replace(token, value)
+        return pattern
+
+    def millis(self):
+        return int((self.date - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+    def _Info(self):
+        return {'type': 'Date', 'value': self.millis()}
+
+
+class List(ComputedObject):
+
+    def __init__(self, items):
+        items = items.items if isinstance(items, List) else list(items)
+        super(List, self).__init__(None, items)
+        self.items = items
+
+    @staticmethod
+    def sequence(start, end, step=1):
+        return List(range(int(_Number(start)), int(_Number(end)) + 1, int(_Number(step))))
+
+    def map(self, function):
+        return List([function(item) for item in self.items])
+
+    def flatten(self):
+        items = []
+        for item in self.items:
+            items.extend(item.items if isinstance(item, List) else [item])
+        return List(items)
+
+    def distinct(self):
+        return List(sorted(set(self.items)))
+
+    def get(self, index):
+        return self.items[int(_Number(index))]
+
+    def size(self):
+        return Number(len(self.items))
+
+    def _Info(self):
+        return self.items
+
+
+###############################################################################
+#                                  Geometry.                                  #
+###############################################################################
+class Geometry(ComputedObject):
+    """A geometry with a known bounding box and area, GeoJSON when it was sent inline."""
+
+    def __init__(self, geo_json=None, proj=None, geodesic=None, bbox=None, area=None, op=None, inputs=()):
+        super(Geometry, self).__init__(op, inputs)
+        if isinstance(geo_json, Geometry):
+            geo_json, bbox, area = geo_json.geo_json, geo_json.bbox, geo_json.area
+        self.geo_json = geo_json
+        if geo_json is not None and bbox is None:
+            bbox, area = _Measure(geo_json)
+        self.bbox = bbox or DEFAULT_BBOX
+        self.area = DEFAULT_AREA_KM2 if area is None else area
+
+    @staticmethod
+    def Rectangle(coords, proj=None, geodesic=None):
+        return Geometry({'type': 'Polygon', 'coordinates': _BoxCoordinates(coords)})
+
+    @staticmethod
+    def Point(coords, proj=None):
+        return Geometry({'type': 'Point', 'coordinates': coords})
+
+    def bounds(self, maxError=None, proj=None):
+        return Geometry({'type': 'Polygon', 'coordinates': _BoxCoordinates(self.bbox)}, op='bounds', inputs=[self])
+
+    def intersection(self, right, maxError=None, proj=None):
+        right = right if isinstance(right, Geometry) else right.geometry()
+        bbox = (max(self.bbox[0], right.bbox[0]), max(self.bbox[1], right.bbox[1]),
+                min(self.bbox[2], right.bbox[2]), min(self.bbox[3], right.bbox[3]))
+        return Geometry(bbox=bbox, area=min(self.area, right.area), op='intersection', inputs=[self, right])
+
+    def dissolve(self, maxError=None, proj=None):
+        return Geometry(bbox=self.bbox, area=self.area, op='dissolve', inputs=[self])
+
+    def simplify(self, maxError=None, proj=None):
+        return Geometry(self.geo_json, bbox=self.bbox, area=self.area, op='simplify', inputs=[self])
+
+    def centroid(self, maxError=None, proj=None):
+        return Geometry.Point([(self.bbox[0] + self.bbox[2]) / 2, (self.bbox[1] + self.bbox[3]) / 2])
+
+    def geometry(self):
+        return self
+
+    def _Info(self):
+        if self.geo_json is not None:
+            return self.geo_json
+        return {'type': 'Polygon', 'coordinates': _BoxCoordinates(self.bbox)}
+
+
+def _Union(geometries, op):
+    geometries = list(geometries)
+    if not geometries:
+        return Geometry(op=op)
+    bbox = (min(g.bbox[0] for g in geometries), min(g.bbox[1] for g in geometries),
+            max(g.bbox[2] for g in geometries), max(g.bbox[3] for g in geometries))
+    return Geometry(bbox=bbox, area=sum(g.area for g in geometries), op=op, inputs=geometries)
+
+
+def _BoxCoordinates(box):
+    min_x, min_y, max_x, max_y = box
+    return [[[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y]]]
+
+
+def _Measure(geo_json):
+    """Bounding box and area in square kilometers of a GeoJSON geometry, holes are ignored."""
+    if geo_json['type'] == 'Point':
+        x, y = geo_json['coordinates'][:2]
+        return (x, y, x, y), 0.0
+    polygons = [geo_json['coordinates']] if geo_json['type'] == 'Polygon' else geo_json['coordinates']
+    points = [point for polygon in polygons for point in polygon[0]]
+    bbox = (min(p[0] for p in points), min(p[1] for p in points), max(p[0] for p in points),
+            max(p[1] for p in points))
+    area = 0.0
+    for polygon in polygons:
+        ring = polygon[0]
+        area += abs(sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:]))) / 2
+    latitude = (bbox[1] + bbox[3]) / 2
+    return bbox, area * 111.32 * 111.32 * abs(math.cos(math.radians(latitude)))
+
+
+###############################################################################
+#                           Features and filters.                             #
+###############################################################################
+class Filter(ComputedObject):
+
+    def __init__(self, values):
+        super(Filter, self).__init__()
+        self.values = values
+
+    @staticmethod
+    def eq(name, value):
+        return Filter([value])
+
+    @staticmethod
+    def inList(name, values):
+        return Filter(list(values))
+
+    @staticmethod
+    def equals(leftField=None, rightValue=None, rightField=None, leftValue=None):
+        return Filter([])
+
+
+class Join(ComputedObject):
+    """Only saveAll of images tagged with their timestep onto features with a 'step'."""
+
+    def __init__(self, key):
+        super(Join, self).__init__()
+        self.key = key
+
+    @staticmethod
+    def saveAll(matchesKey, ordering=None, ascending=None, measureKey=None, outer=None):
+        return Join(matchesKey)
+
+    def apply(self, primary, secondary, condition):
+        # The images of a timestep are the asset filtered to it, their work is
+        # counted where they are reduced
+        step = secondary.step
+        features = []
+        for feature in primary.Features():
+            index = int(_Number(feature.get('step')))
+            start = max(step.start.advance(index, step.unit).date, secondary.start.date)
+            end = min(step.start.advance(index + 1, step.unit).date, secondary.end.date)
+            if end <= start:
+                continue
+            images = ImageCollection(secondary.asset, start=Date(start), end=Date(end), bands=secondary.bands)
+            images.ops = {}
+            features.append(feature.set(self.key, images))
+        return FeatureCollection(features, op='join', inputs=[primary, secondary])
+
+
+class Feature(ComputedObject):
+
+    def __init__(self, geometry, properties=None):
+        if isinstance(geometry, Feature):
+            geometry, properties = geometry.geom, dict(geometry.properties, **(properties or {}))
+        elif isinstance(geometry, dict):
+            geometry = Geometry(geometry)
+        elif geometry is not None and not isinstance(geometry, Geometry):
+            raise EEException('Invalid argument specified for ee.Feature(): {}'.format(geometry))
+        properties = dict(properties or {})
+        super(Feature, self).__init__(None, [geometry] + list(properties.values()))
+        self.geom = geometry
+        self.properties = properties
+
+    def set(self, properties, value=None):
+        if not isinstance(properties, dict):
+            properties = {properties: value}
+        return Feature(self, properties)
+
+    def get(self, name):
+        return self.properties.get(name)
+
+    def geometry(self):
+        return self.geom
+
+    def _Info(self):
+        return {
+            'type': 'Feature',
+            'geometry': self.geom._Info() if self.geom is not None else None,
+            'properties': self.properties
+        }
+
+
+class FeatureCollection(ComputedObject):
+    """Either a list of features or an asset, whose features are only counted."""
+
+    def __init__(self, features, column=None, asset=None, count=None, op=None, inputs=()):
+        if isinstance(features, basestring):
+            asset, features = features, None
+            op = op or 'load'
+        elif isinstance(features, (Feature, FeatureCollection)):
+            features = [features]
+        elif isinstance(features, List):
+            features = features.items
+        elif isinstance(features, Geometry):
+            features = [Feature(features)]
+        if features is not None:
+            features = [item if isinstance(item, (Feature, FeatureCollection)) else Feature(item)
+                        for item in features]
+        super(FeatureCollection, self).__init__(op, list(inputs) + list(features or []))
+        self.features = features
+        self.asset = asset
+        self.count = count
+
+    def filter(self, filter):
+        return FeatureCollection(None, asset=self.asset, count=len(filter.values), op='filter', inputs=[self])
+
+    def filterBounds(self, geometry):
+        return self
+
+    def flatten(self):
+        return FeatureCollection(self.Features())._Inherit(self, 'flatten')
+
+    def map(self, function):
+        results = [function(feature) for feature in self.Features()]
+        if results and all(isinstance(result, Image) for result in results):
+            return ImageCollection(results, op='map', inputs=[self])
+        return FeatureCollection(results)._Inherit(self, 'map')
+
+    def geometry(self, maxError=None):
+        if self.features is None:
+            count = self.count or 1
+            return Geometry(area=DEFAULT_AREA_KM2 * count, op='geometry', inputs=[self])
+        return _Union([feature.geometry() for feature in self.Features() if feature.geometry() is not None],
+                      'geometry')
+
+    def aggregate_array(self, name):
+        return List(['{} {}'.format(self.asset, index) for index in range(self.count or 3)])
+
+    def Features(self):
+        if self.features is None:  # An asset, its features only have an id
+            return [Feature(None, {'system:index': str(index)}) for index in range(self.count or 3)]
+        features = []
+        for item in self.features:
+            features.extend(item.Features() if isinstance(item, FeatureCollection) else [item])
+        return features
+
+    def _Info(self):
+        return {'type': 'FeatureCollection', 'features': [feature._Info() for feature in self.Features()]}
+
+
+###############################################################################
+#                            Images and reducers.                             #
+###############################################################################
+class Reducer(ComputedObject):
+
+    def __init__(self, outputs):
+        super(Reducer, self).__init__()
+        self.outputs = outputs
+
+    @staticmethod
+    def mean():
+        return Reducer(['mean'])
+
+    @staticmethod
+    def sum():
+        return Reducer(['sum'])
+
+    @staticmethod
+    def min():
+        return Reducer(['min'])
+
+    @staticmethod
+    def max():
+        return Reducer(['max'])
+
+    @staticmethod
+    def count():
+        return Reducer(['count'])
+
+    @staticmethod
+    def minMax():
+        return Reducer(['min', 'max'])
+
+    def combine(self, reducer2, outputPrefix=None, sharedInputs=None):
+        return Reducer(self.outputs + reducer2.outputs)
+
+    def GetKeys(self, bands):
+        """Output names of a reduceRegion, EE only adds the suffix when there are several outputs."""
+        if len(self.outputs) == 1:
+            return list(bands)
+        return sorted('{}_{}'.format(band, output) for band in bands for output in self.outputs)
+
+
+class Image(ComputedObject):
+    """An image reduced from a number of source images."""
+
+    def __init__(self, images=1, bands=('b1',), label='', op=None, inputs=(), properties=None):
+        super(Image, self).__init__(op, inputs)
+        self.images = images
+        self.bands = tuple(bands)
+        self.label = label
+        self.properties = properties or {}
+
+    def _Derive(self, op, *inputs):
+        return Image(self.images, self.bands, self.label, op, (self,) + inputs, self.properties)
+
+    def set(self, properties, value=None):
+        if not isinstance(properties, dict):
+            properties = {properties: value}
+        return Image(self.images, self.bands, self.label, 'set', [self], dict(self.properties, **properties))
+
+    def get(self, name):
+        if name == 'system:time_start' and name not in self.properties:
+            return Date(None)
+        return self.properties.get(name)
+
+    def select(self, *bands):
+        return Image(self.images, bands[:1] if bands else self.bands, self.label, 'select', [self], self.properties)
+
+    def multiply(self, value):
+        return self._Derive('multiply')
+
+    def copyProperties(self, source, properties=None):
+        return self._Derive('copyProperties')
+
+    def clip(self, geometry):
+        return self._Derive('clip', geometry)
+
+    def visualize(self, **params):
+        return Image(self.images, ('vis-red', 'vis-green', 'vis-blue'), self.label, 'visualize', [self])
+
+    def reduceRegion(self, reducer=None, geometry=None, scale=None, maxPixels=None, tileScale=None,
+                     bestEffort=None, **kwargs):
+        geometry = geometry if isinstance(geometry, Geometry) else geometry.geometry()
+        pixels = geometry.area * 1e6 / float(scale or 1000) ** 2
+        if bestEffort and maxPixels:
+            pixels = min(pixels, maxPixels)
+        return Dictionary(reducer.GetKeys(self.bands), u'{}:{}:{:.0f}'.format(self.label, scale, geometry.area),
+                          work=self.images * max(pixels, 1), inputs=[self, geometry])
+
+    def reduceRegions(self, collection, reducer, scale=None, **kwargs):
+        # A single band is reduced into a property named after the reducer
+        keys = reducer.outputs if len(self.bands) == 1 else reducer.GetKeys(self.bands)
+        reduced = [feature.set({key: Value(u'{}:{}:{}:{}'.format(self.label, index, scale, key))
+                                for key in keys})
+                   for index, feature in enumerate(collection.Features())]
+        result = FeatureCollection(reduced, op='reduceRegions', inputs=[self])
+        result.work += self.images * len(reduced)
+        return result
+
+    def getMapId(self, vis_params=None):
+        return _Terminal('getMapId', self, lambda: {'mapid': 'fake-' + _Hash(self.label), 'token': 'fake-token'})
+
+    def getDownloadURL(self, params=None):
+        return _Terminal('getDownloadURL', self,
+                         lambda: 'https://earthengine.googleapis.com/api/download?docid=fake-' + _Hash(self.label))
+
+
+class Dictionary(ComputedObject):
+    """Result of a reduceRegion, one Value per output key.
+
+    The reduction is only done once, so the first Value carries its operations
+    and work and the others are free.
+    """
+
+    def __init__(self, keys, label, work=0.0, inputs=()):
+        super(Dictionary, self).__init__('reduceRegion', inputs, work)
+        self.entries = [(key, Value(label + ':' + key)._Inherit(self, 'get') if index == 0 else
+                         Value(label + ':' + key)) for index, key in enumerate(keys)]
+
+    def values(self):
+        return List([value for _, value in self.entries])
+
+    def get(self, key):
+        return dict(self.entries)[key]
+
+    def _Info(self):
+        return dict(self.entries)
+
+
+class ImageCollection(ComputedObject):
+    """A collection of images, an asset filtered by date or a list of images."""
+
+    def __init__(self, source, images=None, start=None, end=None, bands=None, op=None, inputs=(), step=None):
+        if isinstance(source, ImageCollection):  # A cast
+            self.__dict__.update(source.__dict__)
+            self._Inherit(source, 'cast')
+            return
+        if isinstance(source, List):
+            source = source.items
+        if isinstance(source, list):
+            super(ImageCollection, self).__init__(op or 'fromImages', list(inputs) + source)
+            self.asset, self.images = None, source
+        else:
+            super(ImageCollection, self).__init__(op or 'load', inputs)
+            self.asset, self.images = source, images
+        # Operations the images of a list were mapped from, kept by map
+        self.inputs = list(inputs)
+        self.start, self.end, self.step = start, end, step
+        per_day, band = COLLECTIONS.get(self.asset, (1, 'b1'))
+        self.bands = bands or (band,)
+
+    @staticmethod
+    def fromImages(images):
+        if isinstance(images, ImageCollection):  # The images a join saved
+            return images
+        return ImageCollection(images)
+
+    def _Copy(self, op, inputs=(), **changes):
+        attributes = dict(start=self.start, end=self.end, bands=self.bands, step=self.step)
+        attributes.update(changes)
+        if self.asset is None:
+            return ImageCollection(self.images, **attributes)._Inherit(self, op)
+        return ImageCollection(self.asset, op=op, inputs=[self] + list(inputs), **attributes)
+
+    def select(self, *bands):
+        return self._Copy('select', bands=bands[:1])
+
+    def filterDate(self, start, end=None):
+        start = Date(start)
+        end = Date(end) if end is not None else start.advance(1, 'day')
+        return self._Copy('filterDate', start=start, end=end)
+
+    def filterBounds(self, geometry):
+        return self._Copy('filterBounds', [geometry])
+
+    def filter(self, filter):
+        return self._Copy('filter')
+
+    def map(self, function):
+        if self.asset is None:
+            results = [function(image) for image in self.images]
+            if results and all(isinstance(result, (Feature, FeatureCollection)) for result in results):
+                return FeatureCollection(results, op='map', inputs=self.inputs)
+            return ImageCollection(results, op='map', inputs=self.inputs)
+        template = function(self._Template())
+        step = template.properties.get('step')
+        return self._Copy('map', [template], bands=template.bands,
+                          step=step if isinstance(step, Step) else self.step)
+
+    def _Count(self):
+        if self.asset is None:
+            return sum(image.images for image in self.images)
+        per_day = COLLECTIONS.get(self.asset, (1, None))[0]
+        days = (self.end.date - self.start.date).days if self.start is not None else UNFILTERED_DAYS
+        return max(days, 0) * per_day
+
+    def _Template(self):
+        label = u'{}:{}:{}'.format(self.asset, self.start.format() if self.start else '',
+                                  self.end.format() if self.end else '')
+        return Image(self._Count(), self.bands, label)
+
+    def _Reduce(self, op):
+        if self.asset is None:
+            label = u','.join(image.label for image in self.images)
+            bands = self.images[0].bands if self.images else self.bands
+            return Image(self._Count(), bands, _Hash(label), op, [self])
+        return Image(self._Count(), self.bands, self._Template().label, op, [self])
+
+    def sum(self):
+        return self._Reduce('sum')
+
+    def mean(self):
+        return self._Reduce('mean')
+
+    def min(self):
+        return self._Reduce('min')
+
+    def max(self):
+        return self._Reduce('max')
+
+    def size(self):
+        return Number(len(self.images) if self.asset is None else self._Count())
@@ -0,0 +1,287 @@
+"""Offline benchmarks of the request handlers, against the fake EE in fake_ee.py.
+
+Every scenario is a realistic /graph, /overlay or /batch request (or a direct call of
+one of the helpers) that runs once with empty caches and once more warm. For
+each run the number of EE round trips, the reductions and work in them, the
+simulated EE time, the wall time and the size of the response are reported.
+
+Run from the app directory with the App Engine SDK (it provides webapp2,
+jinja2 and the testbed used for memcache):
+
+    python benchmarks/run.py --sdk ~/google-cloud-sdk/platform/google_appengine
+    python benchmarks/run.py --save benchmarks/baseline.json
+    python benchmarks/run.py --baseline benchmarks/baseline.json
+
+With --baseline the run fails when a scenario makes more EE calls or
+reductions than the baseline, which is what usually makes a request slower.
+benchmarks/baseline.json holds the results of the default settings, save it
+again when a change makes fewer calls. The values of the helpers are tested
+in benchmarks/tests.py.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import types
+import urllib
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MARKERS = {
+    'type': 'FeatureCollection',
+    'features': [
+        {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [96.16, 16.87]},
+         'properties': {'title': 'Yangon'}},
+        {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [96.08, 21.97]},
+         'properties': {'title': 'Mandalay'}},
+        {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [97.39, 25.38]},
+         'properties': {'title': 'Myitkyina'}}
+    ]
+}
+
+SCENARIOS = [
+    {
+        'name': 'graph-multi-product',
+        'path': '/graph',
+        'params': {'method': 'area', 'areaType': 'regions', 'target': 'Yangon', 'product': 'CHIRPS,PERSIANN,TRMM',
+                   'statistic': 'sum', 'timestep': 'month', 'startDate': '2010-01-01', 'endDate': '2014-12-31'}
+    },
+    {
+        'name': 'graph-multi-district',
+        'path': '/graph',
+        'params': {'method': 'area', 'areaType': 'districts', 'target': 'Kayeh,Loikaw,Bawlakhe',
+                   'product': 'CHIRPS', 'statistic': 'sum', 'timestep': 'month', 'startDate': '2010-01-01',
+                   'endDate': '2014-12-31'}
+    },
+    {
+        'name': 'graph-country-daily',
+        'path': '/graph',
+        'params': {'method': 'area', 'areaType': 'country', 'target': 'Myanmar', 'product': 'TRMM',
+                   'statistic': 'sum', 'timestep': 'day', 'startDate': '2015-01-01', 'endDate': '2015-12-31'}
+    },
+    {
+        'name': 'graph-stream',
+        'path': '/graph',
+        'params': {'method': 'area', 'areaType': 'basins', 'target': 'Sittaung', 'product': 'CHIRPS,GLDAS',
+                   'statistic': 'sum', 'timestep': 'month', 'startDate': '2010-01-01', 'endDate': '2014-12-31',
+                   'stream': 'ndjson'}
+    },
+    {
+        'name': 'graph-markers',
+        'path': '/graph',
+        'params': {'method': 'coordinate', 'target': json.dumps(MARKERS), 'product': 'CHIRPS',
+                   'statistic': 'sum', 'timestep': 'month', 'startDate': '2010-01-01', 'endDate': '2014-12-31'}
+    },
+    {
+        'name': 'graph-shapefile',
+        'path': '/graph',
+        'params': {'method': 'shapefile', 'target': 'users/benchmark/shapefile', 'product': 'PERSIANN,CFSV2',
+                   'statistic': 'sum', 'timestep': 'year', 'startDate': '2005-01-01', 'endDate': '2014-12-31'}
+    },
+    {
+        'name': 'overlay-regions',
+        'path': '/overlay',
+        'params': {'method': 'area', 'areaType': 'regions', 'target': 'Yangon,Bago', 'product': 'CHIRPS',
+                   'statistic': 'sum', 'timestep': 'month', 'startDate': '2014-01-01', 'endDate': '2014-12-31'}
+    },
+    {
+        'name': 'overlay-shapefile',
+        'path': '/overlay',
+        'params': {'method': 'shapefile', 'target': 'users/benchmark/shapefile', 'product': 'TRMM',
+                   'statistic': 'mean', 'timestep': 'month', 'startDate': '2014-01-01', 'endDate': '2014-12-31'}
+    },
+    {
+        'name': 'batch-dashboard',
+        'path': '/batch',
+        'body': {'queries': {
+            'rain': {'path': '/graph', 'params': {
+                'method': 'area', 'areaType': 'regions', 'target': 'Yangon', 'product': 'CHIRPS,PERSIANN',
+                'statistic': 'sum', 'timestep': 'month', 'startDate': '2010-01-01', 'endDate': '2014-12-31'}},
+            'rain-trmm': {'path': '/graph', 'params': {
+                'method': 'area', 'areaType': 'regions', 'target': 'Yangon', 'product': 'CHIRPS,TRMM',
+                'statistic': 'sum', 'timestep': 'month', 'startDate': '2010-01-01', 'endDate': '2014-12-31'}},
+            'regions': {'path': '/graph', 'params': {
+                'method': 'area', 'areaType': 'regions', 'target': 'Yangon,Bago', 'product': 'CHIRPS',
+                'statistic': 'sum', 'timestep': 'month', 'startDate': '2010-01-01', 'endDate': '2014-12-31'}},
+            'regions-again': {'path': '/graph', 'params': {
+                'method': 'area', 'areaType': 'regions', 'target': 'Bago,Yangon', 'product': 'CHIRPS',
+                'statistic': 'sum', 'timestep': 'month', 'startDate': '2010-01-01', 'endDate': '2014-12-31'}},
+            'map': {'path': '/overlay', 'params': {
+                'method': 'area', 'areaType': 'regions', 'target': 'Yangon,Bago', 'product': 'CHIRPS',
+                'statistic': 'sum', 'timestep': 'month', 'startDate': '2014-01-01', 'endDate': '2014-12-31'}}
+        }}
+    },
+    {
+        'name': 'helper-series-batch',
+        'helper': lambda server: server.ComputeSeriesBatch(
+            '2012-01-01', '2013-12-31',
+            [server.SeriesSpec(name, server.GetAreaGeometry(name, 'basins'), server.PRODUCTS['CHIRPS'],
+                               server.GetAreaRegionKey(name, 'basins'), ('basins', name),
+                               server.geometry.GetArea([name], 'basins'))
+             for name in ('Sittaung', 'Mekong', 'Salween')],
+            'month', 'sum')
+    },
+]
+
+
+def SetUp(sdk, use_store):
+    """Puts fake_ee in place of ee, starts the testbed and imports the app."""
+    if sdk:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import fake_ee
+    sys.modules['ee'] = fake_ee
+    try:
+        import config
+    except ImportError:  # config.py holds the real account and is not checked in
+        config = types.ModuleType('config')
+        config.EE_ACCOUNT = 'benchmark@example.com'
+        config.EE_PRIVATE_KEY_FILE = 'privatekey.pem'
+        config.KEY = ''
+        sys.modules['config'] = config
+
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    bed.init_urlfetch_stub()
+    bed.init_datastore_v3_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)  # For the queues in queue.yaml
+
+    import server
+    if not use_store:  # Measure the EE path, not the deployed store
+        server.store._INDEX = {}
+    return server, fake_ee
+
+
+def RunScenario(server, fake_ee, scenario):
+    fake_ee.Reset()
+    counters = server.metrics.GetSnapshot()['counters']
+    started = time.time()
+    if 'helper' in scenario:
+        body = json.dumps(scenario['helper'](server))
+        status, timing = 200, ''
+    elif 'body' in scenario:
+        response = server.app.get_response(scenario['path'], method='POST', body=json.dumps(scenario['body']))
+        body = response.body
+        status, timing = response.status_int, response.headers.get('Server-Timing', '')
+    else:
+        response = server.app.get_response(scenario['path'] + '?' + urllib.urlencode(scenario['params']))
+        body = response.body
+        status, timing = response.status_int, response.headers.get('Server-Timing', '')
+    wall = time.time() - started
+    calls = fake_ee.GetCalls()
+
+    after = server.metrics.GetSnapshot()['counters']
+    methods = {}
+    for call in calls:
+        methods[call['method']] = methods.get(call['method'], 0) + 1
+    return {
+        'status': status,
+        'ee_calls': len(calls),
+        'ee_methods': methods,
+        'reductions': sum(call['ops'].get('reduceRegion', 0) + call['ops'].get('reduceRegions', 0)
+                          for call in calls),
+        'work': sum(call['work'] for call in calls),
+        'ee_errors': len([call for call in calls if call['error']]),
+        'ee_seconds': sum(call['latency'] for call in calls),
+        'retries': after.get('ee.retries', 0) - counters.get('ee.retries', 0),
+        'wall': wall,
+        'bytes': len(body),
+        'error': GetError(body) if status == 200 else 'HTTP {}'.format(status),
+        'server_timing': timing
+    }
+
+
+def GetError(body):
+    """The error of a JSON response, or of the end record of an NDJSON one."""
+    try:
+        result = json.loads(body.strip().splitlines()[-1]) if body.strip() else {}
+    except ValueError:
+        return 'Invalid JSON'
+    if not isinstance(result, dict):
+        return None
+    return result.get('error') or (result.get('errors') or None)
+
+
+def Run(server, fake_ee):
+    results = {}
+    for scenario in SCENARIOS:
+        server.memcache.flush_all()
+        server.cache.LOCAL.Clear()
+        server.CHUNK_SIZES.clear()
+        for cache in ('cold', 'warm'):
+            results['{}/{}'.format(scenario['name'], cache)] = RunScenario(server, fake_ee, scenario)
+    return results
+
+
+def Report(results, verbose):
+    print('{:<32} {:>6} {:>6} {:>6} {:>10} {:>8} {:>8} {:>9}'.format(
+        'scenario', 'status', 'calls', 'reduce', 'work', 'ee s', 'wall s', 'bytes'))
+    for name in sorted(results):
+        result = results[name]
+        print('{:<32} {:>6} {:>6} {:>6} {:>10.3g} {:>8.2f} {:>8.2f} {:>9}'.format(
+            name, result['status'], result['ee_calls'], result['reductions'], result['work'],
+            result['ee_seconds'], result['wall'], result['bytes']))
+        if verbose:
+            print('    methods {}, errors {}, retries {}'.format(result['ee_methods'], result['ee_errors'],
+                                                                   result['retries']))
+            if result['error']:
+                print('    error: {}'.format(result['error']))
+            if result['server_timing']:
+                print('    Server-Timing: {}'.format(result['server_timing']))
+
+
+def Compare(results, baseline):
+    """Returns the regressions in EE calls and reductions compared to the baseline."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for field in ('ee_calls', 'reductions'):
+            if result[field] > baseline[name][field]:
+                regressions.append('{} {}: {} > {}'.format(name, field, result[field], baseline[name][field]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the handlers against a fake EE.')
+    parser.add_argument('--sdk', help='App Engine SDK directory, when it is not on the PYTHONPATH')
+    parser.add_argument('--store', action='store_true', help='Answer from the precomputed store')
+    parser.add_argument('--scenario', action='append', help='Only run the scenarios with these names')
+    parser.add_argument('--latency', type=float, help='Seconds of a getInfo call without any work')
+    parser.add_argument('--throughput', type=float, help='Images * pixels EE reduces per second')
+    parser.add_argument('--deadline-work', type=float, help='Work above which a call times out')
+    parser.add_argument('--deadline-rate', type=float, help='Fraction of calls that time out anyway')
+    parser.add_argument('--error-rate', type=float, help='Fraction of calls that fail transiently')
+    parser.add_argument('--time-scale', type=float, help='Fraction of the simulated latency that is slept')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Fail on more EE calls than the results in this JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server, fake_ee = SetUp(args.sdk, args.store)
+    settings = {'latency': args.latency, 'throughput': args.throughput, 'deadline_work': args.deadline_work,
+                'deadline_rate': args.deadline_rate, 'error_rate': args.error_rate,
+                'time_scale': args.time_scale}
+    fake_ee.Configure(**{key: value for key, value in settings.items() if value is not None})
+    if args.scenario:
+        SCENARIOS = [scenario for scenario in SCENARIOS if scenario['name'] in args.scenario]
+
+    results = Run(server, fake_ee)
+    Report(results, args.verbose)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True, separators=(',', ': '))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = Compare(results, json.load(f))
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
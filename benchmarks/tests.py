@@ -0,0 +1,469 @@
+"""Tests of the helpers that do not need EE, run next to the benchmarks.
+
+They check the values of the series merging, the timestep arithmetic, the
+chunked cache, the admission scheduler, the shapefile reader and the
+boundary topology. Run from the app directory like benchmarks/run.py:
+
+    python benchmarks/tests.py --sdk ~/google-cloud-sdk/platform/google_appengine
+    python benchmarks/tests.py -v SchedulerTest
+"""
+
+import argparse
+import datetime
+import math
+import os
+import StringIO
+import struct
+import sys
+import threading
+import time
+import unittest
+import zipfile
+
+import run
+
+server = None
+
+
+###############################################################################
+#                                  Timesteps.                                 #
+###############################################################################
+
+
+class TimeStepTest(unittest.TestCase):
+
+    def testAdvanceMonthClampsDay(self):
+        self.assertEqual(server.AdvanceDate(datetime.date(2020, 1, 31), 1, 'month'), datetime.date(2020, 2, 29))
+        self.assertEqual(server.AdvanceDate(datetime.date(2019, 1, 31), 1, 'month'), datetime.date(2019, 2, 28))
+        self.assertEqual(server.AdvanceDate(datetime.date(2020, 3, 31), -1, 'month'), datetime.date(2020, 2, 29))
+        self.assertEqual(server.AdvanceDate(datetime.date(2020, 11, 30), 3, 'month'), datetime.date(2021, 2, 28))
+
+    def testAdvanceYearAndDay(self):
+        self.assertEqual(server.AdvanceDate(datetime.date(2020, 2, 29), 1, 'year'), datetime.date(2021, 2, 28))
+        self.assertEqual(server.AdvanceDate(datetime.date(2020, 2, 29), 4, 'year'), datetime.date(2024, 2, 29))
+        self.assertEqual(server.AdvanceDate(datetime.date(2020, 12, 31), 1, 'day'), datetime.date(2021, 1, 1))
+
+    def testMonthStepsAdvanceFromStart(self):
+        # Every step is advanced from the start, so a clamped February does not shorten March
+        self.assertEqual(server.GetTimeSteps('2020-01-31', '2020-05-01', 'month'),
+                         [datetime.date(2020, 1, 31), datetime.date(2020, 2, 29), datetime.date(2020, 3, 31),
+                          datetime.date(2020, 4, 30)])
+
+    def testStepsIncludeEndDate(self):
+        self.assertEqual(len(server.GetTimeSteps('2015-01-01', '2015-12-31', 'day')), 365)
+        self.assertEqual(len(server.GetTimeSteps('2010-01-01', '2014-12-31', 'month')), 60)
+        self.assertEqual(server.GetTimeSteps('2010-06-01', '2012-06-01', 'year'),
+                         [datetime.date(2010, 6, 1), datetime.date(2011, 6, 1), datetime.date(2012, 6, 1)])
+        self.assertEqual(server.GetTimeSteps('2020-03-01', '2020-02-01', 'month'), [])
+
+    def testLabelsRoundTrip(self):
+        step = datetime.date(2016, 7, 9)
+        self.assertEqual(server.FormatTimeStep(step, 'day'), '09-07-2016')
+        self.assertEqual(server.FormatTimeStep(step, 'month'), '07-2016')
+        self.assertEqual(server.FormatTimeStep(step, 'year'), '2016')
+        self.assertEqual(server.ParseTimeStepLabel('09-07-2016'), step)
+        self.assertEqual(server.ParseTimeStepLabel('07-2016'), datetime.date(2016, 7, 1))
+        self.assertEqual(server.ParseTimeStepLabel('2016'), datetime.date(2016, 1, 1))
+
+    def testCompleteAfterLag(self):
+        product = {'lag_days': 2}
+        today = datetime.date.today()
+        self.assertTrue(server.IsCompleteTimeStep(today - datetime.timedelta(days=3), 'day', product))
+        self.assertFalse(server.IsCompleteTimeStep(today - datetime.timedelta(days=2), 'day', product))
+        self.assertFalse(server.IsCompleteTimeStep(today - datetime.timedelta(days=3), 'day', {'lag_days': 3}))
+
+
+###############################################################################
+#                                Merged series.                               #
+###############################################################################
+
+
+class MergeSeriesTest(unittest.TestCase):
+
+    def testAlignsOnDates(self):
+        merged = server.MergeSeries({
+            'CHIRPS': [['12-2019', 1.5], ['01-2020', 2.0]],
+            'TRMM': [['01-2020', None], ['02-2020', 3.0]],
+        })
+        self.assertEqual(merged['dates'], ['12-2019', '01-2020', '02-2020'])
+        self.assertEqual(merged['series'], [{'name': 'CHIRPS', 'values': [1.5, 2.0, None]},
+                                            {'name': 'TRMM', 'values': [None, None, 3.0]}])
+
+    def testKeepsOrderOfNames(self):
+        merged = server.MergeSeries({'b': [['2001', 1]], 'a': [['2000', 2]]}, ['b', 'a'])
+        self.assertEqual(merged['dates'], ['2000', '2001'])
+        self.assertEqual([series['name'] for series in merged['series']], ['b', 'a'])
+        self.assertEqual([series['values'] for series in merged['series']], [[None, 1.0], [2.0, None]])
+
+    def testDailyLabelsSortByDate(self):
+        merged = server.MergeSeries({'a': [['31-12-2019', 0.0], ['01-01-2020', 4.0], ['02-01-2020', 0.5]]})
+        self.assertEqual(merged['dates'], ['31-12-2019', '01-01-2020', '02-01-2020'])
+        self.assertEqual(merged['series'][0]['values'], [0.0, 4.0, 0.5])
+
+    def testEmpty(self):
+        self.assertEqual(server.MergeSeries({}), {'dates': [], 'series': []})
+
+    def testChartRows(self):
+        merged = server.MergeSeries({'a': [['2000', 1.0]], 'b': [['2001', 2.0]]})
+        self.assertEqual(server.GetChartRows(merged), [['Date', 'a', 'b'], ['2000', 1.0, None], ['2001', None, 2.0]])
+
+
+###############################################################################
+#                                    Cache.                                   #
+###############################################################################
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = server.cache
+        self.memcache = server.cache.memcache
+        self.memcache.flush_all()
+        self.cache.LOCAL.Clear()
+
+    def testSmallValuesAreRaw(self):
+        self.cache.Set('small', 'value', 60)
+        self.assertEqual(self.memcache.get('small')[0], 'r')
+        self.cache.LOCAL.Clear()
+        self.assertEqual(self.cache.Get('small'), 'value')
+
+    def testLargeValuesAreCompressed(self):
+        value = 'rain ' * 10000
+        self.cache.Set('large', value, 60)
+        head = self.memcache.get('large')
+        self.assertEqual(head[0], 'z')
+        self.assertLess(len(head[2]), len(value))
+        self.cache.LOCAL.Clear()
+        self.assertEqual(self.cache.Get('large'), value)
+
+    def testHugeValuesAreChunked(self):
+        value = os.urandom(self.cache.CHUNK_SIZE * 2 + 10)  # Does not compress
+        self.cache.Set('huge', value, 60)
+        kind, _, (version, count) = self.memcache.get('huge')
+        self.assertEqual((kind, count), ('c', 3))
+        for index in range(count):
+            self.assertIsNotNone(self.memcache.get(self.cache._GetChunkKey('huge', version, index)))
+        self.cache.LOCAL.Clear()
+        self.assertEqual(self.cache.Get('huge'), value)
+
+    def testRewriteUsesNewVersion(self):
+        first = os.urandom(self.cache.CHUNK_SIZE + 10)
+        second = os.urandom(self.cache.CHUNK_SIZE + 10)
+        self.cache.Set('huge', first, 60)
+        first_version = self.memcache.get('huge')[2][0]
+        self.cache.Set('huge', second, 60)
+        second_version = self.memcache.get('huge')[2][0]
+        self.assertNotEqual(first_version, second_version)
+        self.cache.LOCAL.Clear()
+        self.assertEqual(self.cache.Get('huge'), second)
+
+    def testMissingChunkIsMiss(self):
+        self.cache.Set('huge', os.urandom(self.cache.CHUNK_SIZE + 10), 60)
+        version = self.memcache.get('huge')[2][0]
+        self.memcache.delete(self.cache._GetChunkKey('huge', version, 1))
+        self.cache.LOCAL.Clear()
+        self.assertIsNone(self.cache.Get('huge'))
+
+    def testLocalCopyIsUsed(self):
+        self.cache.Set('local', 'value', 60)
+        self.memcache.delete('local')
+        self.assertEqual(self.cache.Get('local'), 'value')
+        self.assertIsNone(self.cache.Reload('local'))
+
+
+###############################################################################
+#                                  Admission.                                 #
+###############################################################################
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.admission = server.admission
+        self.scheduler = self.admission.Scheduler(100)
+
+    def Wait(self, cost, lane, timeout):
+        """Starts an Acquire in a thread, returns the list its result is appended to."""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.scheduler.Acquire(cost, lane, timeout)))
+        thread.start()
+        self.threads.append(thread)
+        return result
+
+    def WaitUntil(self, condition):
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def run(self, result=None):
+        self.threads = []
+        try:
+            return super(SchedulerTest, self).run(result)
+        finally:
+            for thread in self.threads:
+                thread.join()
+
+    def testFirstQueryIsAlwaysAdmitted(self):
+        self.assertTrue(self.scheduler.Acquire(500, self.admission.INTERACTIVE, 0))
+        self.assertEqual(self.scheduler.GetStats()['running'], 500)
+
+    def testBudget(self):
+        self.assertTrue(self.scheduler.Acquire(60, self.admission.INTERACTIVE, 0))
+        self.assertFalse(self.scheduler.Acquire(50, self.admission.INTERACTIVE, 0.05))
+        self.assertTrue(self.scheduler.Acquire(40, self.admission.INTERACTIVE, 0))
+        self.assertEqual(self.scheduler.GetStats(), {'budget': 100, 'running': 100, 'queries': 2,
+                                                     'waiting': {'interactive': 0, 'bulk': 0}})
+
+    def testBulkShare(self):
+        self.assertTrue(self.scheduler.Acquire(40, self.admission.BULK, 0))
+        self.assertFalse(self.scheduler.Acquire(20, self.admission.BULK, 0.05))
+        self.assertTrue(self.scheduler.Acquire(10, self.admission.BULK, 0))
+        self.assertTrue(self.scheduler.Acquire(50, self.admission.INTERACTIVE, 0))
+
+    def testReleaseAdmitsWaiting(self):
+        self.assertTrue(self.scheduler.Acquire(70, self.admission.INTERACTIVE, 0))
+        result = self.Wait(50, self.admission.INTERACTIVE, 2)
+        self.WaitUntil(lambda: self.scheduler.GetStats()['waiting']['interactive'] == 1)
+        self.assertEqual(result, [])
+        self.scheduler.Release(70)
+        self.WaitUntil(lambda: result == [True])
+        self.assertEqual(self.scheduler.GetStats()['running'], 50)
+
+    def testBulkWaitsForInteractive(self):
+        self.assertTrue(self.scheduler.Acquire(30, self.admission.INTERACTIVE, 0))
+        interactive = self.Wait(80, self.admission.INTERACTIVE, 2)
+        self.WaitUntil(lambda: self.scheduler.GetStats()['waiting']['interactive'] == 1)
+        # Fits the bulk share, but an interactive query is waiting
+        self.assertFalse(self.scheduler.Acquire(10, self.admission.BULK, 0.05))
+        self.scheduler.Release(30)
+        self.WaitUntil(lambda: interactive == [True])
+
+    def testBusyRetryAfter(self):
+        self.assertEqual(self.admission.Busy('busy', 0.2).retry_after, 1)
+        self.assertEqual(self.admission.Busy('busy', 4.1).retry_after, 5)
+
+
+###############################################################################
+#                                 Shapefiles.                                 #
+###############################################################################
+
+
+# A square of 4 degrees with a hole, outer rings clockwise and holes counter-clockwise
+SQUARE = [(96.0, 16.0), (96.0, 20.0), (100.0, 20.0), (100.0, 16.0), (96.0, 16.0)]
+HOLE = [(97.0, 17.0), (98.0, 17.0), (98.0, 18.0), (97.0, 18.0), (97.0, 17.0)]
+OTHER = [(101.0, 16.0), (101.0, 17.0), (102.0, 17.0), (102.0, 16.0), (101.0, 16.0)]
+
+UTM_47N = ('PROJCS["WGS_1984_UTM_Zone_47N",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",'
+           'SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],'
+           'UNIT["Degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],'
+           'PARAMETER["False_Easting",500000.0],PARAMETER["False_Northing",0.0],'
+           'PARAMETER["Central_Meridian",99.0],PARAMETER["Scale_Factor",0.9996],'
+           'PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]')
+
+
+def BuildShp(shapes, shape_type=5):
+    """Returns a .shp file of the shapes, each a list of rings of (x, y)."""
+    records = ''
+    for number, rings in enumerate(shapes):
+        points = [point for ring in rings for point in ring]
+        parts = [sum(len(ring) for ring in rings[:index]) for index in range(len(rings))]
+        content = struct.pack('<i4d2i', shape_type, 0, 0, 0, 0, len(parts), len(points))
+        content += struct.pack('<{}i'.format(len(parts)), *parts)
+        content += struct.pack('<{}d'.format(2 * len(points)), *[c for point in points for c in point])
+        records += struct.pack('>2i', number + 1, len(content) // 2) + content
+    header = struct.pack('>7i', 9994, 0, 0, 0, 0, 0, (100 + len(records)) // 2)
+    header += struct.pack('<2i8d', 1000, shape_type, 0, 0, 0, 0, 0, 0, 0, 0)
+    return header + records
+
+
+def BuildDbf(fields, rows, deleted=()):
+    """Returns a .dbf file with the fields [(name, type, size)] and rows of values."""
+    record_length = 1 + sum(size for _, _, size in fields)
+    header_length = 32 + 32 * len(fields) + 1
+    data = struct.pack('<4BI2H20x', 3, 120, 1, 1, len(rows), header_length, record_length)
+    for name, field_type, size in fields:
+        data += struct.pack('<11sc4xB15x', name, field_type, size)
+    data += '\r'
+    for index, row in enumerate(rows):
+        data += '*' if index in deleted else ' '
+        data += ''.join(str(value).ljust(size)[:size] for value, (_, _, size) in zip(row, fields))
+    return data + '\x1a'
+
+
+def ForwardUtm(longitude, latitude, central_meridian):
+    """Forward Transverse Mercator of Snyder (page 61), to check the inverse in shapefiles.py."""
+    a = 6378137.0
+    f = 1 / 298.257223563
+    e2 = f * (2 - f)
+    ep2 = e2 / (1 - e2)
+    k0 = 0.9996
+    phi = math.radians(latitude)
+    n = a / math.sqrt(1 - e2 * math.sin(phi) ** 2)
+    t = math.tan(phi) ** 2
+    c = ep2 * math.cos(phi) ** 2
+    d = math.radians(longitude - central_meridian) * math.cos(phi)
+    m = a * ((1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256) * phi -
+             (3 * e2 / 8 + 3 * e2 ** 2 / 32 + 45 * e2 ** 3 / 1024) * math.sin(2 * phi) +
+             (15 * e2 ** 2 / 256 + 45 * e2 ** 3 / 1024) * math.sin(4 * phi) -
+             (35 * e2 ** 3 / 3072) * math.sin(6 * phi))
+    x = k0 * n * (d + (1 - t + c) * d ** 3 / 6 + (5 - 18 * t + t ** 2 + 72 * c - 58 * ep2) * d ** 5 / 120)
+    y = k0 * (m + n * math.tan(phi) * (d ** 2 / 2 + (5 - t + 9 * c + 4 * c ** 2) * d ** 4 / 24 +
+                                       (61 - 58 * t + t ** 2 + 600 * c - 330 * ep2) * d ** 6 / 720))
+    return x + 500000, y
+
+
+class ShapefileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shapefiles = server.shapefiles
+
+    def testReadShapes(self):
+        shapes = list(self.shapefiles.ReadShapes(BuildShp([[SQUARE, HOLE], [OTHER]])))
+        self.assertEqual(shapes, [[SQUARE, HOLE], [OTHER]])
+
+    def testGroupsHolesInOuterRings(self):
+        polygons, records = self.shapefiles.ReadFiles({'areas.shp': BuildShp([[SQUARE, OTHER, HOLE]])})
+        self.assertEqual(polygons, [[[list(p) for p in SQUARE], [list(p) for p in HOLE]],
+                                    [[list(p) for p in OTHER]]])
+        self.assertEqual(records, [])
+
+    def testWrongWindingIsOuter(self):
+        polygons = self.shapefiles.GroupRings([list(reversed(SQUARE))])
+        self.assertEqual(polygons, [[[list(p) for p in reversed(SQUARE)]]])
+
+    def testZipAndRecords(self):
+        dbf = BuildDbf([('NAME', 'C', 10), ('RAIN', 'N', 8), ('CODE', 'N', 4)],
+                       [('Yangon', '12.5', '7'), ('Gone', '0', '0'), ('Bago', '', '8')], deleted=(1,))
+        archive = StringIO.StringIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.writestr('upload/areas.shp', BuildShp([[SQUARE], [OTHER]]))
+            z.writestr('upload/areas.dbf', dbf)
+            z.writestr('readme.txt', 'not a part')
+        polygons, records = self.shapefiles.ReadFiles({'areas.zip': archive.getvalue()})
+        self.assertEqual(len(polygons), 2)
+        self.assertEqual(records, [{'NAME': u'Yangon', 'RAIN': 12.5, 'CODE': 7},
+                                   {'NAME': u'Bago', 'RAIN': u'', 'CODE': 8}])
+
+    def testInvalidFiles(self):
+        self.assertRaises(ValueError, self.shapefiles.ReadFiles, {'areas.dbf': ''})
+        self.assertRaises(ValueError, self.shapefiles.ReadFiles, {'areas.shp': 'x' * 100})
+        self.assertRaises(ValueError, self.shapefiles.ReadFiles, {'areas.shp': BuildShp([[SQUARE]], shape_type=3)})
+        self.assertRaises(ValueError, self.shapefiles.ReadFiles, {'areas.zip': 'not a zip'})
+        projected = [[(x * 1e5, y * 1e5) for x, y in SQUARE]]
+        self.assertRaises(ValueError, self.shapefiles.ReadFiles, {'areas.shp': BuildShp([projected])})
+
+    def testProjections(self):
+        self.assertIs(self.shapefiles.ReadProjection(None), self.shapefiles._LongitudeLatitude)
+        self.assertIs(self.shapefiles.ReadProjection('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984"]]'),
+                      self.shapefiles._LongitudeLatitude)
+        self.assertRaises(ValueError, self.shapefiles.ReadProjection, 'GEOGCS["GCS_Everest_1830"]')
+        self.assertRaises(ValueError, self.shapefiles.ReadProjection,
+                          UTM_47N.replace('Transverse_Mercator', 'Lambert_Conformal_Conic'))
+        self.assertRaises(ValueError, self.shapefiles.ReadProjection, UTM_47N.replace('1.0]]', '0.3048]]'))
+
+    def testUtm(self):
+        transform = self.shapefiles.ReadProjection(UTM_47N)
+        longitude, latitude = transform(500000, 0)
+        self.assertAlmostEqual(longitude, 99, places=9)
+        self.assertAlmostEqual(latitude, 0, places=9)
+        for point in [(96.16, 16.87), (97.39, 25.38), (98.5, 10.0), (101.2, 21.0)]:
+            longitude, latitude = transform(*ForwardUtm(point[0], point[1], 99))
+            self.assertAlmostEqual(longitude, point[0], places=6)
+            self.assertAlmostEqual(latitude, point[1], places=6)
+
+    def testUtmShapefile(self):
+        square = [ForwardUtm(x, y, 99) for x, y in SQUARE]
+        polygons, _ = self.shapefiles.ReadFiles({'areas.shp': BuildShp([[square]]), 'areas.prj': UTM_47N})
+        for (longitude, latitude), (x, y) in zip(polygons[0][0], SQUARE):
+            self.assertAlmostEqual(longitude, x, places=6)
+            self.assertAlmostEqual(latitude, y, places=6)
+
+
+###############################################################################
+#                                  Topology.                                  #
+###############################################################################
+
+
+def Square(x, y, size=1.0):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+class TopologyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = server.topology
+
+    def testLevels(self):
+        self.assertEqual([self.topology.GetLevel(zoom) for zoom in (1, 5, 6, 7, 10, 11, 18)], [5, 5, 7, 7, 11, 11, 11])
+        self.assertEqual(self.topology.GetTolerance(0), 360.0 / 256)
+        self.assertEqual(self.topology.GetTolerance(5), 360.0 / 256 / 32)
+
+    def testUnknownLayersAreNotKept(self):
+        self.assertIsNone(self.topology.GetLayer('unknown', 5))
+        self.assertNotIn(('unknown', 5), self.topology._LAYERS)
+        for url in ('/boundaries/unknown/5', '/boundaries/regions/6', '/boundaries/regions/99999'):
+            self.assertEqual(server.app.get_response(url).status_int, 404)
+
+    def testSharedBorderIsOneArc(self):
+        arcs, shapes = self.topology.BuildTopology([[[Square(0, 0)]], [[Square(1, 0)]]])
+        self.assertEqual(len(arcs), 3)
+        first, second = shapes[0][0][0], shapes[1][0][0]
+        shared = [index for index in second if index < 0]
+        self.assertEqual(len(shared), 1)
+        self.assertIn(~shared[0], first)
+        self.assertEqual(arcs[~shared[0]], [(1, 0), (1, 1)])
+
+    def testLonelyRingIsOneClosedArc(self):
+        arcs, shapes = self.topology.BuildTopology([[[Square(0, 0)]], [[Square(5, 5)]]])
+        self.assertEqual(shapes, [[[[0]]], [[[1]]]])
+        self.assertEqual(arcs[0], [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)])
+
+    def testSameRingIsShared(self):
+        arcs, shapes = self.topology.BuildTopology([[[Square(0, 0)]], [[list(reversed(Square(0, 0)))]]])
+        self.assertEqual(len(arcs), 1)
+        self.assertEqual(shapes, [[[[0]]], [[[~0]]]])
+
+    def testQuantizeAndDeltaEncode(self):
+        quantized = self.topology._Quantize([(0.0, 0.0), (0.1, 0.0), (1.0, 0.5), (1.0, 0.52)], (0.0, 0.0), 0.25)
+        self.assertEqual(quantized, [[0, 0], [4, 2]])
+        self.assertEqual(self.topology._Quantize([(0.0, 0.0), (0.1, 0.0)], (0.0, 0.0), 0.25), [[0, 0], [0, 0]])
+        self.assertEqual(self.topology._DeltaEncode([[3, 4], [5, 4], [5, 1]]), [[3, 4], [2, 0], [0, -3]])
+        self.assertEqual(self.topology._MapArc(~7, {}), ~0)
+
+    def testBuildLayer(self):
+        features = [
+            {'type': 'Feature', 'properties': {'ST': 'A', 'other': 1},
+             'geometry': {'type': 'Polygon', 'coordinates': [Square(96, 16)]}},
+            {'type': 'Feature', 'properties': {'ST': 'B'},
+             'geometry': {'type': 'Polygon', 'coordinates': [Square(97, 16)]}},
+            {'type': 'Feature', 'properties': {'ST': 'A'},
+             'geometry': {'type': 'Polygon', 'coordinates': [Square(90, 10)]}},
+        ]
+        layer = self.topology.BuildLayer(features, 'regions', 5)
+        scale = self.topology.GetTolerance(5) / 2
+        self.assertEqual(layer['transform'], {'scale': [scale, scale], 'translate': [90, 10]})
+        geometries = layer['objects']['regions']['geometries']
+        self.assertEqual([geometry['properties'] for geometry in geometries], [{'ST': 'A'}, {'ST': 'B'}])
+        self.assertEqual(len(geometries[0]['arcs']), 2)  # Both parts of A in one MultiPolygon
+        self.assertEqual(len(layer['arcs']), 4)
+        # Arcs decode back to the corners of the squares, to half a quantization step
+        corners = set()
+        for arc in layer['arcs']:
+            x, y = 0, 0
+            for dx, dy in arc:
+                x, y = x + dx, y + dy
+                corners.add((90 + x * scale, 10 + y * scale))
+        expected = {tuple(point) for square in (Square(96, 16), Square(97, 16), Square(90, 10)) for point in square}
+        self.assertEqual(len(corners), len(expected))
+        for (x, y), (expected_x, expected_y) in zip(sorted(corners), sorted(expected)):
+            self.assertAlmostEqual(x, expected_x, delta=scale / 2)
+            self.assertAlmostEqual(y, expected_y, delta=scale / 2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tests the helpers that do not need EE.')
+    parser.add_argument('--sdk', help='App Engine SDK directory, when it is not on the PYTHONPATH')
+    args, rest = parser.parse_known_args()
+    server, _ = run.SetUp(args.sdk, False)
+    unittest.main(argv=[sys.argv[0]] + rest)
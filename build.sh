@@ -51,3 +51,7 @@ BuildDep https://github.com/google/earthengine-api.git v0.1.153 python/ee
 
 # Build httplib2.
 BuildDep https://github.com/jcgregorio/httplib2.git tags/v0.9.1 python2/httplib2
+
+# Build the simplified boundary layers served on /boundaries (districts are
+# fetched from EE, which needs config.py and the App Engine SDK, see topology.py).
+python topology.py --area-types country,regions,basins
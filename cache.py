@@ -0,0 +1,196 @@
+"""Two-tier cache for query results: an in-process LRU in front of memcache.
+
+Repeated queries on an instance are answered from the LRU without a memcache
+RPC. In memcache values are stored zlib compressed, values that are still
+larger than a memcache entry (1 MB) are split over several entries:
+
+    key                       ('r', expires, value)               small values
+    key                       ('z', expires, compressed value)
+    key                       ('c', expires, (version, count))    chunked values
+    key:<version>:<index>     chunk of the compressed value
+
+The version makes sure chunks of different writes of a key are never mixed,
+a value with a missing chunk is a miss. Values are strings (JSON), hits and
+misses per tier are counted in metrics.
+"""
+
+import collections
+import os
+import threading
+import time
+import zlib
+
+from google.appengine.api import memcache
+
+import config
+import metrics
+
+# Size of the in-process LRU in bytes, values larger than LOCAL_MAX_VALUE are
+# only stored in memcache.
+LOCAL_CACHE_BYTES = getattr(config, 'LOCAL_CACHE_BYTES', 16 * 1024 * 1024)
+LOCAL_MAX_VALUE = LOCAL_CACHE_BYTES // 4
+
+# Values larger than COMPRESS_THRESHOLD bytes are compressed, compressed values
+# larger than CHUNK_SIZE are chunked (memcache values are at most 1 MB,
+# including the key and some overhead).
+COMPRESS_THRESHOLD = 1024
+CHUNK_SIZE = 1000 * 1000 - 4096
+
+
+class LRU(object):
+    """Size-bounded, thread-safe least recently used cache with an expiry time per entry."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def Get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                self.size -= len(value)
+                return None
+            self.entries[key] = entry  # Most recently used
+            return value
+
+    def Set(self, key, value, expires):
+        if len(value) > LOCAL_MAX_VALUE:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (value, expires)
+            self.size += len(value)
+            while self.size > self.capacity:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                metrics.Count('cache.local.evictions')
+
+    def Delete(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+
+    def Clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def GetStats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'capacity': self.capacity}
+
+
+LOCAL = LRU(LOCAL_CACHE_BYTES)
+
+
+def Get(key):
+    """Returns the value of key from the LRU or memcache, None when it is not cached."""
+    value = LOCAL.Get(key)
+    if value is not None:
+        metrics.Count('cache.local.hit')
+        return value
+    with metrics.Span('memcache'):
+        value, expires = _GetFromMemcache(key)
+    if value is None:
+        metrics.Count('cache.miss')
+        return None
+    metrics.Count('cache.memcache.hit')
+    LOCAL.Set(key, value, expires)
+    return value
+
+
+def Reload(key):
+    """Returns the value of key from memcache, skipping the LRU, for values another instance may have replaced.
+
+    The LRU takes the value from memcache, None when memcache does not have it.
+    """
+    with metrics.Span('memcache'):
+        value, expires = _GetFromMemcache(key)
+    if value is None:
+        return None
+    metrics.Count('cache.memcache.reload')
+    LOCAL.Set(key, value, expires)
+    return value
+
+
+def Contains(keys):
+    """Returns the set of the keys that are cached, without fetching their values."""
+    cached = set(key for key in keys if LOCAL.Get(key) is not None)
+    missing = [key for key in keys if key not in cached]
+    if missing:
+        with metrics.Span('memcache'):
+            cached.update(memcache.get_multi(missing))
+    return cached
+
+
+def Set(key, value, expiration):
+    """Stores value (a string) under key for expiration seconds in both tiers."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    expires = int(time.time() + expiration)
+    LOCAL.Set(key, value, expires)
+    with metrics.Span('memcache'):
+        _SetInMemcache(key, value, expires)
+
+
+def Delete(key):
+    LOCAL.Delete(key)
+    memcache.delete(key)
+
+
+def GetStats():
+    return {'local': LOCAL.GetStats()}
+
+
+def _GetFromMemcache(key):
+    """Returns (value, expires) from memcache, (None, None) when it is not there."""
+    head = memcache.get(key)
+    if not isinstance(head, tuple):  # Missing, or a marker of ComputeOnce
+        return None, None
+    kind, expires, payload = head
+    if kind == 'r':
+        return payload, expires
+    if kind == 'z':
+        return zlib.decompress(payload), expires
+    version, count = payload
+    chunk_keys = [_GetChunkKey(key, version, index) for index in range(count)]
+    chunks = memcache.get_multi(chunk_keys)
+    if len(chunks) < count:  # A chunk was evicted
+        metrics.Count('cache.chunks.missing')
+        return None, None
+    return zlib.decompress(''.join(chunks[chunk_key] for chunk_key in chunk_keys)), expires
+
+
+def _SetInMemcache(key, value, expires):
+    # memcache takes an absolute unix time for expirations over 30 days
+    if len(value) <= COMPRESS_THRESHOLD:
+        memcache.set(key, ('r', expires, value), expires)
+        return
+    compressed = zlib.compress(value)
+    metrics.Count('cache.bytes.raw', len(value))
+    metrics.Count('cache.bytes.compressed', len(compressed))
+    if len(compressed) <= CHUNK_SIZE:
+        memcache.set(key, ('z', expires, compressed), expires)
+        return
+    version = os.urandom(4).encode('hex')
+    chunks = {}
+    for index, offset in enumerate(range(0, len(compressed), CHUNK_SIZE)):
+        chunks[_GetChunkKey(key, version, index)] = compressed[offset:offset + CHUNK_SIZE]
+    metrics.Count('cache.chunked')
+    # The head is written last so it never points at chunks that are not there
+    if memcache.set_multi(chunks, expires):
+        metrics.Count('cache.chunks.failed')
+        return
+    memcache.set(key, ('c', expires, (version, len(chunks))), expires)
+
+
+def _GetChunkKey(key, version, index):
+    return '{}:{}:{}'.format(key, version, index)
@@ -0,0 +1,393 @@
+"""Bulk exports of the series of every area of an area type, run on the task queue.
+
+The series of every district (or region, or basin) for several products are
+far too much work for an interactive /graph request. An export job computes
+them in the background instead, one unit per area with all its products, so
+every unit is a single ComputeSeriesBatch. A job runs at most EXPORT_LANES
+chains of tasks, each task computes one unit and queues the next unit of its
+chain. Results are stored per unit as soon as they are computed:
+
+    ExportJob                       the spec, the areas and the status
+    ExportJob/ExportPart <unit+1>   the values of one area, or the error it failed with
+
+A unit that fails is retried by the task queue with backoff, after
+EXPORT_MAX_ATTEMPTS it is stored as failed and its chain moves on. A unit
+refused by admission control (see admission.py) is queued again after the
+refusal's delay, that is not an attempt. Stored
+units are never computed again, so a resumed job only computes the units that
+are missing or failed. The download is streamed part by part, as CSV with a
+row per area and timestep and a column per product, or in a columnar format:
+
+    {"areas": [...], "products": [...], "dates": [...], ...}\\n   one line of JSON
+    float64 values, little endian, NaN for null                  area by area, product by product
+
+which numpy reads as frombuffer(data, '<f8').reshape(areas, products, dates).
+"""
+
+import array
+import csv
+import datetime
+import json
+import logging
+import os
+import StringIO
+import sys
+from httplib import HTTPException
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+from google.appengine.runtime import DeadlineExceededError
+
+import admission
+import config
+import ee
+import metrics
+
+EXPORT_QUEUE = 'exports'  # See queue.yaml
+EXPORT_AREA_TYPES = ('regions', 'districts', 'basins')
+EXPORT_FORMATS = {'csv': ('text/csv', 'csv'), 'columns': ('application/octet-stream', 'f8')}
+EXPORT_TIMESTEPS = ('day', 'month', 'year')
+EXPORT_STATISTICS = ('sum', 'mean', 'min', 'max')
+
+# Task chains per job, the queue bounds the tasks of all jobs together
+EXPORT_LANES = getattr(config, 'EXPORT_LANES', 2)
+EXPORT_MAX_ATTEMPTS = 5
+# Downloads are limited by the 32 MB response size of App Engine
+EXPORT_MAX_VALUES = 10 ** 6
+# Parts read from the datastore at once while streaming a download
+EXPORT_BATCH_SIZE = 10
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ExportJob(ndb.Model):
+    spec = ndb.JsonProperty()
+    areas = ndb.StringProperty(repeated=True, indexed=False)
+    status = ndb.StringProperty()
+    error = ndb.TextProperty()
+    # Resumes start the chains again, tasks of an earlier run are ignored
+    run = ndb.IntegerProperty(default=0)
+    lanes = ndb.IntegerProperty(default=0)
+    finished_lanes = ndb.IntegerProperty(repeated=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class ExportPart(ndb.Model):
+    values = ndb.BlobProperty(compressed=True)
+    error = ndb.TextProperty()
+    failed = ndb.BooleanProperty(default=False)
+
+
+###############################################################################
+#                                    Jobs.                                    #
+###############################################################################
+
+
+def ParseSpec(spec, products):
+    """Returns the spec of an export with its defaults, raises ValueError when it is not valid.
+
+    {"areaType": "districts", "products": ["CHIRPS", ...], "startDate": "yyyy-mm-dd",
+    "endDate": "yyyy-mm-dd", "timestep": "month", "statistic": "sum", "format": "csv"}
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('Expected an export spec')
+    parsed = {
+        'areaType': spec.get('areaType', 'districts'),
+        'products': spec.get('products') or sorted(products),
+        'startDate': spec.get('startDate'),
+        'endDate': spec.get('endDate'),
+        'timestep': spec.get('timestep', 'month'),
+        'statistic': spec.get('statistic', 'sum'),
+        'format': spec.get('format', 'csv')
+    }
+    if parsed['areaType'] not in EXPORT_AREA_TYPES:
+        raise ValueError('areaType must be one of {}'.format(', '.join(EXPORT_AREA_TYPES)))
+    if not isinstance(parsed['products'], list) or any(product not in products for product in parsed['products']):
+        raise ValueError('products must be a list of {}'.format(', '.join(sorted(products))))
+    if parsed['timestep'] not in EXPORT_TIMESTEPS:
+        raise ValueError('timestep must be one of {}'.format(', '.join(EXPORT_TIMESTEPS)))
+    if parsed['statistic'] not in EXPORT_STATISTICS:
+        raise ValueError('statistic must be one of {}'.format(', '.join(EXPORT_STATISTICS)))
+    if parsed['format'] not in EXPORT_FORMATS:
+        raise ValueError('format must be one of {}'.format(', '.join(sorted(EXPORT_FORMATS))))
+    try:
+        start = datetime.datetime.strptime(parsed['startDate'], '%Y-%m-%d')
+        end = datetime.datetime.strptime(parsed['endDate'], '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ValueError('startDate and endDate must be yyyy-mm-dd')
+    if end < start:
+        raise ValueError('endDate is before startDate')
+    return parsed
+
+
+def CreateJob(spec):
+    """Stores a job for the parsed spec and queues its start, returns the ExportJob."""
+    @ndb.transactional
+    def Create():
+        job = ExportJob(spec=spec, status=QUEUED)
+        job.put()
+        deferred.defer(StartJob, job.key.id(), job.run, _queue=EXPORT_QUEUE, _transactional=True)
+        return job
+
+    job = Create()
+    metrics.Count('export.jobs')
+    logging.info('Export %d queued: %s', job.key.id(), json.dumps(spec))
+    return job
+
+
+def ResumeJob(job):
+    """Queues the units of a finished job that failed or are missing again, False when it is still running."""
+    @ndb.transactional
+    def Resume():
+        current = job.key.get()
+        if current.status in (QUEUED, RUNNING):
+            return None
+        ndb.delete_multi(ExportPart.query(ExportPart.failed == True, ancestor=job.key).fetch(keys_only=True))
+        current.run += 1
+        current.status = QUEUED
+        current.error = None
+        current.finished_lanes = []
+        current.put()
+        deferred.defer(StartJob, current.key.id(), current.run, _queue=EXPORT_QUEUE, _transactional=True)
+        return current
+
+    resumed = Resume()
+    if resumed is None:
+        return False
+    logging.info('Export %d resumed, run %d', resumed.key.id(), resumed.run)
+    return True
+
+
+def GetStatus(job):
+    """Status of a job for polling, with the number of units done and the areas that failed."""
+    parts = ExportPart.query(ancestor=job.key).count()
+    failed = ExportPart.query(ExportPart.failed == True, ancestor=job.key).fetch()
+    status = {
+        'id': job.key.id(),
+        'status': job.status,
+        'spec': job.spec,
+        'units': len(job.areas),
+        'done': parts - len(failed),
+        'failed': {job.areas[part.key.id() - 1]: part.error for part in failed},
+        'created': job.created.isoformat() + 'Z',
+        'updated': job.updated.isoformat() + 'Z'
+    }
+    if job.error:
+        status['error'] = job.error
+    if job.status in (DONE, FAILED) and job.areas:
+        status['download'] = '/export/{}/download'.format(job.key.id())
+    return status
+
+
+def GetDownloadInfo(job):
+    """(content type, file name) of the download of a job."""
+    content_type, extension = EXPORT_FORMATS[job.spec['format']]
+    return content_type, 'export-{}.{}'.format(job.key.id(), extension)
+
+
+###############################################################################
+#                                    Tasks.                                   #
+###############################################################################
+
+
+def StartJob(job_id, run):
+    """Task that finds the areas of a job and starts its chains, a resumed job keeps its areas."""
+    import server  # server imports this module for its handlers
+
+    job = ExportJob.get_by_id(job_id)
+    if job is None or job.run != run or job.status != QUEUED:
+        return
+    spec = job.spec
+    try:
+        areas = job.areas or server.GetAreaNames(spec['areaType'])
+    except (Exception, DeadlineExceededError) as ex:  # DeadlineExceededError is not an Exception
+        if GetAttempt() < EXPORT_MAX_ATTEMPTS:
+            raise  # The task queue tries again with backoff
+        job.status, job.error = FAILED, server.ErrorHandling(ex) or type(ex).__name__
+        job.put()
+        return
+    steps = server.GetTimeSteps(spec['startDate'], spec['endDate'], spec['timestep'])
+    if len(areas) * len(spec['products']) * len(steps) > EXPORT_MAX_VALUES:
+        job.status = FAILED
+        job.error = 'Exports are limited to {} values, use fewer products or a longer timestep'.format(
+            EXPORT_MAX_VALUES)
+        job.put()
+        return
+    job.areas = areas
+    job.lanes = min(EXPORT_LANES, len(areas))
+    job.status = RUNNING if areas else DONE
+    job.put()
+    logging.info('Export %d run %d started: %d areas in %d lanes', job_id, run, len(areas), job.lanes)
+    for lane in range(job.lanes):
+        QueueUnit(job, lane)
+
+
+def RunUnit(job_id, run, unit, refusals=0):
+    """Task that computes and stores one unit of a job, then queues the next unit of its chain.
+
+    refusals is the number of times admission control refused the unit before.
+    """
+    import server
+
+    job = ExportJob.get_by_id(job_id)
+    # A task can run twice, the first run queued the next unit already
+    if job is None or job.run != run or GetPartKey(job.key, unit).get() is not None:
+        return
+    spec = job.spec
+    name = job.areas[unit]
+    try:
+        with metrics.Span('export.unit'):
+            server.InitializeEE()
+            series = server.GetAreaSeriesSpecs(name, spec['areaType'], spec['products'])
+            steps = server.GetTimeSteps(spec['startDate'], spec['endDate'], spec['timestep'])
+            cost = server.EstimateSeriesCost(series, steps, spec['timestep'], spec['statistic'])
+            with admission.Acquire(cost, admission.BULK):
+                results = server.ComputeSeriesBatch(spec['startDate'], spec['endDate'], series, spec['timestep'],
+                                                    spec['statistic'])
+        part = ExportPart(key=GetPartKey(job.key, unit),
+                          values=EncodeValues([[value for _, value in results[product]]
+                                               for product in spec['products']]))
+        metrics.Count('export.units')
+    except admission.Busy as ex:
+        logging.info('Export %d refused on %s, retrying in %ds', job_id, name, ex.retry_after)
+        metrics.Count('export.units.refused')
+        DeferUnit(job, unit, refusals + 1, ex.retry_after)
+        return
+    except (Exception, DeadlineExceededError) as ex:  # DeadlineExceededError is not an Exception
+        if GetAttempt() < EXPORT_MAX_ATTEMPTS:
+            logging.warning('Export %d failed on %s, retrying: %r', job_id, name, ex)
+            raise
+        part = ExportPart(key=GetPartKey(job.key, unit), error=server.ErrorHandling(ex) or type(ex).__name__,
+                          failed=True)
+        metrics.Count('export.units.failed')
+    part.put()
+    QueueUnit(job, unit + job.lanes)
+
+
+def QueueUnit(job, unit):
+    """Queues the next unit of a chain, or finishes the chain at its end."""
+    lane = unit % job.lanes
+    unit = GetNextUnit(job, unit)
+    if unit is None:
+        FinishLane(job.key, job.run, lane)
+        return
+    DeferUnit(job, unit)
+
+
+def DeferUnit(job, unit, refusals=0, countdown=0):
+    """Queues a RunUnit task, named so a task that runs twice does not fork its chain.
+
+    A refused unit gets a new task, its retry count starts over.
+    """
+    name = 'export-{}-{}-{}'.format(job.key.id(), job.run, unit)
+    if refusals:
+        name += '-refused-{}'.format(refusals)
+    try:
+        deferred.defer(RunUnit, job.key.id(), job.run, unit, refusals, _queue=EXPORT_QUEUE, _name=name,
+                       _countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def GetNextUnit(job, unit):
+    """The first unit from unit on in its chain that is not stored yet, None at the end of the chain."""
+    while unit < len(job.areas):
+        if GetPartKey(job.key, unit).get() is None:
+            return unit
+        unit += job.lanes
+    return None
+
+
+@ndb.transactional
+def FinishLane(job_key, run, lane):
+    """Marks a chain as finished, the last one marks the job as done (or failed when a unit failed)."""
+    job = job_key.get()
+    if job.run != run or lane in job.finished_lanes:
+        return
+    job.finished_lanes.append(lane)
+    if len(job.finished_lanes) >= job.lanes:
+        failed = ExportPart.query(ExportPart.failed == True, ancestor=job_key).count()
+        job.status = FAILED if failed else DONE
+        logging.info('Export %d %s, %d of %d units failed', job_key.id(), job.status, failed, len(job.areas))
+    job.put()
+
+
+def GetAttempt():
+    """Number of the current attempt of a task, App Engine passes the retries in a header."""
+    return int(os.environ.get('HTTP_X_APPENGINE_TASKRETRYCOUNT', 0)) + 1
+
+
+def GetPartKey(job_key, unit):
+    return ndb.Key(ExportPart, unit + 1, parent=job_key)  # Ids start at 1
+
+
+###############################################################################
+#                                  Downloads.                                 #
+###############################################################################
+
+
+def StreamExport(job, dates):
+    """Yields the download of a job in pieces, reading its parts in batches.
+
+    dates are the labels of the timesteps, units without a part (failed) are
+    written as nulls.
+    """
+    products = job.spec['products']
+    empty = EncodeValues([[None] * len(dates) for _ in products])
+    columnar = job.spec['format'] == 'columns'
+    if columnar:
+        header = dict(job.spec, areas=job.areas, dates=dates, dtype='<f8',
+                      failed=[job.areas[key.id() - 1] for key in
+                              ExportPart.query(ExportPart.failed == True, ancestor=job.key).fetch(keys_only=True)])
+        yield json.dumps(header) + '\n'
+    else:
+        yield FormatCSV([['area', 'date'] + products])
+    unit = 0
+    for part in ExportPart.query(ancestor=job.key).order(ExportPart.key).iter(batch_size=EXPORT_BATCH_SIZE):
+        index = part.key.id() - 1
+        while unit <= index:
+            values = part.values if unit == index and part.values else empty
+            if columnar:
+                yield values
+            else:
+                yield FormatCSV(GetRows(job.areas[unit], dates, DecodeValues(values, len(products))))
+            unit += 1
+    for unit in range(unit, len(job.areas)):
+        yield empty if columnar else FormatCSV(GetRows(job.areas[unit], dates, DecodeValues(empty, len(products))))
+
+
+def GetRows(area, dates, columns):
+    return [[area, date] + ['' if column[index] is None else '{:.10g}'.format(column[index]) for column in columns]
+            for index, date in enumerate(dates)]
+
+
+def FormatCSV(rows):
+    output = StringIO.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    for row in rows:
+        writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+    return output.getvalue()
+
+
+def EncodeValues(columns):
+    """Packs columns of values (None for nulls) as little endian float64, like the store does."""
+    values = array.array('d', [float('nan') if value is None else value for column in columns for value in column])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+
+def DecodeValues(data, count):
+    """Unpacks count columns packed by EncodeValues."""
+    values = array.array('d')
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    size = len(values) // count if count else 0
+    return [[None if value != value else value for value in values[index * size:(index + 1) * size]]
+            for index in range(count)]
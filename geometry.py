@@ -0,0 +1,263 @@
+"""In-process index of the area boundaries that ship in static/polygons.
+
+The same boundaries are stored as EE assets (see the *_PATH constants in
+server.py), but filtering those assets costs EE a full load of the asset on
+every request and asking it for things like bounds costs a round trip. The
+index is built once per instance from the GeoJSON files and holds, per area
+name, its bounding box, centroid, area and simplified geometries at each of
+SIMPLIFY_TOLERANCES. Those geometries are small enough to be sent inline with
+an EE computation.
+"""
+
+import json
+import math
+import os
+import threading
+
+POLYGONS_DIR = os.path.join(os.path.dirname(__file__), 'static', 'polygons')
+
+# Area type -> (GeoJSON file, property holding the area name)
+AREA_FILES = {
+    'country': ('myanmar_country_boundaries.json', 'Name'),
+    'regions': ('myanmar_state_region_boundaries.json', 'ST'),
+    'districts': ('myanmar_district_boundaries.json', 'DT'),
+    'basins': ('myanmar_basins_boundaries.json', 'Name'),
+}
+
+# Douglas-Peucker tolerances in degrees (0.001 is roughly 100 meters), the
+# finest one is still well below the scale of every product.
+SIMPLIFY_TOLERANCES = (0.001, 0.005, 0.02)
+
+# Geometries sent inline to EE are kept below this number of vertices, the
+# finest tolerance that fits is used.
+MAX_INLINE_POINTS = 10000
+
+# Kilometers per degree of latitude
+KM_PER_DEGREE = 111.32
+
+_INDEX = {}
+_LOCK = threading.Lock()
+
+
+def BuildIndex():
+    """Loads every area type, used to build the index before the first request."""
+    for area_type in AREA_FILES:
+        GetIndex(area_type)
+
+
+def GetIndex(area_type):
+    """Returns {name: entry} for the area type, built once per instance.
+
+    An entry is a dict with 'bbox' (min_x, min_y, max_x, max_y), 'centroid'
+    (x, y), 'area' in square kilometers, 'geometries', a GeoJSON MultiPolygon
+    per simplify tolerance and 'points', their number of vertices.
+    """
+    with _LOCK:
+        if area_type not in _INDEX:
+            _INDEX[area_type] = _LoadIndex(area_type)
+        return _INDEX[area_type]
+
+
+def GetAreaNames(area_type):
+    return sorted(GetIndex(area_type).keys())
+
+
+def GetEntry(name, area_type):
+    """Returns the index entry for a single area, or None when it is not available locally."""
+    return GetIndex(area_type).get(name)
+
+
+def GetBounds(names, area_type):
+    """Returns the bounding box of the given areas as GeoJSON Polygon coordinates.
+
+    Returns None when one of the areas is not available locally.
+    """
+    entries = _GetEntries(names, area_type)
+    if entries is None:
+        return None
+    min_x = min(entry['bbox'][0] for entry in entries)
+    min_y = min(entry['bbox'][1] for entry in entries)
+    max_x = max(entry['bbox'][2] for entry in entries)
+    max_y = max(entry['bbox'][3] for entry in entries)
+    return GetBoxPolygon((min_x, min_y, max_x, max_y))
+
+
+def GetBoxPolygon(bbox):
+    """GeoJSON Polygon coordinates of a (min_x, min_y, max_x, max_y) bounding box."""
+    min_x, min_y, max_x, max_y = bbox
+    return [[[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y]]]
+
+
+def GetArea(names, area_type):
+    """Returns the combined area of the given areas in square kilometers, or None."""
+    entries = _GetEntries(names, area_type)
+    return None if entries is None else sum(entry['area'] for entry in entries)
+
+
+def GetGeometry(names, area_type, tolerance=None):
+    """Returns the simplified GeoJSON MultiPolygon covering the given areas, or None.
+
+    Without a tolerance the finest one that stays below MAX_INLINE_POINTS is
+    used, otherwise the coarsest precomputed tolerance not above the given one.
+    """
+    entries = _GetEntries(names, area_type)
+    if entries is None:
+        return None
+    return _GetEntriesGeometry(entries, tolerance)
+
+
+def BuildShape(polygons):
+    """Returns {'bbox', 'area', 'geometry'} of a custom area, like a shapefile, given its GeoJSON polygons.
+
+    The geometry is simplified like the index entries, to be sent inline to EE.
+    """
+    entry = _BuildEntry(polygons)
+    return {'bbox': entry['bbox'], 'area': entry['area'], 'geometry': _GetEntriesGeometry([entry])}
+
+
+def Simplify(ring, tolerance):
+    """Douglas-Peucker simplification of a closed ring, returns None if it collapses."""
+    if len(ring) <= 4:
+        return ring
+    simplified = SimplifyLine(ring, tolerance)
+    return simplified if len(simplified) >= 4 else None
+
+
+def SimplifyLine(line, tolerance):
+    """Douglas-Peucker simplification of a line, its first and last point are always kept."""
+    if len(line) <= 2:
+        return line
+    keep = [False] * len(line)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(line) - 1)]
+    while stack:
+        first, last = stack.pop()
+        index, distance = _FarthestPoint(line, first, last)
+        if index is not None and distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(line, keep) if kept]
+
+
+def GetPolygons(geometry):
+    """Returns the list of polygons (lists of rings) of a Polygon, MultiPolygon or GeometryCollection."""
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    if geometry['type'] == 'GeometryCollection':
+        return [polygon for part in geometry['geometries'] for polygon in GetPolygons(part)]
+    return []
+
+
+def _GetEntries(names, area_type):
+    index = GetIndex(area_type)
+    if not names or any(name not in index for name in names):
+        return None
+    return [index[name] for name in names]
+
+
+def _GetEntriesGeometry(entries, tolerance=None):
+    if tolerance is None:
+        tolerance = next((t for t in SIMPLIFY_TOLERANCES
+                          if sum(entry['points'][t] for entry in entries) <= MAX_INLINE_POINTS),
+                         SIMPLIFY_TOLERANCES[-1])
+    else:
+        tolerance = max([t for t in SIMPLIFY_TOLERANCES if t <= tolerance] or [SIMPLIFY_TOLERANCES[0]])
+    return {
+        'type': 'MultiPolygon',
+        'coordinates': [polygon for entry in entries
+                        for polygon in entry['geometries'][tolerance]['coordinates']]
+    }
+
+
+def _LoadIndex(area_type):
+    if area_type not in AREA_FILES:
+        return {}
+    filename, name_property = AREA_FILES[area_type]
+    path = os.path.join(POLYGONS_DIR, filename)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+
+    # Areas can be split over several features
+    polygons = {}
+    for feature in data['features']:
+        name = feature['properties'][name_property]
+        polygons.setdefault(name, []).extend(GetPolygons(feature['geometry']))
+    return {name: _BuildEntry(area_polygons) for name, area_polygons in polygons.items()}
+
+
+def _BuildEntry(polygons):
+    points = [point for polygon in polygons for point in polygon[0]]
+    bbox = (min(p[0] for p in points), min(p[1] for p in points),
+            max(p[0] for p in points), max(p[1] for p in points))
+
+    # Shoelace over all rings, holes are wound the other way and subtract themselves
+    area = centroid_x = centroid_y = 0.0
+    for polygon in polygons:
+        for ring_index, ring in enumerate(polygon):
+            ring_area, ring_x, ring_y = _RingMoments(ring)
+            if (ring_area < 0) == (ring_index == 0):  # Normalize the winding, outer positive and holes negative
+                ring_area, ring_x, ring_y = -ring_area, -ring_x, -ring_y
+            area += ring_area
+            centroid_x += ring_x
+            centroid_y += ring_y
+    if area:
+        centroid = (centroid_x / (6 * area), centroid_y / (6 * area))
+    else:
+        centroid = ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+    # Degrees squared to square kilometers, longitude shrinks with the cosine of the latitude
+    area_km2 = area * KM_PER_DEGREE * KM_PER_DEGREE * math.cos(math.radians(centroid[1]))
+
+    geometries = {}
+    point_counts = {}
+    for tolerance in SIMPLIFY_TOLERANCES:
+        simplified = []
+        for polygon in polygons:
+            rings = [Simplify(ring, tolerance) for ring in polygon]
+            if rings[0] is not None:
+                simplified.append([ring for ring in rings if ring is not None])
+        if not simplified:  # Everything collapsed, an area this small is fine as its bounding box
+            simplified = [GetBoxPolygon(bbox)]
+        geometries[tolerance] = {'type': 'MultiPolygon', 'coordinates': simplified}
+        point_counts[tolerance] = sum(len(ring) for polygon in simplified for ring in polygon)
+
+    return {
+        'bbox': bbox,
+        'centroid': centroid,
+        'area': area_km2,
+        'geometries': geometries,
+        'points': point_counts
+    }
+
+
+def _RingMoments(ring):
+    """Returns the signed area and first moments of a ring in degrees."""
+    area = moment_x = moment_y = 0.0
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        cross = x1 * y2 - x2 * y1
+        area += cross
+        moment_x += (x1 + x2) * cross
+        moment_y += (y1 + y2) * cross
+    return area / 2, moment_x, moment_y
+
+
+def _FarthestPoint(ring, first, last):
+    """Returns the index and distance of the point farthest from the segment first-last."""
+    x1, y1 = ring[first][:2]
+    x2, y2 = ring[last][:2]
+    dx, dy = x2 - x1, y2 - y1
+    length = math.hypot(dx, dy)
+    index, distance = None, -1.0
+    for i in range(first + 1, last):
+        x, y = ring[i][:2]
+        if length:
+            d = abs(dy * x - dx * y + x2 * y1 - y2 * x1) / length
+        else:  # Closed ring, first and last are the same point
+            d = math.hypot(x - x1, y - y1)
+        if d > distance:
+            index, distance = i, d
+    return index, distance
@@ -0,0 +1,107 @@
+"""Timings and counters of the app, per request and per instance.
+
+Code that talks to EE, memcache or encodes JSON wraps the work in a Span, the
+duration is added to the totals of the instance (served on /metrics) and to
+the request that is being handled (sent back in the Server-Timing header).
+Counters count events like cache hits, retries and timeouts.
+
+The request is tracked per thread, threads started for a request (see
+server.EEExecutor) adopt it with SetRequest.
+"""
+
+import logging
+import random
+import re
+import threading
+import time
+
+# Fraction of the LogSampled messages that is actually logged
+LOG_SAMPLE_RATE = 0.01
+
+_TIMINGS = {}
+_COUNTERS = {}
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_STARTED = time.time()
+
+
+class Request(object):
+    """The spans of a single request, summed per name."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.durations = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def Add(self, name, seconds):
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def GetServerTiming(self):
+        """Server-Timing header value, concurrent spans of the same name are summed."""
+        with self.lock:
+            return ', '.join('{};dur={:.1f};desc="{}x"'.format(re.sub(r'[^\w-]', '-', name),
+                                                              self.durations[name] * 1000, self.counts[name])
+                             for name in sorted(self.durations))
+
+
+class Span(object):
+    """Context manager that records how long the work inside it took under name."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        RecordDuration(self.name, time.time() - self.started)
+        return False
+
+
+def GetRequest():
+    return getattr(_LOCAL, 'request', None)
+
+
+def SetRequest(request):
+    """Makes request the one the spans of this thread are added to, None to stop tracking."""
+    _LOCAL.request = request
+
+
+def RecordDuration(name, seconds):
+    with _LOCK:
+        timing = _TIMINGS.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        timing['count'] += 1
+        timing['total_ms'] += seconds * 1000
+        timing['max_ms'] = max(timing['max_ms'], seconds * 1000)
+    request = GetRequest()
+    if request is not None:
+        request.Add(name, seconds)
+
+
+def Count(name, value=1):
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def GetSnapshot():
+    """Returns the counters and timings of this instance since it started."""
+    with _LOCK:
+        timings = {}
+        for name, timing in _TIMINGS.items():
+            timings[name] = dict(timing, mean_ms=timing['total_ms'] / timing['count'])
+        return {
+            'uptime': time.time() - _STARTED,
+            'counters': dict(_COUNTERS),
+            'timings': timings
+        }
+
+
+def LogSampled(message, *args):
+    """Logs a debug message for LOG_SAMPLE_RATE of the calls, for messages on the hot path."""
+    if random.random() < LOG_SAMPLE_RATE:
+        logging.debug(message, *args)
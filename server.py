@@ -59,18 +59,38 @@ requests more quickly.
 
 """
 
+import calendar
+import datetime
+import hashlib
 import json
+import logging
 import os
+import Queue
+import random
+import struct
 import sys
+import threading
+import time
+import urllib
 from httplib import HTTPException
 
 import jinja2
+import numpy
 import webapp2
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import deferred
 
+import admission
+import cache
 import config
 import ee
+import exports
+import geometry
+import metrics
+import shapefiles
+import store
+import topology
 
 
 ###############################################################################
@@ -84,64 +104,247 @@ class MainHandler(webapp2.RequestHandler):
     def get(self):
         """Returns the main web page, populated with EE map."""
         template_values = {
-            'key': config.KEY
+            'key': config.KEY,
+            'boundaries_version': topology.GetVersion()
         }
         template = JINJA2_ENVIRONMENT.get_template('index.html')
         self.response.out.write(template.render(template_values))
 
 
-class OverlayHandler(webapp2.RequestHandler):
+class WarmupHandler(webapp2.RequestHandler):
+    """Prepares a new instance before App Engine sends it traffic, see /_ah/warmup in app.yaml."""
 
     def get(self):
-        name = self.request.url
-        json_data = memcache.get(name)
-        print('Getting For URL: ', name)
+        started = time.time()
+        InitializeEE()
+        JINJA2_ENVIRONMENT.get_template('index.html')
+        geometry.BuildIndex()
+        store.Preload()
+        topology.GetVersion()
+        logging.info('Warmup initialized in %.2fs', time.time() - started)
+        WarmHotQueries(started + WARMUP_DEADLINE)
+        self.response.out.write('OK')
+
+
+class InstrumentedHandler(webapp2.RequestHandler):
+    """Handler that tracks the spans of its requests and reports them in a Server-Timing header."""
+
+    def dispatch(self):
+        request = metrics.Request()
+        metrics.SetRequest(request)
+        try:
+            with metrics.Span('request.' + self.__class__.__name__):
+                super(InstrumentedHandler, self).dispatch()
+        finally:
+            metrics.SetRequest(None)
+            self.response.headers['Server-Timing'] = str(request.GetServerTiming())
+
+    def handle_exception(self, exception, debug):
+        """Answers queries refused by admission control with a 503 the browser retries after a while."""
+        if not isinstance(exception, admission.Busy):
+            return super(InstrumentedHandler, self).handle_exception(exception, debug)
+        logging.info('Refused %s: %s', self.request.url, exception)
+        self.response.clear()
+        self.response.set_status(503)
+        self.response.headers['Retry-After'] = str(exception.retry_after)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps({'error': str(exception), 'retryAfter': exception.retry_after}))
+
+    def GetCached(self, handler, key):
+        """Returns the cached JSON for key, counting hits, misses and bytes per handler."""
+        json_data = cache.Get(key)
+        if json_data is None:
+            metrics.Count('cache.{}.miss'.format(handler))
+        else:
+            metrics.Count('cache.{}.hit'.format(handler))
+            metrics.Count('cache.{}.bytes'.format(handler), len(json_data))
+            metrics.LogSampled('Cache hit for %s, %d bytes', self.request.url, len(json_data))
+        return json_data
+
+
+class OverlayHandler(InstrumentedHandler):
+
+    def get(self):
+        name = GetQueryCacheKey(self.request.path, self.request.GET)
+        json_data = self.GetCached('overlay', name)
+        RecordHotQuery(name)
+        logging.debug('Getting for URL: %s', self.request.url)
+        if json_data is not None:
+            json_data = CheckOverlayToken(name, self.request.GET, json_data)
         # If we've cached details for this URL, return them.
         if json_data is not None:
-            print('From Cache:')
-            print(json_data)
             self.response.headers['Content-Type'] = 'application/json'
             self.response.out.write(json_data)
             return
-        start_date = self.request.get('startDate')
-        end_date = self.request.get('endDate')
-        targets = self.request.get('target').split(',')
-        product = self.request.get('product')
-        timestep = self.request.get('timestep')
-        statistic = self.request.get('statistic')
-        method = self.request.get('method')
-        area_type = self.request.get('areaType')
-        values = {}
-        if method == 'area':
-            features = GetMultiAreaFeatures(targets, area_type)
-            # values['center'] = feature.centroid().getInfo()['coordinates']
-        elif method == 'shapefile':
-            features = GetShapeFileFeature(targets)
-            # values['center'] = feature.centroid().getInfo()['coordinates']
-        else:
-            values['error'] = 'Did not set correct method!'
-            self.response.headers['Content-Type'] = 'application/json'
-            self.response.out.write(json.dumps(values))
+        json_data = ComputeOnce(name, lambda: Admitted('/overlay', self.request.GET, GetOverlayForQuery),
+                                EE_TOKEN_LIFETIME)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json_data)
+
+
+class BatchHandler(InstrumentedHandler):
+    """Answers several /graph and /overlay queries at once, see RunBatch.
+
+    The body is {"queries": {id: {"path": "/graph", "params": {...}}, ...}},
+    with the params of the GET request, the response {"results": {id: ...}}
+    holds what that request would have returned.
+    """
+
+    def post(self):
+        try:
+            queries = json.loads(self.request.body)['queries']
+            valid = (isinstance(queries, dict) and 0 < len(queries) <= BATCH_MAX_QUERIES and
+                     all(query['path'] in ('/graph', '/overlay') and
+                         all(isinstance(value, basestring) for value in query['params'].values())
+                         for query in queries.values()))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            valid = False
+        if not valid:
+            self.abort(400, detail='Expected up to {} /graph or /overlay queries'.format(BATCH_MAX_QUERIES))
+        for query in queries.values():
+            RecordHotQuery(GetQueryCacheKey(query['path'], query['params']))
+        results = RunBatch(queries)
+        self.response.headers['Content-Type'] = 'application/json'
+        # The results are JSON already, they are not parsed just to be encoded again
+        self.response.out.write('{"results": {' + ', '.join('{}: {}'.format(json.dumps(query_id), result)
+                                                           for query_id, result in sorted(results.items())) + '}}')
+
+
+class ExportJobHandler(InstrumentedHandler):
+    """Base of the handlers of the bulk exports."""
+
+    def GetJob(self, job_id):
+        job = exports.ExportJob.get_by_id(int(job_id))
+        if job is None:
+            self.abort(404)
+        return job
+
+    def WriteStatus(self, job):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.out.write(json.dumps(exports.GetStatus(job)))
+
+
+class ExportHandler(ExportJobHandler):
+    """Starts a bulk export of all areas of an area type (POST) and reports its status (GET), see exports.py.
+
+    The body of a POST is the spec of the export, see exports.ParseSpec. Both
+    answer with the status of the job, which links to its download once it is
+    done.
+    """
+
+    def post(self):
+        try:
+            spec = exports.ParseSpec(json.loads(self.request.body), PRODUCTS)
+        except ValueError as ex:
+            self.abort(400, detail=str(ex))
+        job = exports.CreateJob(spec)
+        self.response.status = 202
+        self.response.headers['Location'] = '/export/{}'.format(job.key.id())
+        self.WriteStatus(job)
+
+    def get(self, job_id):
+        self.WriteStatus(self.GetJob(job_id))
+
+
+class ExportDownloadHandler(ExportJobHandler):
+    """Streams the results of a finished export."""
+
+    def get(self, job_id):
+        job = self.GetJob(job_id)
+        if job.status not in (exports.DONE, exports.FAILED) or not job.areas:
+            self.response.status = 409
+            self.WriteStatus(job)
             return
-        values = GetOverlayFor(start_date, end_date, product, statistic, features, timestep)
-        tries = 0
-        while 'error' in values.keys() and values['error'] == 'Timeout, deadline exceeded' and tries < 4:
-            tries = tries + 1
-            values = GetOverlayFor(start_date, end_date, product, statistic, features, timestep)
-        if 'error' not in values.keys():
-            memcache.add(name, json.dumps(values), MEMCACHE_EXPIRATION)
+        content_type, filename = exports.GetDownloadInfo(job)
+        spec = job.spec
+        dates = [FormatTimeStep(step, spec['timestep'])
+                 for step in GetTimeSteps(spec['startDate'], spec['endDate'], spec['timestep'])]
+        self.response.headers['Content-Type'] = content_type
+        self.response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        self.response.app_iter = exports.StreamExport(job, dates)
+
+
+class ExportResumeHandler(ExportJobHandler):
+    """Computes the areas of a finished export that failed again."""
+
+    def post(self, job_id):
+        job = self.GetJob(job_id)
+        if not exports.ResumeJob(job):
+            self.response.status = 409
+        self.WriteStatus(job.key.get())
+
+
+class BoundariesHandler(InstrumentedHandler):
+    """Serves the simplified boundaries of an area type as TopoJSON, see topology.py."""
+
+    def get(self, area_type, level):
+        # The browser asks for the levels there are layers of, see area.getLevel
+        if area_type not in topology.LAYER_PROPERTIES or int(level) not in topology.ZOOM_LEVELS:
+            self.abort(404)
+        layer = topology.GetLayer(area_type, int(level))
+        if layer is None:
+            self.abort(404)
+        gzipped = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        etag = layer['etag'] + ('-gzip' if gzipped else '')
+        # Versioned URLs never change, others are checked again every now and then
+        versioned = self.request.get('v') == topology.GetVersion()
         self.response.headers['Content-Type'] = 'application/json'
-        self.response.out.write(json.dumps(values))
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        self.response.headers['ETag'] = '"{}"'.format(etag)
+        self.response.headers['Cache-Control'] = 'public, max-age={}'.format(
+            BOUNDARIES_MAX_AGE if versioned else BOUNDARIES_REVALIDATE_AGE)
+        if etag in self.request.if_none_match:
+            self.response.status = 304
+            return
+        if gzipped:
+            self.response.headers['Content-Encoding'] = 'gzip'
+            self.response.out.write(layer['gzip'])
+        else:
+            self.response.out.write(layer['body'])
+
 
+class SFHandler(InstrumentedHandler):
+    """Validates a shapefile asset (GET) or takes an uploaded shapefile (POST), see GetShapeFile.
 
-class SFHandler(webapp2.RequestHandler):
+    Both answer with the bounding box and area of the shapefile, an upload
+    also with the id to use as the target of queries instead of an asset id.
+    """
 
     def get(self):
         link = self.request.get('link')
-        fc = ee.FeatureCollection(link)
-        print(fc.getInfo())
         data = {}
-        data['success'] = 'true'
+        try:
+            shape = GetShapeFile(link)
+            data['success'] = 'true'
+            if shape is not None:
+                data['bbox'] = shape['bbox']
+                data['area'] = shape['area']
+        except (ee.EEException, HTTPException) as ex:
+            data['error'] = ErrorHandling(ex)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(data))
+
+    def post(self):
+        files = {}
+        for upload in self.request.POST.getall('file'):
+            if hasattr(upload, 'file'):
+                files[upload.filename] = upload.file.read(SHAPEFILE_MAX_BYTES + 1)
+        data = {}
+        try:
+            if sum(len(contents) for contents in files.values()) > SHAPEFILE_MAX_BYTES:
+                raise ValueError('Shapefiles are limited to {} MB'.format(SHAPEFILE_MAX_BYTES // 2 ** 20))
+            polygons, records = shapefiles.ReadFiles(files)
+        except (ValueError, struct.error) as ex:
+            data['error'] = 'Invalid shapefile: {}'.format(ex)
+        else:
+            shape = geometry.BuildShape(polygons)
+            shape_json = json.dumps(shape)
+            link = SHAPEFILE_UPLOAD_PREFIX + hashlib.md5(shape_json).hexdigest()
+            cache.Set(GetShapeFileCacheKey(link), shape_json, SHAPEFILE_UPLOAD_EXPIRATION)
+            metrics.Count('shapefile.uploads')
+            data = {'success': 'true', 'id': link, 'bbox': shape['bbox'], 'area': shape['area'],
+                    'features': len(records)}
         self.response.headers['Content-Type'] = 'application/json'
         self.response.out.write(json.dumps(data))
 
@@ -149,35 +352,118 @@ class SFHandler(webapp2.RequestHandler):
 class TestHandler(webapp2.RequestHandler):
 
     def get(self):
+        InitializeEE()
         features = ee.FeatureCollection('users/joepkt/myanmar_district_boundaries')
         kayeh = features.filter(ee.Filter.eq('DT', 'Kayeh'))
         print(kayeh.getInfo())
 
 
+class MetricsHandler(webapp2.RequestHandler):
+    """Counters and timings of this instance, see metrics.py."""
+
+    def get(self):
+        snapshot = metrics.GetSnapshot()
+        snapshot['inflight'] = len(INFLIGHT)
+        snapshot['cache'] = cache.GetStats()
+        snapshot['admission'] = admission.GetStats()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(snapshot, indent=1, sort_keys=True))
+
+
 ###############################################################################
 #                                Overlay                                      #
 ###############################################################################
-def GetOverlayFor(start_date, end_date, product_name, statistic, target_feature, timestep):
+def GetOverlayForQuery(params):
+    """Returns the overlay for the parameters of an /overlay request."""
+    InitializeEE()
+    start_date = params.get('startDate', '')
+    end_date = params.get('endDate', '')
+    targets = params.get('target', '').split(',')
+    product = params.get('product', '')
+    timestep = params.get('timestep', '')
+    statistic = params.get('statistic', '')
+    method = params.get('method', '')
+    area_type = params.get('areaType', '')
+    bounds = None
+    area = None
+    if method == 'area':
+        features = GetMultiAreaFeatures(targets, area_type)
+        bounds = geometry.GetBounds([GetAreaName(name, area_type) for name in targets], area_type)
+        area = geometry.GetArea([GetAreaName(name, area_type) for name in targets], area_type)
+        # values['center'] = feature.centroid().getInfo()['coordinates']
+    elif method == 'shapefile':
+        try:
+            features, bounds, area = GetShapeFileRegion(','.join(targets))
+        except (ee.EEException, HTTPException) as ex:
+            return {'error': ErrorHandling(ex)}
+    else:
+        return {'error': 'Did not set correct method!'}
+
+    # The min/max and download url outlive the map token, they are cached on their own
+    stats_key = GetOverlayStatsKey(params)
+    cached = cache.Get(stats_key)
+    stats = json.loads(cached) if cached is not None else None
+    metrics.Count('overlay.stats.' + ('hit' if stats is not None else 'miss'))
+    values = GetOverlayFor(start_date, end_date, product, statistic, features, timestep, bounds, area, stats)
+    if stats is None and 'error' not in values:
+        cache.Set(stats_key, json.dumps({name: values[name] for name in OVERLAY_STATS}),
+                  GetQueryExpiration('/overlay', params))
+    return values
+
+
+def GetOverlayStatsKey(params):
+    return 'overlay:stats:' + GetQueryCacheKey('/overlay', params)
+
+
+def GetOverlayFor(start_date, end_date, product_name, statistic, target_feature, timestep, bounds=None,
+                  area=None, stats=None):
+    """Returns the map id, legend and download url for an overlay.
+
+    bounds are the GeoJSON Polygon coordinates of the download region, when
+    they are not known locally they are fetched from EE next to the min/max.
+    area is the size of the region in square kilometers, used to pick the scale.
+    stats are the OVERLAY_STATS of an earlier computation of the same overlay,
+    with them only a new map id is requested. 'issued' is the time the map
+    token was issued.
+    """
     values = {}
     try:
         # collection = GetOverlayImageCollection(start_date, end_date, product)
         # calced = GetCalculatedCollection(collection, statistic)
         product = PRODUCTS[product_name]
         image = GetOverlayCalculation(start_date, end_date, product, target_feature, timestep, statistic)
-        min_max = image.reduceRegion(ee.Reducer.minMax(), target_feature, product['scale'])
-        min = GetMin(min_max, target_feature)
-        max = GetMax(min_max, target_feature)
-        print('Min', min)
-        print('Max', max)
-        overlay = GetOverlayImage(image, target_feature, min, max, statistic)
-        data = overlay.getMapId()
+        executor = EEExecutor()
+        if stats is None:
+            region = target_feature.geometry()
+            reduce_settings = GetReduceSettings(product, area,
+                                                GetImageCount(product, GetTimeSteps(start_date, end_date, timestep),
+                                                              timestep))
+            with metrics.Span('overlay.minmax'):
+                if bounds is None:
+                    (minimum, maximum), bounds = executor.Run(
+                        lambda: ComputeMinMaxAdaptive(image, region, reduce_settings),
+                        lambda: CallWithBackoff(region.bounds().getInfo)['coordinates'])
+                else:
+                    minimum, maximum = ComputeMinMaxAdaptive(image, region, reduce_settings, bounds)
+            logging.debug('Overlay min %s, max %s', minimum, maximum)
+            overlay = GetOverlayImage(image, target_feature, minimum, maximum, statistic)
+            with metrics.Span('overlay.mapid'):
+                data, download_url = executor.Run(
+                    lambda: CallWithBackoff(overlay.getMapId, 'getMapId'),
+                    lambda: CallWithBackoff(lambda: overlay.getDownloadURL({'name': 'ImageOverlay',
+                                                                            'region': bounds,
+                                                                            'scale': reduce_settings['scale']}),
+                                            'getDownloadURL'))
+            stats = {'min': minimum, 'max': maximum, 'download_url': download_url,
+                     'scale': reduce_settings['scale']}
+        else:
+            overlay = GetOverlayImage(image, target_feature, stats['min'], stats['max'], statistic)
+            with metrics.Span('overlay.mapid'):
+                data = CallWithBackoff(overlay.getMapId, 'getMapId')
         values['mapid'] = data['mapid']
         values['token'] = data['token']
-        values['min'] = min
-        values['max'] = max
-        values['download_url'] = overlay.getDownloadURL(
-            {'name': 'ImageOverlay', 'region': target_feature.geometry().bounds().getInfo()['coordinates'],
-             'scale': product['scale']})
+        values['issued'] = int(time.time())
+        values.update(stats)
     except (ee.EEException, HTTPException) as ex:
         # Handle exceptions from the EE client library.
         if 'Deadline' in ex.args[0]:
@@ -185,42 +471,73 @@ def GetOverlayFor(start_date, end_date, product_name, statistic, target_feature,
         else:
             values['error'] = ErrorHandling(ex)
     finally:
-        print('Returning curr values')
         return values
 
 
-def GetOverlayCalculation(start_date, end_date, product, features, timestep, statistic):
-    start_date = ee.Date(start_date)
-    end_date = ee.Date(end_date)
-    date = ee.List.sequence(0, end_date.difference(start_date, timestep).toInt())
+def CheckOverlayToken(key, params, json_data):
+    """Returns the cached overlay JSON if its map token is still valid, None if it has to be recomputed.
+
+    A token that expires within EE_TOKEN_REFRESH seconds is still served,
+    while a task replaces the overlay in the background (see RefreshOverlay).
+    Such an overlay is read from memcache again first, the task may have run
+    on another instance and this one may have an old copy in its LRU.
+    """
+    age = GetOverlayAge(json_data)
+    if age >= EE_TOKEN_LIFETIME - EE_TOKEN_REFRESH:
+        refreshed = cache.Reload(key)
+        if refreshed is not None and GetOverlayAge(refreshed) < age:
+            metrics.Count('overlay.token.reloaded')
+            json_data, age = refreshed, GetOverlayAge(refreshed)
+    if age >= EE_TOKEN_LIFETIME:
+        metrics.Count('overlay.token.expired')
+        return None
+    if age >= EE_TOKEN_LIFETIME - EE_TOKEN_REFRESH:
+        ScheduleOverlayRefresh(key, params)
+    return json_data
+
+
+def GetOverlayAge(json_data):
+    """Seconds since the map token of a cached overlay was issued."""
+    return time.time() - json.loads(json_data).get('issued', 0)
+
+
+def ScheduleOverlayRefresh(key, params):
+    """Starts RefreshOverlay for the query, unless it was started already."""
+    if not memcache.add('refresh:' + key, True, EE_TOKEN_REFRESH):
+        return
+    metrics.Count('overlay.token.refresh')
+    deferred.defer(RefreshOverlay, key, dict(params))
+
+
+def RefreshOverlay(key, params):
+    """Task that replaces a cached overlay with one with a new map token, from its cached min/max."""
+    InitializeEE()
+    # Busy is raised again, the task queue retries the refresh later
+    details = Admitted('/overlay', params, GetOverlayForQuery, admission.BULK)
+    if 'error' in details:
+        logging.warning('Refreshing overlay %s failed: %s', key, details['error'])
+        return
+    cache.Set(key, json.dumps(details), EE_TOKEN_LIFETIME)
 
-    def GetImageForDate(advance):
-        m = start_date.advance(advance, timestep)
-        img = product['collection'].filterDate(m, ee.Date(m).advance(1, timestep)).filterBounds(features.geometry())
-        img_calced = img.sum()
-        return img_calced
 
-    multiplied = ee.ImageCollection.fromImages(date.map(GetImageForDate).flatten()).map(
-        lambda i: Multiply(i, product['multiply']))
-    return GetCalculatedCollection(multiplied, statistic)
+def GetOverlayCalculation(start_date, end_date, product, features, timestep, statistic):
+    """The statistic over the timesteps of the product's total per timestep."""
+    steps = GetTimeSteps(start_date, end_date, timestep)
+    images = GetTimeStepImages(product, steps[0], len(steps), timestep, 'sum', features.geometry())
+    return GetCalculatedCollection(images, statistic)
 
 
 def GetOverlayImageCollection(start_date, end_date, product):
     start_date = ee.Date(start_date)
     end_date = ee.Date(end_date)
-    return product['collection'].filterDate(start_date, end_date)
-
-
-def GetMax(min_max, region):
-    # maximum = min_max.select('max')#.reduceRegion(ee.Reducer.max(), region, 5000)
-    # return ee.Number(min_max.get('max')).getInfo()
-    return min_max.get(min_max.keys().get(0)).getInfo()
+    return GetCollection(product).filterDate(start_date, end_date)
 
 
-def GetMin(min_max, region):
-    # minmum = min_max.select('min')#.reduceRegion(ee.Reducer.min(), region, 5000)
-    # return ee.Number(min_max.get('min')).getInfo()
-    return min_max.get(min_max.keys().get(1)).getInfo()
+def GetMinMax(min_max):
+    """Returns (min, max) from an evaluated ee.Reducer.minMax() dictionary ({band}_min, {band}_max)."""
+    minimum = next((value for key, value in min_max.items() if key.endswith('_min')), None)
+    maximum = next((value for key, value in min_max.items() if key.endswith('_max')), None)
+    return minimum, maximum
 
 
 def GetOverlayImage(image, region, min, max, statistic):
@@ -232,74 +549,179 @@ def GetOverlayImage(image, region, min, max, statistic):
 ###############################################################################
 #                                Graph For Regions.                           #
 ###############################################################################
-class GraphHandler(webapp2.RequestHandler):
+class GraphHandler(InstrumentedHandler):
 
     def get(self):
-        name = self.request.url
-        json_data = memcache.get(name)
-        print('Getting For URL: ', name)
-        # If we've cached details for this polygon, return them.
-        if json_data is not None:
-            print('From Cache:')
-            print(json_data)
-            self.response.headers['Content-Type'] = 'application/json'
-            self.response.out.write(json_data)
+        name = GetQueryCacheKey(self.request.path, self.request.GET)
+        json_data = self.GetCached('graph', name)
+        RecordHotQuery(name)
+        logging.debug('Getting for URL: %s', self.request.url)
+        stream = self.request.get('stream') == 'ndjson'
+        if stream and json_data is None and not IsInFlight(name):
+            # Admitted before the response starts, so a refusal can still be a 503
+            ticket = admission.Acquire(EstimateQueryCost(self.request.path, self.request.GET))
+            self.response.headers['Content-Type'] = 'application/x-ndjson'
+            self.response.app_iter = StreamedRecords(
+                StreamGraphForQuery(name, self.request.GET, time.time() + GetTimeLeft()), ticket)
+            return
+        # If we've not cached details for this polygon, compute all of its series in one go.
+        if json_data is None:
+            json_data = ComputeOnce(name, lambda: Admitted('/graph', self.request.GET, GetGraphForQuery),
+                                    GetQueryExpiration(self.request.path, self.request.GET))
+        if stream:
+            self.response.headers['Content-Type'] = 'application/x-ndjson'
+            self.response.out.write(''.join(StreamDetails(json.loads(json_data))))
             return
-        print('NOT CACHE:')
-        start_date = self.request.get('startDate')
-        end_date = self.request.get('endDate')
-        target = self.request.get('target')
-        area_type = self.request.get('areaType')
-        product = self.request.get('product')
-        statistic = self.request.get('statistic')
-        timestep = self.request.get('timestep')
-        method = self.request.get('method')
-        products = product.split(",")
-        if method == 'coordinate':
-            json_features = json.loads(target)
-            print(json_features)
-            features = json_features['features']
-            details = GetPointsLineSeries(start_date, end_date, products, features, timestep,
-                                          statistic)
-        else:
-            targets = target.split(",")
-            details = GetGraphSeries(start_date, end_date, targets, area_type, method,
-                                     products, timestep, statistic)
-            details['title'] = 'ShapeFile' if method == 'shapefile' else product if len(targets) > 1 else target
-        json_data = json.dumps(details)
-        # Store the results in memcache.
-        if 'error' not in details.keys():
-            memcache.add(name, json_data, MEMCACHE_EXPIRATION)
         self.response.headers['Content-Type'] = 'application/json'
-        self.response.out.write(json_data)
+        self.response.out.write(FormatGraphJSON(json_data, self.request.get('format')))
+
+
+def GetGraphForQuery(params):
+    """Returns the graph details for the parameters of a /graph request."""
+    InitializeEE()
+    start_date = params.get('startDate', '')
+    end_date = params.get('endDate', '')
+    target = params.get('target', '')
+    area_type = params.get('areaType', '')
+    product = params.get('product', '')
+    statistic = params.get('statistic', '')
+    timestep = params.get('timestep', '')
+    method = params.get('method', '')
+    products = product.split(",")
+    if method == 'coordinate':
+        json_features = json.loads(target)
+        features = json_features['features']
+        details = GetPointsLineSeries(start_date, end_date, products, features, timestep,
+                                      statistic)
+    else:
+        targets = target.split(",")
+        details = GetGraphSeries(start_date, end_date, targets, area_type, method,
+                                 products, timestep, statistic)
+        details['title'] = GetGraphTitle(method, product, targets)
+    return details
+
+
+def GetGraphTitle(method, product, targets):
+    return 'ShapeFile' if method == 'shapefile' else product if len(targets) > 1 else ','.join(targets)
+
+
+def StreamGraphForQuery(key, params, deadline):
+    """Yields the graph for a /graph request as NDJSON, every series as soon as it is computed.
+
+    The first record is a header with the title and columns, followed by a
+    record per series and an end record holding the error of every series that
+    failed, so one failing product does not take the others down. Series are
+    computed independently until the deadline (a unix time). The query is in
+    flight while it runs, so identical queries wait for it (see ComputeOnce),
+    and when all series succeed the combined graph is cached like a regular
+    /graph response.
+    """
+    flight = Flight()
+    with INFLIGHT_LOCK:
+        leader = INFLIGHT.setdefault(key, flight) is flight
+    marker = 'inflight:' + key
+    marked = memcache.add(marker, True, INFLIGHT_WAIT)
+    try:
+        InitializeEE()
+        method = params.get('method', '')
+        if method == 'coordinate':  # Markers are sampled in a single call, nothing to stream
+            details = GetGraphForQuery(params)
+            if 'error' not in details:
+                flight.result = json.dumps(details)
+                cache.Set(key, flight.result, GetQueryExpiration('/graph', params))
+            for record in StreamDetails(details):
+                yield record
+            return
+
+        start_date = params.get('startDate', '')
+        end_date = params.get('endDate', '')
+        targets = params.get('target', '').split(',')
+        product = params.get('product', '')
+        timestep = params.get('timestep', '')
+        statistic = params.get('statistic', '')
+        try:
+            series = GetGraphSeriesSpecs(targets, params.get('areaType', ''), method, product.split(','))
+        except (ee.EEException, HTTPException) as ex:
+            yield StreamRecord({'type': 'end', 'error': ErrorHandling(ex), 'errors': {}})
+            return
+
+        yield StreamRecord({'type': 'header', 'title': GetGraphTitle(method, product, targets),
+                            'columns': ['Date'] + [spec['name'] for spec in series]})
+        chart_data = {}
+        errors = {}
+        compute = lambda spec: ComputeSeriesBatch(start_date, end_date, [spec], timestep, statistic)[spec['name']]
+        try:
+            for index, points, error in EEExecutor(deadline=deadline - time.time()).Iterate(compute, series):
+                name = series[index]['name']
+                if error is not None:
+                    errors[name] = ErrorHandling(error)
+                    continue
+                chart_data[name] = points
+                yield StreamRecord({'type': 'series', 'name': name, 'data': points,
+                                    'scale': series[index]['reduce']['scale']})
+        except ee.EEException as ex:  # Deadline of the whole request
+            errors.update({spec['name']: ErrorHandling(ex) for spec in series if spec['name'] not in chart_data})
+        if not errors:  # Cached before the end record, the client may be gone once it has it
+            details = GetSeriesDetails(chart_data, series)
+            details['title'] = GetGraphTitle(method, product, targets)
+            flight.result = json.dumps(details)
+            cache.Set(key, flight.result, GetQueryExpiration('/graph', params))
+        yield StreamRecord({'type': 'end', 'errors': errors})
+    finally:
+        if marked:
+            memcache.delete(marker)
+        if leader:
+            with INFLIGHT_LOCK:
+                del INFLIGHT[key]
+            flight.done.set()
+
+
+class StreamedRecords(object):
+    """Response body of the records of an admitted query, it holds the admission ticket until it is closed.
+
+    The server closes the body when it is sent or the client went away, also
+    when it never started reading it.
+    """
+
+    def __init__(self, records, ticket):
+        self.records = records
+        self.ticket = ticket
+
+    def __iter__(self):
+        with self.ticket:
+            for record in self.records:
+                yield record
+
+    def close(self):
+        self.records.close()
+        self.ticket.Release()
+
+
+def StreamDetails(details):
+    """Yields already computed graph details in the NDJSON format of StreamGraphForQuery."""
+    if 'error' in details:
+        yield StreamRecord({'type': 'end', 'error': details['error'], 'errors': {}})
+        return
+    names = [series['name'] for series in details['series']]
+    yield StreamRecord({'type': 'header', 'title': details.get('title'), 'columns': ['Date'] + names})
+    for series in details['series']:
+        yield StreamRecord({'type': 'series', 'name': series['name'],
+                            'data': [list(point) for point in zip(details['dates'], series['values'])],
+                            'scale': details.get('scale', {}).get(series['name'])})
+    yield StreamRecord({'type': 'end', 'errors': {}})
+
+
+def StreamRecord(record):
+    return json.dumps(record) + '\n'
 
 
 def GetGraphSeries(start_date, end_date, targets, area_type, method, products, timestep, statistic):
     """Returns data to draw graphs with for single area"""
     details = {}
     try:
-        # Else build new dictionary
-        chart_data = None
-        if method == 'area':
-            if len(targets) > 1:  # Multiple area's means one product (build dictionary of Area's with their data)
-                print('Going for multiple areas: {}, with product: {}'.format(targets, products))
-                chart_data = {target: ComputeGraphSeries(start_date, end_date, GetAreaGeometry(target, area_type),
-                                                         PRODUCTS[products[0]], timestep, statistic) for
-                              target in targets}
-            else:
-                print('Going for single area: {}, with products: {}'.format(targets, products))
-                region = GetAreaGeometry(targets[0], area_type)
-                chart_data = {
-                    product: ComputeGraphSeries(start_date, end_date, region, PRODUCTS[product], timestep, statistic)
-                    for
-                    product in products}
-        elif method == 'shapefile':
-            region = GetShapeFileFeature(targets)
-            chart_data = {
-                product: ComputeGraphSeries(start_date, end_date, region, PRODUCTS[product], timestep, statistic)
-                for product in products}
-        print(details)
-        details['chart_data'] = OrderForGraph(chart_data)
+        series = GetGraphSeriesSpecs(targets, area_type, method, products)
+        chart_data = ComputeSeriesBatch(start_date, end_date, series, timestep, statistic)
+        details.update(GetSeriesDetails(chart_data, series))
 
     except (ee.EEException, HTTPException) as ex:
         # Handle exceptions from the EE client library.
@@ -309,33 +731,241 @@ def GetGraphSeries(start_date, end_date, targets, area_type, method, products, t
         return details
 
 
-def ComputeGraphSeries(start_date, end_date, region, product, timestep, statistic):
-    start_date = ee.Date(start_date)
-    end_date = ee.Date(end_date)
-    months = ee.List.sequence(0, end_date.difference(start_date, timestep).toInt())
-
-    # Create base months
-    def CalculateTimeStep(count):
-        m = start_date.advance(count, timestep)
-        img_col = product['collection'].filterDate(m, ee.Date(m).advance(1, timestep))
-        img_multiplied = GetCalculatedCollection(img_col.map(lambda i: Multiply(i, product['multiply'])), statistic)
-        img = img_multiplied.reduceRegion(
-            ee.Reducer.mean(), region,
-            product['scale'])
+def GetGraphSeriesSpecs(targets, area_type, method, products):
+    """Returns the SeriesSpec of every line in an area or shapefile graph."""
+    series = []
+    if method == 'area':
+        if len(targets) > 1:  # Multiple area's means one product (build dictionary of Area's with their data)
+            logging.debug('Going for multiple areas: %s, with product: %s', targets, products)
+            series = [SeriesSpec(target, GetAreaGeometry(target, area_type), PRODUCTS[products[0]],
+                                 GetAreaRegionKey(target, area_type), (area_type, GetAreaName(target, area_type)),
+                                 geometry.GetArea([GetAreaName(target, area_type)], area_type))
+                      for target in targets]
+        else:
+            logging.debug('Going for single area: %s, with products: %s', targets, products)
+            series = GetAreaSeriesSpecs(targets[0], area_type, products)
+    elif method == 'shapefile':
+        link = ','.join(targets)
+        region, bounds, area_km2 = GetShapeFileRegion(link)
+        series = [SeriesSpec(product, region, PRODUCTS[product], 'shapefile:' + link, area_km2=area_km2,
+                             bounds=bounds) for product in products]
+    return series
+
+
+def GetAreaSeriesSpecs(name, area_type, products):
+    """Returns a SeriesSpec per product for a single standard area, named after the product."""
+    region = GetAreaGeometry(name, area_type)
+    region_key = GetAreaRegionKey(name, area_type)
+    area = (area_type, GetAreaName(name, area_type))
+    area_km2 = geometry.GetArea([area[1]], area_type)
+    return [SeriesSpec(product, region, PRODUCTS[product], region_key, area, area_km2) for product in products]
+
+
+def GetSeriesDetails(chart_data, series):
+    """Graph details of the computed {name: points} of the SeriesSpecs, with the scale of every line."""
+    details = MergeSeries(chart_data, [spec['name'] for spec in series])
+    details['scale'] = {spec['name']: spec['reduce']['scale'] for spec in series}
+    return details
+
+
+def SeriesSpec(name, region, product, region_key=None, area=None, area_km2=None, bounds=None):
+    """Describes one line in a graph, the name is used as its column title.
+
+    area is the (area_type, name) of a standard area, used to look the series
+    up in the precomputed store. area_km2 is the size of the region, used to
+    pick the scale of the reduction (see GetReduceSettings), which is stored
+    in 'reduce' once the series is computed. bounds are the GeoJSON Polygon
+    coordinates of the region when they are known without asking EE.
+    """
+    return {
+        'name': name,
+        'region': region,
+        'product': product,
+        'region_key': region_key,
+        'area': area,
+        'area_km2': area_km2,
+        'bounds': bounds,
+        'reduce': {'scale': product['scale']}
+    }
+
+
+def ComputeGraphSeries(start_date, end_date, region, product, timestep, statistic, region_key=None):
+    """Returns [[date, value], ...] for every timestep between the given dates."""
+    spec = SeriesSpec(product['name'], region, product, region_key)
+    return ComputeSeriesBatch(start_date, end_date, [spec], timestep, statistic)[spec['name']]
+
+
+def ComputeSeriesBatch(start_date, end_date, series, timestep, statistic):
+    """Returns {name: [[date, value], ...]} for every SeriesSpec in one EE round trip.
+
+    Standard areas are answered from the precomputed store where it covers the
+    query. Other series with a region_key are cached per timestep, so a query
+    that overlaps an earlier one only asks EE for the timesteps it is missing.
+    The missing spans of all series are combined into a single FeatureCollection
+    and fetched with one getInfo call.
+    """
+    steps = GetTimeSteps(start_date, end_date, timestep)
+    results = [[None] * len(steps) for _ in series]
+    for index, spec in enumerate(series):
+        stored, spec['reduce'] = GetStoredSteps(spec, steps, timestep, statistic)
+        metrics.Count('series.steps.store', len(stored))
+        for step_index, value in stored.items():
+            results[index][step_index] = [FormatTimeStep(steps[step_index], timestep), value]
+
+    keys = [[GetSeriesCacheKey(spec['product'], spec['region_key'], statistic, timestep, step,
+                               spec['reduce']['scale']) for step in steps]
+            if spec['region_key'] is not None else [None] * len(steps) for spec in series]
+    with metrics.Span('memcache'):
+        cached = memcache.get_multi([key for index, series_keys in enumerate(keys)
+                                     for step_index, key in enumerate(series_keys)
+                                     if key is not None and results[index][step_index] is None])
+    for index, series_keys in enumerate(keys):
+        for step_index, key in enumerate(series_keys):
+            if key in cached:
+                results[index][step_index] = cached[key]
+    metrics.Count('series.steps.memcache', len(cached))
+
+    # The span of missing timesteps per series, gaps in between are refreshed as well
+    spans = {}
+    for index, points in enumerate(results):
+        missing = [step_index for step_index, point in enumerate(points) if point is None]
+        metrics.Count('series.steps.missing', len(missing))
+        metrics.LogSampled('Series %s: %d stored or cached, %d missing', series[index]['name'],
+                           len(points) - len(missing), len(missing))
+        if missing:
+            spans[index] = (missing[0], missing[-1] - missing[0] + 1)
+
+    if spans:
+        features = None
+        # Skip the combined request when a series is known not to fit in one
+        if all(count <= GetChunkSize(series[index], timestep, count) for index, (_, count) in spans.items()):
+            collections = [CalculateSeriesFeatures(index, steps[first], count, series[index], timestep, statistic)
+                           for index, (first, count) in spans.items()]
+            try:
+                features = CallWithBackoff(lambda: ee.FeatureCollection(collections).flatten().getInfo()['features'])
+            except ee.EEException as ex:
+                if not IsTooLargeError(ex):
+                    raise
+                logging.info('Batch too large, fetching %d series adaptively', len(collections))
+        if features is None:
+            # Every series on its own, split into chunks that fit within the deadline
+            def FetchSpan(index):
+                first, count = spans[index]
+                return FetchSeriesAdaptive(index, steps[first:first + count], series[index], timestep, statistic)
+
+            features = [feature for part in EEExecutor().Map(FetchSpan, spans.keys()) for feature in part]
+        complete = {}
+        for feature in features:
+            properties = feature['properties']
+            index = int(properties['series'])
+            step_index = spans[index][0] + int(properties['step'])
+            point = [properties['system:time_start'], properties.get('value')]
+            results[index][step_index] = point
+            key = keys[index][step_index]
+            if key is not None and IsCompleteTimeStep(steps[step_index], timestep, series[index]['product']):
+                complete[key] = point
+        FillMissingSteps(results, steps, timestep)
+        with metrics.Span('memcache'):
+            memcache.set_multi(complete, SERIES_EXPIRATION)
+
+    return {spec['name']: points for spec, points in zip(series, results)}
+
+
+def GetStoredSteps(spec, steps, timestep, statistic):
+    """Returns the {step index: value} of a SeriesSpec in the store and the reduce settings of the series.
+
+    The store holds series reduced at the product's scale. They are used when
+    the steps left for EE fit COST_BUDGET at that scale as well, so a series
+    never mixes scales and reports the one it was reduced at. Otherwise every
+    step is computed at the scale GetReduceSettings picks for all of them.
+    """
+    product = spec['product']
+    image_count = GetImageCount(product, steps, timestep)
+    if spec['area'] is not None:
+        area_type, name = spec['area']
+        stored = store.Lookup(area_type, name, product['name'], statistic, timestep, steps, AdvanceDate,
+                              product['scale'])
+        if stored:
+            settings = GetReduceSettings(product, spec['area_km2'],
+                                         image_count * (len(steps) - len(stored)) // len(steps))
+            if settings['scale'] == product['scale']:
+                return stored, settings
+    return {}, GetReduceSettings(product, spec['area_km2'], image_count)
+
+
+def FillMissingSteps(results, steps, timestep):
+    """Gives timesteps EE returned nothing for (no images) a None value, they are not cached."""
+    for points in results:
+        for step_index, point in enumerate(points):
+            if point is None:
+                points[step_index] = [FormatTimeStep(steps[step_index], timestep), None]
+
+
+def CalculateSeriesFeatures(index, start_date, count, spec, timestep, statistic, weighted=False):
+    """FeatureCollection with one feature per timestep, tagged with the series index.
+
+    weighted features also hold the pixel count of the mean as 'weight', used to
+    combine the means of parts of a region.
+    """
+    start = ee.Date(start_date.isoformat())
+    region = spec['region']
+
+    def CalculateTimeStep(image):
+        step = image.get('step')
+        m = start.advance(step, timestep)
+        if weighted:
+            img = image.reduceRegion(
+                reducer=ee.Reducer.mean().combine(ee.Reducer.count(), None, True), geometry=region,
+                **spec['reduce'])
+            # Keys are sorted, {band}_count comes before {band}_mean
+            return ee.Feature(None, {
+                'system:time_start': m.format(GetDateFormat(timestep)),
+                'value': img.values().get(1),
+                'weight': img.values().get(0),
+                'series': index,
+                'step': step
+            })
+        img = image.reduceRegion(
+            reducer=ee.Reducer.mean(), geometry=region,
+            **spec['reduce'])
         return ee.Feature(None, {
-            'system:time_start': m.format(
-                'dd-MM-YYYY' if timestep == 'day' else 'MM-YYYY' if timestep == 'month' else 'YYYY'),
-            'value': img.values().get(0)
+            'system:time_start': m.format(GetDateFormat(timestep)),
+            'value': img.values().get(0),
+            'series': index,
+            'step': step
         })
 
-    chart_data = months.map(CalculateTimeStep).getInfo()
+    images = GetTimeStepImages(spec['product'], start_date, count, timestep, statistic, region)
+    return ee.FeatureCollection(images.map(CalculateTimeStep))
+
 
-    def ExtractMean(feature):
-        return [feature['properties']['system:time_start'], feature['properties']['value']]
+def GetTimeStepImages(product, start_date, count, timestep, statistic, region=None):
+    """ImageCollection with the statistic over the product's images of each of count timesteps.
 
-    chart_data = map(ExtractMean, chart_data)
-    print(chart_data)
-    return chart_data
+    The collection is filtered by date (and region) once, every image is
+    tagged with the index of its timestep and a join groups them per
+    timestep, instead of filtering the whole collection again for every
+    timestep. The unit multiplier is applied to the reduced image of a
+    timestep, which gives the same result for every statistic because the
+    multipliers are positive. Images have the timestep index as 'step',
+    timesteps without images are left out.
+    """
+    start = ee.Date(start_date.isoformat())
+    images = GetCollection(product).filterDate(start, ee.Date(AdvanceDate(start_date, count, timestep).isoformat()))
+    if region is not None:
+        images = images.filterBounds(region)
+    tagged = images.map(lambda image: image.set(
+        'step', ee.Date(image.get('system:time_start')).difference(start, timestep).floor().toInt()))
+    steps = ee.FeatureCollection(ee.List.sequence(0, count - 1).map(lambda step: ee.Feature(None, {'step': step})))
+    grouped = ee.Join.saveAll('images').apply(steps, tagged, ee.Filter.equals(leftField='step', rightField='step'))
+
+    def Reduce(step):
+        image = GetCalculatedCollection(ee.ImageCollection.fromImages(step.get('images')), statistic)
+        if product['multiply'] != 1:
+            image = image.multiply(product['multiply'])
+        return image.set('step', step.get('step'))
+
+    return ee.ImageCollection(grouped.map(Reduce))
 
 
 ###############################################################################
@@ -343,37 +973,666 @@ def ComputeGraphSeries(start_date, end_date, region, product, timestep, statisti
 ###############################################################################
 
 def GetPointsLineSeries(start_date, end_date, products, point_features, timestep, statistic):
-    point_features = map(ee.Feature, point_features)  # Map to ee.Feature (loads GeoJSON)
+    region_keys = map(GetPointRegionKey, point_features)
     details = {
         'title': 'Markers'
     }
 
     try:
         if len(products) > 1:
-            print('Multiple products')
-            chart_data = {product: ComputeGraphSeries(start_date, end_date, point_features[0].geometry(),
-                                                      PRODUCTS[product], timestep, statistic) for product in
-                          products}
+            region = ee.Geometry(point_features[0]['geometry'])
+            series = [SeriesSpec(product, region, PRODUCTS[product], region_keys[0], area_km2=0) for product in
+                      products]
+            chart_data = ComputeSeriesBatch(start_date, end_date, series, timestep, statistic)
         else:
-            product = PRODUCTS[products[0]]
-            print('Multiple Features with product: ', product)
-            chart_data = {
-                point.getInfo()['properties']['title']: ComputeGraphSeries(start_date, end_date, point.geometry(),
-                                                                           PRODUCTS[products[0]], timestep, statistic)
-                for point in point_features}
-            # for point in point_features:
-            #     details[point.getInfo()['properties']['title']] = GetPointData(start_date, end_date, product,
-            #                                                                    point, timestep, statistic)
-        print(details)
-        details['chart_data'] = OrderForGraph(chart_data)
+            chart_data = ComputePointSeries(start_date, end_date, point_features, region_keys, PRODUCTS[products[0]],
+                                            timestep, statistic)
+        details.update(MergeSeries(chart_data))
     except (ee.EEException, HTTPException) as ex:
         # Handle exceptions from the EE client library.
         details['error'] = ErrorHandling(ex)
     finally:
-        print("Done getting Chart Data")
         return details
 
 
+def ComputePointSeries(start_date, end_date, point_features, region_keys, product, timestep, statistic):
+    """Returns {title: [[date, value], ...]} for every GeoJSON marker in one EE round trip.
+
+    Titles are read from the GeoJSON, every timestep image samples all uncached
+    markers at once with reduceRegions.
+    """
+    steps = GetTimeSteps(start_date, end_date, timestep)
+    keys = [[GetSeriesCacheKey(product, region_key, statistic, timestep, step) for step in steps]
+            for region_key in region_keys]
+    with metrics.Span('memcache'):
+        cached = memcache.get_multi([key for point_keys in keys for key in point_keys])
+    results = [[cached.get(key) for key in point_keys] for point_keys in keys]
+
+    missing = [(point_index, step_index) for point_index, points in enumerate(results)
+               for step_index, point in enumerate(points) if point is None]
+    metrics.Count('series.steps.memcache', len(steps) * len(keys) - len(missing))
+    metrics.Count('series.steps.missing', len(missing))
+    if missing:
+        point_indices = sorted(set(point_index for point_index, _ in missing))
+        first = min(step_index for _, step_index in missing)
+        count = max(step_index for _, step_index in missing) - first + 1
+        points = ee.FeatureCollection([ee.Feature(ee.Geometry(point_features[index]['geometry']), {'point': index})
+                                       for index in point_indices])
+        start = ee.Date(steps[first].isoformat())
+        date_format = GetDateFormat(timestep)
+
+        def SampleTimeStep(image):
+            step = image.get('step')
+            m = start.advance(step, timestep)
+            samples = image.reduceRegions(points, ee.Reducer.mean(), product['scale'])
+            return samples.map(lambda f: f.set({'step': step, 'system:time_start': m.format(date_format)}))
+
+        images = GetTimeStepImages(product, steps[first], count, timestep, statistic)
+        samples = ee.FeatureCollection(images.map(SampleTimeStep)).flatten()
+        features = CallWithBackoff(samples.getInfo)
+        complete = {}
+        for feature in features['features']:
+            properties = feature['properties']
+            point_index = int(properties['point'])
+            step_index = first + int(properties['step'])
+            point = [properties['system:time_start'], properties.get('mean')]
+            results[point_index][step_index] = point
+            if IsCompleteTimeStep(steps[step_index], timestep, product):
+                complete[keys[point_index][step_index]] = point
+        FillMissingSteps(results, steps, timestep)
+        with metrics.Span('memcache'):
+            memcache.set_multi(complete, SERIES_EXPIRATION)
+
+    return {feature['properties']['title']: points for feature, points in zip(point_features, results)}
+
+
+###############################################################################
+#                                   Batches.                                  #
+###############################################################################
+def RunBatch(queries):
+    """Returns {id: JSON} for the {id: {'path': ..., 'params': ...}} queries of a /batch request.
+
+    Identical queries are computed once and cached ones are not computed at
+    all. The series of area and shapefile graphs over the same dates,
+    timestep and statistic are computed together in one ComputeSeriesBatch,
+    which shares the regions and lines the graphs have in common and fetches
+    them in a single EE round trip. Other queries run concurrently. The batch
+    is admitted (see admission.py) with the cost of all its uncached queries.
+    """
+    keys = {query_id: GetQueryCacheKey(query['path'], query['params']) for query_id, query in queries.items()}
+    unique = {}
+    for query_id, query in sorted(queries.items()):
+        unique.setdefault(keys[query_id], query)
+    metrics.Count('batch.queries', len(queries))
+    metrics.Count('batch.duplicates', len(queries) - len(unique))
+
+    results = {}
+    groups = {}
+    tasks = []
+    for key, query in unique.items():
+        path, params = query['path'], query['params']
+        cached = cache.Get(key)
+        if cached is not None and path == '/overlay':
+            cached = CheckOverlayToken(key, params, cached)
+        if cached is not None:
+            metrics.Count('batch.cached')
+            results[key] = cached
+        elif path == '/graph' and params.get('method') in ('area', 'shapefile'):
+            group = tuple(params.get(param, '') for param in ('startDate', 'endDate', 'timestep', 'statistic'))
+            groups.setdefault(group, {})[key] = params
+        else:
+            if path == '/graph':
+                compute, expiration = GetGraphForQuery, GetQueryExpiration(path, params)
+            else:
+                compute, expiration = GetOverlayForQuery, EE_TOKEN_LIFETIME
+            tasks.append(([key], lambda key=key, compute=compute, params=params, expiration=expiration: {
+                key: ComputeOnce(key, lambda: compute(params), expiration)}))
+    for group, graphs in groups.items():
+        tasks.append((list(graphs), lambda group=group, graphs=graphs: ComputeBatchGraphs(graphs, *group)))
+
+    cost = sum(EstimateQueryCost(unique[key]['path'], unique[key]['params'])
+               for key in unique if key not in results)
+    try:
+        with admission.Acquire(cost):
+            for index, computed, error in EEExecutor().Iterate(lambda task: task[1](), tasks):
+                if error is not None:
+                    computed = dict.fromkeys(tasks[index][0], json.dumps({'error': ErrorHandling(error)}))
+                results.update(computed)
+    except ee.EEException as ex:  # Deadline of the whole request
+        error = json.dumps({'error': ErrorHandling(ex)})
+        results.update((key, error) for key in unique if key not in results)
+
+    return {query_id: FormatGraphJSON(results[keys[query_id]], query['params'].get('format'))
+            if query['path'] == '/graph' else results[keys[query_id]] for query_id, query in queries.items()}
+
+
+def ComputeBatchGraphs(graphs, start_date, end_date, timestep, statistic):
+    """Returns {key: JSON} for the {key: params} of area and shapefile graphs over the same time range.
+
+    A line that several graphs have in common (same region and product) is
+    computed once, and graphs over the same region share its geometry.
+    """
+    InitializeEE()
+    regions = {}
+    lines = {}
+    layouts = {}
+    results = {}
+    for key, params in graphs.items():
+        targets = params.get('target', '').split(',')
+        method = params.get('method', '')
+        product = params.get('product', '')
+        try:
+            series = GetGraphSeriesSpecs(targets, params.get('areaType', ''), method, product.split(','))
+        except (ee.EEException, HTTPException, KeyError) as ex:  # KeyError for an unknown product
+            results[key] = json.dumps({'error': ErrorHandling(ex)})
+            continue
+        layout = []
+        for spec in series:
+            line = lines.setdefault((spec['region_key'], spec['product']['name']),
+                                    dict(spec, name=str(len(lines)),
+                                         region=regions.setdefault(spec['region_key'], spec['region'])))
+            layout.append((spec['name'], line))
+        layouts[key] = (GetGraphTitle(method, product, targets), layout)
+    metrics.Count('batch.lines', len(lines))
+
+    chart_data = {}
+    error = None
+    try:
+        chart_data = ComputeSeriesBatch(start_date, end_date, lines.values(), timestep, statistic)
+    except (ee.EEException, HTTPException) as ex:
+        error = json.dumps({'error': ErrorHandling(ex)})
+    for key, (title, layout) in layouts.items():
+        if error is not None:
+            results[key] = error
+            continue
+        series = [dict(line, name=name) for name, line in layout]
+        details = GetSeriesDetails({name: chart_data[line['name']] for name, line in layout}, series)
+        details['title'] = title
+        with metrics.Span('json'):
+            results[key] = json.dumps(details)
+        cache.Set(key, results[key], GetQueryExpiration('/graph', graphs[key]))
+    return results
+
+
+###############################################################################
+#                                  Admission.                                 #
+###############################################################################
+def Admitted(path, params, compute, lane=admission.INTERACTIVE):
+    """Returns compute(params) once the query is admitted, see admission.py. Raises admission.Busy.
+
+    Admission happens out here, GetOverlayFor and GetGraphSeries turn every
+    exception into an error in their result.
+    """
+    with admission.Acquire(EstimateQueryCost(path, params), lane):
+        return compute(params)
+
+
+def EstimateQueryCost(path, params):
+    """Estimated EE cost (images * pixels) of a /graph or /overlay query, see EstimateSeriesCost.
+
+    Queries that fail before they reach EE cost nothing, as do overlays whose
+    min/max are cached (only a new map id is requested).
+    """
+    try:
+        timestep = params.get('timestep', '')
+        steps = GetTimeSteps(params.get('startDate', ''), params.get('endDate', ''), timestep)
+        products = [PRODUCTS[product] for product in params.get('product', '').split(',')]
+    except (ValueError, KeyError):
+        return 0.0
+    statistic = params.get('statistic', '')
+    targets = params.get('target', '').split(',')
+    method = params.get('method', '')
+    area_type = params.get('areaType', '')
+    if path == '/overlay':
+        if cache.Contains([GetOverlayStatsKey(params)]):
+            return 0.0
+        products = products[:1]
+    if method == 'coordinate':
+        try:
+            points = len(json.loads(params.get('target', ''))['features'])
+        except (ValueError, KeyError, TypeError):
+            return 0.0
+        # Every point is a single pixel per image, several products sample only the first point
+        return sum(GetImageCount(product, steps, timestep) for product in products) * (
+            points if len(products) == 1 else 1)
+    if method == 'area':
+        names = [GetAreaName(target, area_type) for target in targets]
+        if path == '/overlay':
+            series = [SeriesSpec(products[0]['name'], None, products[0],
+                                 area_km2=geometry.GetArea(names, area_type))]
+        elif len(names) > 1:
+            series = [SeriesSpec(name, None, products[0], area=(area_type, name),
+                                 area_km2=geometry.GetArea([name], area_type)) for name in names]
+        else:
+            series = [SeriesSpec(product['name'], None, product, area=(area_type, names[0]),
+                                 area_km2=geometry.GetArea(names, area_type)) for product in products]
+    elif method == 'shapefile':
+        cached = cache.Get(GetShapeFileCacheKey(','.join(targets)))
+        area_km2 = json.loads(cached)['area'] if cached is not None else None
+        series = [SeriesSpec(product['name'], None, product, area_km2=area_km2) for product in products]
+    else:
+        return 0.0
+    return EstimateSeriesCost(series, steps, timestep, statistic)
+
+
+def EstimateSeriesCost(series, steps, timestep, statistic):
+    """Estimated EE cost of the SeriesSpecs over the steps: images times pixels at their scale.
+
+    The cost model of GetReduceSettings, for the steps the store does not
+    cover (see GetStoredSteps). Steps cached in memcache are counted, looking
+    them up would cost a round trip per query. A region of unknown size costs
+    COST_BUDGET.
+    """
+    cost = 0.0
+    for spec in series:
+        stored, settings = GetStoredSteps(spec, steps, timestep, statistic)
+        missing = len(steps) - len(stored)
+        if not missing:
+            continue
+        if spec['area_km2'] is None:
+            cost += COST_BUDGET
+            continue
+        image_count = GetImageCount(spec['product'], steps, timestep)
+        scale = settings['scale']
+        cost += image_count * missing / len(steps) * spec['area_km2'] * 1e6 / (scale * scale)
+    return cost
+
+
+###############################################################################
+#                                  Hot queries.                               #
+###############################################################################
+def RecordHotQuery(key):
+    """Counts a sample of the /graph and /overlay queries, so warmup knows which cached results to load."""
+    if random.random() >= HOT_QUERY_SAMPLE_RATE:
+        return
+    client = memcache.Client()
+    for _ in range(3):  # Lost a race with another request, try again
+        queries = client.gets(HOT_QUERIES_KEY)
+        if queries is None:
+            memcache.add(HOT_QUERIES_KEY, {}, HOT_QUERIES_EXPIRATION)
+            queries = client.gets(HOT_QUERIES_KEY)
+            if queries is None:
+                return
+        queries[key] = queries.get(key, 0) + 1
+        if len(queries) > HOT_QUERIES_SIZE:  # Forget the least popular ones
+            for stale in sorted(queries, key=queries.get)[:len(queries) - HOT_QUERIES_SIZE]:
+                del queries[stale]
+        if client.cas(HOT_QUERIES_KEY, queries, HOT_QUERIES_EXPIRATION):
+            return
+
+
+def WarmHotQueries(deadline):
+    """Loads the cached results of the most popular queries into the LRU of this instance, until the deadline.
+
+    Queries that are not cached are left to the requests that need them,
+    computing them could keep the instance out of rotation for a minute.
+    """
+    queries = memcache.get(HOT_QUERIES_KEY) or {}
+    loaded = 0
+    for key in sorted(queries, key=queries.get, reverse=True)[:WARMUP_QUERIES]:
+        if time.time() > deadline:
+            logging.info('Warmup deadline reached')
+            break
+        if cache.Get(key) is not None:
+            loaded += 1
+    metrics.Count('warmup.loaded', loaded)
+    logging.info('Warmup loaded %d of the %d most popular queries', loaded, min(len(queries), WARMUP_QUERIES))
+
+
+###############################################################################
+#                               Request coalescing.                           #
+###############################################################################
+class Flight(object):
+    """An in-progress computation that concurrent identical queries wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def ComputeOnce(key, compute, expiration):
+    """Returns the JSON of compute(), running it once for concurrent queries with the same key.
+
+    Within an instance identical queries wait for the first one. Across
+    instances an in-flight marker in memcache makes other instances poll
+    memcache for the result instead of starting the same EE computation. When
+    the computation fails (nothing cached) the waiting queries compute it
+    themselves, if their request has INFLIGHT_MIN_COMPUTE seconds left. They
+    wait at most INFLIGHT_WAIT seconds and never past the request's deadline,
+    a query without a result by then raises admission.Busy. Results without
+    an error are cached under key for expiration seconds.
+    """
+    with INFLIGHT_LOCK:
+        flight = INFLIGHT.get(key)
+        leader = flight is None
+        if leader:
+            flight = INFLIGHT[key] = Flight()
+    if not leader:
+        logging.info('Waiting for identical query in this instance')
+        metrics.Count('inflight.wait.instance')
+        flight.done.wait(max(min(INFLIGHT_WAIT, GetTimeLeft()), 0))
+        if flight.result is not None:
+            return flight.result
+        CheckTimeToCompute()
+
+    marker = 'inflight:' + key
+    marked = False
+    try:
+        result = None
+        if leader:
+            marked = memcache.add(marker, True, INFLIGHT_WAIT)
+            if not marked:
+                result = WaitForOtherInstance(key, marker, min(INFLIGHT_WAIT, GetTimeLeft()))
+                if result is None:
+                    CheckTimeToCompute()
+        if result is None:
+            details = compute()
+            with metrics.Span('json'):
+                result = json.dumps(details)
+            if 'error' not in details:
+                cache.Set(key, result, expiration)
+        flight.result = result
+        return result
+    finally:
+        if marked:
+            memcache.delete(marker)
+        if leader:
+            with INFLIGHT_LOCK:
+                del INFLIGHT[key]
+            flight.done.set()
+
+
+def IsInFlight(key):
+    """True when an identical query is being computed, on this instance or another one."""
+    with INFLIGHT_LOCK:
+        if key in INFLIGHT:
+            return True
+    return memcache.get('inflight:' + key) is not None
+
+
+def WaitForOtherInstance(key, marker, wait):
+    """Polls memcache for the result of a query computed by another instance, None if it did not arrive in time."""
+    logging.info('Waiting for identical query in another instance')
+    metrics.Count('inflight.wait.memcache')
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(INFLIGHT_POLL)
+        result = cache.Get(key)
+        if result is not None:
+            return result
+        if memcache.get(marker) is None:  # Finished without a result, or gave up
+            return None
+    return None
+
+
+def CheckTimeToCompute():
+    """Raises admission.Busy when the request has too little time left to compute a query it waited for."""
+    if GetTimeLeft() < INFLIGHT_MIN_COMPUTE:
+        metrics.Count('inflight.busy')
+        raise admission.Busy('The same query is still being computed, please try again in a moment',
+                             admission.RETRY_AFTER)
+
+
+def GetTimeLeft():
+    """Seconds until the EE_REQUEST_DEADLINE of the request being handled, a full deadline outside requests."""
+    request = metrics.GetRequest()
+    if request is None:
+        return EE_REQUEST_DEADLINE
+    return request.started + EE_REQUEST_DEADLINE - time.time()
+
+
+###############################################################################
+#                             Adaptive execution.                             #
+###############################################################################
+def FetchSeriesAdaptive(index, steps, spec, timestep, statistic):
+    """Fetches the features of one series in chunks of timesteps that fit within the deadline.
+
+    On a deadline error the chunk is halved and the size that worked is
+    remembered for the product and region. A single timestep that still does
+    not fit is computed over parts of the region. Step properties are relative
+    to steps[0], like a single CalculateSeriesFeatures call.
+    """
+    chunk = GetChunkSize(spec, timestep, len(steps))
+    learned = None
+    features = []
+    offset = 0
+    while offset < len(steps):
+        size = min(chunk, len(steps) - offset)
+        try:
+            part = CallWithBackoff(
+                lambda: CalculateSeriesFeatures(index, steps[offset], size, spec, timestep,
+                                                statistic).getInfo()['features'])
+        except ee.EEException as ex:
+            if not IsTooLargeError(ex):
+                raise
+            if size > 1:
+                chunk = learned = max(size // 2, 1)
+                logging.info('Series %s too large, retrying with %d timesteps', spec['name'], chunk)
+                metrics.Count('ee.split.time')
+                continue
+            part = [FetchTimeStepSplit(index, steps[offset], spec, timestep, statistic, GetRegionBounds(spec))]
+        for feature in part:
+            feature['properties']['step'] = offset + int(feature['properties']['step'])
+        features.extend(part)
+        offset += size
+    if learned is not None:
+        LearnChunkSize(spec, timestep, learned)
+    return features
+
+
+def FetchTimeStepSplit(index, step, spec, timestep, statistic, bounds, depth=0):
+    """Computes a single timestep over the quarters of the region, combining their means by pixel count."""
+    def FetchQuarter(quarter):
+        part = dict(spec, region=spec['region'].intersection(ee.Geometry.Rectangle(GetBoundsBox(quarter)), 1))
+        try:
+            features = CallWithBackoff(
+                lambda: CalculateSeriesFeatures(index, step, 1, part, timestep, statistic,
+                                                weighted=True).getInfo()['features'])
+            return features[0] if features else None  # No images over the quarter
+        except ee.EEException as ex:
+            if not IsTooLargeError(ex) or depth + 1 >= MAX_SPLIT_DEPTH:
+                raise
+            return FetchTimeStepSplit(index, step, part, timestep, statistic, quarter, depth + 1)
+
+    logging.info('Splitting %s at %s over %d parts', spec['name'], step, 4 ** (depth + 1))
+    metrics.Count('ee.split.region')
+    parts = [part for part in EEExecutor().Map(FetchQuarter, SplitBounds(bounds)) if part is not None]
+    weighted = [(p['properties'].get('value'), p['properties'].get('weight') or 0) for p in parts]
+    weighted = [(value, weight) for value, weight in weighted if value is not None and weight > 0]
+    total = sum(weight for _, weight in weighted)
+    properties = {'system:time_start': FormatTimeStep(step, timestep), 'series': index, 'step': 0}
+    properties['value'] = sum(value * weight for value, weight in weighted) / total if total else None
+    properties['weight'] = total
+    return {'type': 'Feature', 'geometry': None, 'properties': properties}
+
+
+def ComputeMinMaxAdaptive(image, region, reduce_settings, bounds=None, depth=0):
+    """Returns (min, max) of the image over the region, over quarters of it if it does not fit the deadline."""
+    try:
+        return GetMinMax(CallWithBackoff(image.reduceRegion(reducer=ee.Reducer.minMax(), geometry=region,
+                                                            **reduce_settings).getInfo, 'reduceRegion'))
+    except ee.EEException as ex:
+        if not IsTooLargeError(ex) or depth >= MAX_SPLIT_DEPTH:
+            raise
+    if bounds is None:
+        bounds = CallWithBackoff(region.bounds().getInfo)['coordinates']
+    logging.info('Splitting min/max over %d parts', 4 ** (depth + 1))
+    metrics.Count('ee.split.region')
+    parts = EEExecutor().Map(
+        lambda quarter: ComputeMinMaxAdaptive(image, region.intersection(ee.Geometry.Rectangle(GetBoundsBox(quarter)),
+                                                                         1), reduce_settings, quarter,
+                                                  depth + 1),
+        SplitBounds(bounds))
+    minimums = [minimum for minimum, _ in parts if minimum is not None]
+    maximums = [maximum for _, maximum in parts if maximum is not None]
+    return min(minimums) if minimums else None, max(maximums) if maximums else None
+
+
+def CallWithBackoff(function, name='getInfo'):
+    """Calls EE, retrying transient errors with exponential backoff and jitter.
+
+    Every attempt takes a slot of EE_CALL_SEMAPHORE, so function should be a
+    single EE call. Attempts are timed as the 'ee.<name>' span, waiting for the
+    semaphore as 'ee.queue'.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with metrics.Span('ee.queue'):
+                EE_CALL_SEMAPHORE.acquire()
+            try:
+                with metrics.Span('ee.' + name):
+                    return function()
+            finally:
+                EE_CALL_SEMAPHORE.release()
+        except (ee.EEException, HTTPException) as ex:
+            if IsTooLargeError(ex):
+                metrics.Count('ee.timeouts')
+            if attempt == MAX_RETRIES or not IsTransientError(ex):
+                metrics.Count('ee.errors')
+                raise
+            delay = BACKOFF_BASE * 2 ** attempt * random.uniform(0.5, 1.5)
+            logging.warning('Transient error (%s), retrying in %.2fs', ex, delay)
+            metrics.Count('ee.retries')
+            time.sleep(delay)
+
+
+def GetChunkSize(spec, timestep, default):
+    """Number of timesteps of this product and region known to fit in one request."""
+    key = GetChunkSizeKey(spec, timestep)
+    if key not in CHUNK_SIZES:
+        learned = memcache.get(key)
+        if learned is None:
+            return default
+        CHUNK_SIZES[key] = learned
+    return CHUNK_SIZES[key]
+
+
+def LearnChunkSize(spec, timestep, size):
+    key = GetChunkSizeKey(spec, timestep)
+    CHUNK_SIZES[key] = size
+    memcache.set(key, size, CHUNK_SIZE_EXPIRATION)
+
+
+def GetChunkSizeKey(spec, timestep):
+    region_key = spec['region_key'] or spec['name']
+    return 'chunk:' + hashlib.md5(u'{}:{}:{}'.format(spec['product']['name'], region_key,
+                                                     timestep).encode('utf-8')).hexdigest()
+
+
+def GetRegionBounds(spec):
+    """Bounds of a series region, from the local index for standard areas."""
+    if spec['bounds'] is not None:
+        return spec['bounds']
+    if spec['area'] is not None:
+        bounds = geometry.GetBounds([spec['area'][1]], spec['area'][0])
+        if bounds is not None:
+            return bounds
+    return CallWithBackoff(spec['region'].bounds().getInfo)['coordinates']
+
+
+def GetBoundsBox(bounds):
+    """Returns [min_x, min_y, max_x, max_y] of GeoJSON Polygon coordinates."""
+    xs = [point[0] for point in bounds[0]]
+    ys = [point[1] for point in bounds[0]]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def SplitBounds(bounds):
+    """Splits GeoJSON Polygon bounds into its four quarters."""
+    min_x, min_y, max_x, max_y = GetBoundsBox(bounds)
+    mid_x, mid_y = (min_x + max_x) / 2.0, (min_y + max_y) / 2.0
+    return [[[[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]]
+            for x1, x2 in ((min_x, mid_x), (mid_x, max_x)) for y1, y2 in ((min_y, mid_y), (mid_y, max_y))]
+
+
+###############################################################################
+#                                   Executor.                                 #
+###############################################################################
+class EEExecutor(object):
+    """Runs independent EE calls of a single request on a bounded pool of threads.
+
+    All calls share the request's deadline. The first call that fails cancels
+    every call that has not started yet and its exception is raised to the
+    caller. Calls that are already talking to EE can't be interrupted, their
+    results are dropped. Across requests the number of outstanding EE calls on
+    this instance is limited by EE_CALL_SEMAPHORE to stay within the account's
+    QPS, it is taken by CallWithBackoff around each single EE call so nested
+    executors can't deadlock on it.
+    """
+
+    def __init__(self, max_workers=None, deadline=None):
+        self.max_workers = max_workers or EE_MAX_CONCURRENCY
+        self.deadline = time.time() + (deadline or EE_REQUEST_DEADLINE)
+        self.request = metrics.GetRequest()  # Spans of the workers count for the request that started them
+
+    def Run(self, *calls):
+        """Executes the given zero-argument callables, returns their results in order."""
+        return self.Map(lambda call: call(), calls)
+
+    def Map(self, function, items):
+        """Returns [function(item) for item in items], with the calls running concurrently."""
+        items = list(items)
+        if len(items) <= 1:
+            return [self._Call(function, item) for item in items]
+        results = [None] * len(items)
+        for index, result, error in self._Start(function, items, cancel_on_error=True):
+            if error is not None:
+                raise error
+            results[index] = result
+        return results
+
+    def Iterate(self, function, items):
+        """Yields (index, result, error) for every item as soon as its call is done.
+
+        A failing call does not cancel the others, its exception is yielded as error.
+        """
+        items = list(items)
+        for item in self._Start(function, items, cancel_on_error=False):
+            yield item
+
+    def _Start(self, function, items, cancel_on_error):
+        tasks = Queue.Queue()
+        for index, item in enumerate(items):
+            tasks.put((index, item))
+        done = Queue.Queue()
+        cancelled = threading.Event()
+
+        def Worker():
+            metrics.SetRequest(self.request)
+            while not cancelled.is_set():
+                try:
+                    index, item = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    done.put((index, self._Call(function, item), None))
+                except Exception as ex:
+                    if cancel_on_error:
+                        cancelled.set()
+                    done.put((index, None, ex))
+
+        for _ in range(min(self.max_workers, len(items))):
+            worker = threading.Thread(target=Worker)
+            worker.daemon = True
+            worker.start()
+
+        try:
+            for _ in items:
+                try:
+                    yield done.get(timeout=max(self.deadline - time.time(), 0))
+                except Queue.Empty:
+                    metrics.Count('ee.deadlines')
+                    raise ee.EEException('Deadline exceeded while waiting for Earth Engine')
+        finally:
+            cancelled.set()
+
+    def _Call(self, function, item):
+        if time.time() > self.deadline:
+            metrics.Count('ee.deadlines')
+            raise ee.EEException('Deadline exceeded before calling Earth Engine')
+        return function(item)
+
+
 ###############################################################################
 #                                   Helpers.                                  #
 ###############################################################################
@@ -398,25 +1657,19 @@ def GetCalculatedCollection(images, statistic):
     if statistic == 'max':
         return images.max()
     else:
-        print('No statistics specified')
+        logging.warning('No statistics specified')
         return images
 
 
 def GetAreaGeometry(name, area_type):
     """Returns an ee.Geometry for the area's with given names."""
-    if area_type == 'regions':
-        stdt = 'ST'
-        path = REGIONS_PATH
-    elif area_type == 'basins':
-        stdt = 'Name'
-        path = BASINS_PATH
-    elif area_type == 'country':
-        stdt = 'Name'
-        path = MYANMAR_PATH
-        name = name.upper()
-    else:
-        stdt = 'DT'
-        path = DISTRICTS_PATH
+    stdt, path = GetAreaAsset(area_type)
+    name = GetAreaName(name, area_type)
+
+    # Inline geometry from the local index saves EE from loading and filtering the asset
+    local = geometry.GetGeometry([name], area_type)
+    if local is not None:
+        return ee.Geometry(local, None, False)
 
     features = ee.FeatureCollection(path)
     areas = features.filter(ee.Filter.eq(stdt, name))
@@ -424,73 +1677,300 @@ def GetAreaGeometry(name, area_type):
 
 
 def GetMultiAreaFeatures(names, area_type):
-    """Returns an ee.Geometry for the area's with given names."""
+    """Returns an ee.FeatureCollection for the area's with given names."""
+    stdt, path = GetAreaAsset(area_type)
+    names = [GetAreaName(name, area_type) for name in names]
+
+    if all(geometry.GetEntry(name, area_type) is not None for name in names):
+        return ee.FeatureCollection([ee.Feature(ee.Geometry(geometry.GetGeometry([name], area_type), None, False),
+                                                {stdt: name}) for name in names])
+
+    features = ee.FeatureCollection(path)
+    areas = features.filter(ee.Filter.inList(stdt, names))
+    return areas
+
+
+def GetAreaNames(area_type):
+    """Returns the names of every area of the area type, from the local index or else the asset."""
+    names = geometry.GetAreaNames(area_type)
+    if not names:
+        InitializeEE()
+        stdt, path = GetAreaAsset(area_type)
+        names = CallWithBackoff(ee.FeatureCollection(path).aggregate_array(stdt).distinct().getInfo)
+    return names
+
+
+def GetAreaName(name, area_type):
+    """The country is stored as MYANMAR, the browser calls it Myanmar."""
+    return name.upper() if area_type == 'country' else name
+
+
+def GetAreaAsset(area_type):
+    """Returns the name property and EE asset path for the area type."""
     if area_type == 'regions':
-        stdt = 'ST'
-        path = REGIONS_PATH
+        return 'ST', REGIONS_PATH
     elif area_type == 'basins':
-        stdt = 'Name'
-        path = BASINS_PATH
+        return 'Name', BASINS_PATH
     elif area_type == 'country':
-        stdt = 'Name'
-        path = MYANMAR_PATH
-        names = [name.upper() for name in names]
+        return 'Name', MYANMAR_PATH
     else:
-        stdt = 'DT'
-        path = DISTRICTS_PATH
+        return 'DT', DISTRICTS_PATH
+
+
+def GetShapeFileRegion(link):
+    """Returns (ee.Geometry, bounds, area in km2) of a shapefile asset or upload.
+
+    The geometry is sent inline when it is known (see GetShapeFile), otherwise
+    EE dissolves the asset and bounds and area are None.
+    """
+    shape = GetShapeFile(link)
+    if shape is None:
+        return ee.FeatureCollection(link).geometry().dissolve(), None, None
+    return ee.Geometry(shape['geometry'], None, False), geometry.GetBoxPolygon(shape['bbox']), shape['area']
+
+
+def GetShapeFile(link):
+    """Returns the dissolved, simplified geometry of a shapefile with its bbox and area, see geometry.BuildShape.
+
+    An asset is dissolved and simplified by EE once and cached for
+    SHAPEFILE_EXPIRATION seconds. Uploads (see SFHandler) only live in the
+    cache. Returns None for an asset too large to fetch its geometry.
+    """
+    key = GetShapeFileCacheKey(link)
+    cached = cache.Get(key)
+    if cached is not None:
+        return json.loads(cached)
+    if link.startswith(SHAPEFILE_UPLOAD_PREFIX):
+        raise ee.EEException('The uploaded shapefile expired, please upload it again')
+    InitializeEE()
+    region = ee.FeatureCollection(link).geometry(SHAPEFILE_MAX_ERROR).dissolve(SHAPEFILE_MAX_ERROR)
+    try:
+        info = CallWithBackoff(region.simplify(SHAPEFILE_MAX_ERROR).getInfo)
+    except ee.EEException as ex:
+        if not IsTooLargeError(ex):
+            raise
+        logging.info('Shapefile %s too large to fetch, EE dissolves it every time', link)
+        return None
+    polygons = geometry.GetPolygons(info)
+    if not polygons:
+        raise ee.EEException('The shapefile holds no polygons')
+    shape = geometry.BuildShape(polygons)
+    cache.Set(key, json.dumps(shape), SHAPEFILE_EXPIRATION)
+    return shape
 
-    features = ee.FeatureCollection(path)
-    areas = features.filter(ee.Filter.inList(stdt, names))
-    return areas
-    # From JSON VV
-    # path = os.path.join(os.path.split(__file__)[0], path)
-    # with open(path) as f:
-    #     data = json.load(f)
-    #     areas = [ee.Feature(k) for k in data["features"]]
-    #     collection = ee.FeatureCollection(areas)
-    #     features = collection.filter(ee.Filter.inList(stdt, names))
-    #     return features.geometry().dissolve()
 
+def GetShapeFileCacheKey(link):
+    return 'shape:' + hashlib.md5(link.encode('utf-8')).hexdigest()
 
-def GetShapeFileFeature(shapefile):
-    return ee.FeatureCollection(shapefile).geometry().dissolve()
 
+def ParseDate(date):
+    """Parses the yyyy-mm-dd dates send by the browser."""
+    return datetime.datetime.strptime(date[:10], '%Y-%m-%d').date()
+
+
+def AdvanceDate(date, count, timestep):
+    """Python equivalent of ee.Date.advance for the timesteps we support."""
+    if timestep == 'day':
+        return date + datetime.timedelta(days=count)
+    months = count * 12 if timestep == 'year' else count
+    month_index = date.month - 1 + months
+    year = date.year + month_index // 12
+    month = month_index % 12 + 1
+    return datetime.date(year, month, min(date.day, calendar.monthrange(year, month)[1]))
+
+
+def GetTimeSteps(start_date, end_date, timestep):
+    """Returns the start date of every timestep the EE series contains.
+
+    Matches ee.List.sequence(0, end.difference(start, timestep).toInt()), which
+    includes every step that starts on or before the end date.
+    """
+    start = ParseDate(start_date)
+    end = ParseDate(end_date)
+    steps = []
+    step = start
+    while step <= end:
+        steps.append(step)
+        step = AdvanceDate(start, len(steps), timestep)
+    return steps
+
+
+def FormatTimeStep(step, timestep):
+    """Python equivalent of formatting a step with GetDateFormat in EE."""
+    if timestep == 'day':
+        return '{:02d}-{:02d}-{:04d}'.format(step.day, step.month, step.year)
+    if timestep == 'month':
+        return '{:02d}-{:04d}'.format(step.month, step.year)
+    return '{:04d}'.format(step.year)
+
+
+def GetDateFormat(timestep):
+    """EE date format of the labels in the graphs."""
+    return 'dd-MM-YYYY' if timestep == 'day' else 'MM-YYYY' if timestep == 'month' else 'YYYY'
+
+
+def IsCompleteTimeStep(step, timestep, product):
+    """Only timesteps that have fully passed and whose images the product published have final data."""
+    return AdvanceDate(step, 1, timestep) + datetime.timedelta(days=product['lag_days']) <= datetime.date.today()
+
+
+def GetAreaRegionKey(name, area_type):
+    return 'area:{}:{}'.format(area_type, name)
+
+
+def GetPointRegionKey(point_feature):
+    """Region key for a GeoJSON marker, based on its location instead of its title."""
+    return 'point:{}'.format(','.join(str(c) for c in point_feature['geometry']['coordinates']))
+
+
+def GetSeriesCacheKey(product, region_key, statistic, timestep, step, scale=None):
+    """Memcache key for a single timestep of a product's series over a region."""
+    key = 'series:{}:{}:{}:{}:{}'.format(product['name'], region_key, statistic, timestep, step.isoformat())
+    if scale is not None and scale != product['scale']:  # Computed coarser than usual
+        key += ':{}'.format(scale)
+    if len(key) > 250:  # Memcache key limit, shapefile links can be long
+        key = 'series:' + hashlib.md5(key).hexdigest()
+    return key
+
+
+def GetQueryCacheKey(path, params):
+    """Memcache key for a query that does not depend on parameter or target order."""
+    normalized = []
+    for param in sorted(set(params.keys()) - {'stream', 'format'}):
+        value = params.get(param)
+        if param in ('target', 'product') and not value.startswith('{'):
+            value = ','.join(sorted(value.split(',')))
+        normalized.append((param, value.encode('utf-8')))
+    return 'query:' + hashlib.md5(path + '?' + urllib.urlencode(normalized)).hexdigest()
+
+
+def GetQueryExpiration(path, params):
+    """Seconds to cache the result of a query, longer when its products published all of its range."""
+    historical, current = QUERY_EXPIRATION[path]
+    try:
+        end = ParseDate(params.get('endDate', ''))
+        lag = max(PRODUCTS[product]['lag_days'] for product in params.get('product', '').split(','))
+    except (ValueError, KeyError):
+        return current
+    return historical if end + datetime.timedelta(days=lag) < datetime.date.today().replace(day=1) else current
+
+
+def MergeSeries(chart_data, names=None):
+    """Aligns {name: [[date, value], ...]} on the dates of the series.
+
+    Returns the compact columnar form {'dates': [...], 'series': [{'name': name,
+    'values': [...]}, ...]} with one value per date for every series. Dates a
+    series does not have, and values EE returned null for, are None rather than
+    0, so products with a different temporal coverage line up.
+    """
+    names = sorted(chart_data) if names is None else names
+    ordinals = {}
+    labels = {}
+    for name in names:
+        ordinals[name] = numpy.array([ParseTimeStepLabel(label).toordinal() for label, _ in chart_data[name]],
+                                     dtype=numpy.int64)
+        labels.update(zip(ordinals[name].tolist(), (label for label, _ in chart_data[name])))
+    dates = numpy.unique(numpy.concatenate([ordinals[name] for name in names])) if names else numpy.array([])
+
+    series = []
+    for name in names:
+        column = numpy.empty(len(dates))
+        column.fill(numpy.nan)
+        values = numpy.array([numpy.nan if value is None else value for _, value in chart_data[name]], dtype=float)
+        column[numpy.searchsorted(dates, ordinals[name])] = values
+        series.append({
+            'name': name,
+            'values': [None if numpy.isnan(value) else value for value in column.tolist()]
+        })
+    return {
+        'dates': [labels[ordinal] for ordinal in dates.tolist()],
+        'series': series
+    }
 
-def OrderForGraph(details):
-    """Generates a multi-dimensional array of information to be displayed in the Graphs"""
-    # Create first row of columns
-    print("Creating the graph data::")
-    first_row = ['Date']
-    for i in details:
-        first_row.append(i)
-
-    # Build array of months (Assumes Month (mm-yyyy) to be first, and have the value as second element per row
-    first = details[details.keys()[0]]
-    months = [first[i][0] for i in range(len(first))]
-    print(months)
-
-    rows = [len(first)]
-    rows[0] = first_row
-
-    # Create rows and add to main array
-    for index in range(len(months)):
-        row = [months[index]]
-        for i in details:
-            value = details[i][index][1]
-            row.append(0.0 if value is None else value)
-        rows.append(row)
-
-    print(rows)
 
+def GetChartRows(details):
+    """Generates a multi-dimensional array of information to be displayed in the Graphs"""
+    rows = [['Date'] + [series['name'] for series in details['series']]]
+    rows.extend([date] + list(values)
+                for date, values in zip(details['dates'], zip(*[series['values'] for series in details['series']])))
     return rows
 
 
+def FormatGraphJSON(json_data, output_format):
+    """Cached graphs are compact columns, the browser gets rows unless it asks for format=columns."""
+    if output_format == 'columns':
+        return json_data
+    with metrics.Span('json'):
+        details = json.loads(json_data)
+        if 'series' not in details:
+            return json_data
+        details['chart_data'] = GetChartRows(details)
+        del details['dates']
+        del details['series']
+        return json.dumps(details)
+
+
+def ParseTimeStepLabel(label):
+    """Parses the dd-MM-YYYY, MM-YYYY and YYYY labels of the graphs."""
+    parts = [int(part) for part in label.split('-')]
+    parts.reverse()
+    return datetime.date(parts[0], parts[1] if len(parts) > 1 else 1, parts[2] if len(parts) > 2 else 1)
+
+
+def GetImageCount(product, steps, timestep):
+    """Number of product images the timesteps cover."""
+    if not steps:
+        return 0
+    days = (AdvanceDate(steps[-1], 1, timestep) - steps[0]).days
+    return days * product['images_per_day']
+
+
+def GetReduceSettings(product, area, image_count):
+    """Returns the reduceRegion scale, tileScale and bestEffort settings for a query.
+
+    The cost of a query is estimated as the number of pixels of the region
+    times the number of images it covers. The finest scale on the product's
+    ladder whose cost fits COST_BUDGET is used, so small areas keep their full
+    resolution while country wide daily queries get coarser. Without an area
+    (shapefiles) the product's scale is used.
+    """
+    if area is None:
+        return {'scale': product['scale']}
+    for factor in SCALE_LADDER:
+        scale = product['scale'] * factor
+        pixels = area * 1e6 / (scale * scale)
+        if pixels * image_count <= COST_BUDGET:
+            break
+    settings = {
+        'scale': scale,
+        'maxPixels': MAX_PIXELS,
+        # Smaller tiles use less memory per tile, at the price of more of them
+        'tileScale': 4 if pixels > TILE_SCALE_PIXELS else 1
+    }
+    if pixels * image_count > COST_BUDGET:  # Even the coarsest scale is too expensive, let EE decide
+        settings['bestEffort'] = True
+    return settings
+
+
+def IsTransientError(e):
+    """Errors that may pass when the same request is tried again a bit later."""
+    if isinstance(e, HTTPException):
+        return True
+    message = (e.args[0] if e.args else '').lower()
+    return any(error in message for error in ('too many', 'rate limit', 'internal error', 'unavailable',
+                                              'backend error', 'connection'))
+
+
+def IsTooLargeError(e):
+    """Errors that can be avoided by asking EE for less work at once."""
+    message = e.args[0] if e.args else ''
+    return 'Deadline' in message or 'timed out' in message or 'memory limit' in message
+
+
 def ErrorHandling(e):
-    print('Error getting graph data ERROR CAUGHT')
-    print('type', type(e).__name__)
-    print('ex args', e.args)
-    print('Info', sys.exc_info())
-    return 'Area too large, timeout deadline exceeded' if 'Deadline' in e.args[0] else str(e)
+    logging.error('Error getting EE data, %s: %s', type(e).__name__, e.args, exc_info=sys.exc_info()[0] is not None)
+    metrics.Count('errors.' + type(e).__name__)
+    return 'Area too large, timeout deadline exceeded' if 'Deadline' in str(e) else str(e)
 
 
 ###############################################################################
@@ -498,10 +1978,96 @@ def ErrorHandling(e):
 ###############################################################################
 
 
-# Memcache is used to avoid exceeding our EE quota. Entries in the cache expire
-# 24 hours after they are added. See:
+# Query results are cached (see cache.py) to avoid exceeding our EE quota, for
+# QUERY_EXPIRATION[path] = (historical, current) seconds. Ranges that ended
+# before the current month, and that the products published (see lag_days in
+# PRODUCTS), no longer change, other ranges get new images every day.
+# Complete timesteps of a series never change and are kept SERIES_EXPIRATION
+# seconds, or until memcache evicts them. See:
 # https://cloud.google.com/appengine/docs/python/memcache/
-MEMCACHE_EXPIRATION = 60 * 60 * 24
+QUERY_EXPIRATION = {
+    '/graph': (60 * 60 * 24 * 30, 60 * 60 * 6),
+    '/overlay': (60 * 60 * 24 * 30, 60 * 60 * 6),
+}
+SERIES_EXPIRATION = 60 * 60 * 24 * 30
+
+# Overlays hold an EE map token, which is valid for about EE_TOKEN_LIFETIME
+# seconds. They are cached that long, with the OVERLAY_STATS cached separately
+# for QUERY_EXPIRATION['/overlay']. An overlay whose token expires within
+# EE_TOKEN_REFRESH seconds gets a new token in the background.
+EE_TOKEN_LIFETIME = getattr(config, 'EE_TOKEN_LIFETIME', 60 * 60 * 3)
+EE_TOKEN_REFRESH = 60 * 60
+OVERLAY_STATS = ('min', 'max', 'scale', 'download_url')
+
+# Independent EE calls run concurrently, but never more than EE_MAX_CONCURRENCY
+# at a time per instance so we stay within the account's QPS. All calls of a
+# request have to finish within EE_REQUEST_DEADLINE seconds (App Engine kills
+# requests after 60 seconds).
+EE_MAX_CONCURRENCY = getattr(config, 'EE_MAX_CONCURRENCY', 4)
+EE_REQUEST_DEADLINE = getattr(config, 'EE_REQUEST_DEADLINE', 55)
+EE_CALL_SEMAPHORE = threading.BoundedSemaphore(EE_MAX_CONCURRENCY)
+
+# Shapefile assets are dissolved and simplified by EE to SHAPEFILE_MAX_ERROR
+# meters once and cached for SHAPEFILE_EXPIRATION seconds, they can be
+# replaced by their owner. Uploaded shapefiles of up to SHAPEFILE_MAX_BYTES get
+# an id starting with SHAPEFILE_UPLOAD_PREFIX and are kept in the cache for
+# SHAPEFILE_UPLOAD_EXPIRATION seconds.
+SHAPEFILE_MAX_ERROR = 100
+SHAPEFILE_EXPIRATION = 60 * 60 * 24
+SHAPEFILE_MAX_BYTES = 10 * 2 ** 20
+SHAPEFILE_UPLOAD_PREFIX = 'upload:'
+SHAPEFILE_UPLOAD_EXPIRATION = 60 * 60 * 24 * 30
+
+# A /batch request holds at most BATCH_MAX_QUERIES queries
+BATCH_MAX_QUERIES = 50
+
+# Identical queries that arrive while one is being computed wait for it, for
+# at most INFLIGHT_WAIT seconds, other instances check memcache for the result
+# every INFLIGHT_POLL seconds. A query whose request has less than
+# INFLIGHT_MIN_COMPUTE seconds left is not computed after waiting, it would
+# run into the deadline.
+INFLIGHT_WAIT = 45
+INFLIGHT_MIN_COMPUTE = 30
+INFLIGHT_POLL = 0.5
+INFLIGHT = {}
+INFLIGHT_LOCK = threading.Lock()
+
+# Transient EE errors are retried MAX_RETRIES times, waiting about BACKOFF_BASE
+# seconds and doubling every retry. Work that does not fit the deadline is
+# split into smaller time ranges, and regions into quarters at most
+# MAX_SPLIT_DEPTH times. The time range sizes that fit are remembered per
+# product and region for CHUNK_SIZE_EXPIRATION seconds.
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+MAX_SPLIT_DEPTH = 2
+CHUNK_SIZE_EXPIRATION = 60 * 60 * 24 * 7
+CHUNK_SIZES = {}
+
+# The scale of a reduction is picked from the product's scale times one of
+# SCALE_LADDER, the finest one whose estimated cost (pixels * images) stays
+# below COST_BUDGET. Reductions over more than TILE_SCALE_PIXELS pixels use
+# smaller tiles to avoid running out of memory.
+SCALE_LADDER = (1, 2, 4, 8, 16, 32)
+COST_BUDGET = getattr(config, 'EE_COST_BUDGET', 5e8)
+MAX_PIXELS = 1e10
+TILE_SCALE_PIXELS = 1e6
+
+# /_ah/warmup loads the cached results of the WARMUP_QUERIES most popular
+# queries into the instance's LRU, for at most WARMUP_DEADLINE seconds (the
+# warmup request has 60). Popularity is counted for HOT_QUERY_SAMPLE_RATE of
+# the requests, over the HOT_QUERIES_SIZE most popular queries, as hits per
+# query cache key.
+WARMUP_QUERIES = 10
+WARMUP_DEADLINE = 30
+HOT_QUERY_SAMPLE_RATE = 0.1
+HOT_QUERIES_SIZE = 50
+HOT_QUERIES_KEY = 'hot:keys'
+HOT_QUERIES_EXPIRATION = 60 * 60 * 24 * 7
+
+# Boundary layers are cached by browsers for BOUNDARIES_MAX_AGE seconds when
+# the URL holds the version of the layers, BOUNDARIES_REVALIDATE_AGE otherwise.
+BOUNDARIES_MAX_AGE = 60 * 60 * 24 * 365
+BOUNDARIES_REVALIDATE_AGE = 60 * 60
 
 DISTRICTS_PATH = 'users/joepkt/myanmar_district_boundaries'
 REGIONS_PATH = 'users/joepkt/myanmar_state_region_boundaries'
@@ -514,6 +2080,14 @@ app = webapp2.WSGIApplication([
     ('/graph', GraphHandler),
     ('/test', TestHandler),
     ('/shapefile', SFHandler),
+    ('/metrics', MetricsHandler),
+    ('/batch', BatchHandler),
+    ('/export', ExportHandler),
+    (r'/export/(\d+)', ExportHandler),
+    (r'/export/(\d+)/download', ExportDownloadHandler),
+    (r'/export/(\d+)/resume', ExportResumeHandler),
+    (r'/boundaries/(\w+)/(\d+)', BoundariesHandler),
+    ('/_ah/warmup', WarmupHandler),
     ('/', MainHandler),
 ])
 
@@ -522,10 +2096,6 @@ app = webapp2.WSGIApplication([
 ###############################################################################
 
 
-# Use our App Engine service account's credentials.
-EE_CREDENTIALS = ee.ServiceAccountCredentials(
-    config.EE_ACCOUNT, config.EE_PRIVATE_KEY_FILE)
-
 # Create the Jinja templating system we use to dynamically generate HTML. See:
 # http://jinja.pocoo.org/docs/dev/
 JINJA2_ENVIRONMENT = jinja2.Environment(
@@ -533,51 +2103,94 @@ JINJA2_ENVIRONMENT = jinja2.Environment(
     autoescape=True,
     extensions=['jinja2.ext.autoescape'])
 
-# Initialize the EE API.
-ee.Initialize(EE_CREDENTIALS)
 urlfetch.set_default_fetch_deadline(500)
 
+# EE is initialized on first use instead of on import, so a new instance can
+# serve static and cached responses without waiting for the EE handshake.
+EE_INITIALIZED = threading.Event()
+EE_INIT_LOCK = threading.Lock()
+
+
+def InitializeEE():
+    """Initializes the EE API with our App Engine service account's credentials, once per instance."""
+    if EE_INITIALIZED.is_set():
+        return
+    with EE_INIT_LOCK:
+        if EE_INITIALIZED.is_set():
+            return
+        with metrics.Span('ee.initialize'):
+            credentials = ee.ServiceAccountCredentials(config.EE_ACCOUNT, config.EE_PRIVATE_KEY_FILE)
+            ee.Initialize(credentials)
+        EE_INITIALIZED.set()
+
 
 ###############################################################################
 #                               Building the ImageCollections.                #
 ###############################################################################
 # COUNTRIES = ee.FeatureCollection('ft:1tdSwUL7MVpOauSgRzqVTOwdfy17KDbw-1d9omPw')
 
-
-def Multiply(i, value):
-    return i.multiply(value).copyProperties(i, ['system:time_start'])
-
-
-TRMM = ee.ImageCollection('TRMM/3B42').select('precipitation')
-PERSIANN = ee.ImageCollection('NOAA/PERSIANN-CDR')
-CHIRPS = ee.ImageCollection('UCSB-CHG/CHIRPS/DAILY')
-CFSV2 = ee.ImageCollection('NOAA/CFSV2/FOR6H').select('Precipitation_rate_surface_6_Hour_Average')
-GLDAS = ee.ImageCollection('NASA/GLDAS/V021/NOAH/G025/T3H').select('Rainf_tavg')
-
+# Products publish their images up to lag_days after the day they cover,
+# timesteps are only final (see IsCompleteTimeStep) once that has passed.
 PRODUCTS = {
     'CHIRPS': {
-        'collection': CHIRPS,
+        'name': 'CHIRPS',
+        'asset': 'UCSB-CHG/CHIRPS/DAILY',
+        'band': None,
         'scale': 1000,
-        'multiply': 1
+        'multiply': 1,
+        'images_per_day': 1,
+        'lag_days': 30
     },
     'PERSIANN': {
-        'collection': PERSIANN,
+        'name': 'PERSIANN',
+        'asset': 'NOAA/PERSIANN-CDR',
+        'band': None,
         'scale': 5000,
-        'multiply': 1
+        'multiply': 1,
+        'images_per_day': 1,
+        'lag_days': 90
     },
     'TRMM': {
-        'collection': TRMM,
+        'name': 'TRMM',
+        'asset': 'TRMM/3B42',
+        'band': 'precipitation',
         'scale': 30000,
-        'multiply': 3
+        'multiply': 3,
+        'images_per_day': 8,
+        'lag_days': 60
     },
     'CFSV2': {
-        'collection': CFSV2,
+        'name': 'CFSV2',
+        'asset': 'NOAA/CFSV2/FOR6H',
+        'band': 'Precipitation_rate_surface_6_Hour_Average',
         'scale': 30000,
-        'multiply': 60 * 60 * 6
+        'multiply': 60 * 60 * 6,
+        'images_per_day': 4,
+        'lag_days': 2
     },
     'GLDAS': {
-        'collection': GLDAS,
+        'name': 'GLDAS',
+        'asset': 'NASA/GLDAS/V021/NOAH/G025/T3H',
+        'band': 'Rainf_tavg',
         'scale': 30000,
-        'multiply': 60 * 60 * 3
+        'multiply': 60 * 60 * 3,
+        'images_per_day': 8,
+        'lag_days': 45
     }
 }
+
+
+def GetCollection(product):
+    """Returns the ee.ImageCollection of a product, created on first use."""
+    name = product['name']
+    if name not in COLLECTIONS:
+        InitializeEE()
+        collection = ee.ImageCollection(product['asset'])
+        if product['band'] is not None:
+            collection = collection.select(product['band'])
+        with EE_INIT_LOCK:
+            COLLECTIONS.setdefault(name, collection)
+    return COLLECTIONS[name]
+
+
+COLLECTIONS = {}
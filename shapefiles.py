@@ -0,0 +1,228 @@
+"""Reads uploaded ESRI shapefiles into GeoJSON polygons, without EE.
+
+A shapefile is a set of files with the same name: .shp holds the shapes,
+.dbf their attributes and .prj the coordinate system. They are uploaded as
+separate files or as one .zip. Only polygon shapefiles are supported, in
+longitude/latitude or a Transverse Mercator projection (UTM) on WGS 84,
+which is converted to longitude/latitude. See
+https://www.esri.com/library/whitepapers/pdfs/shapefile.pdf
+"""
+
+import math
+import os
+import re
+import struct
+import StringIO
+import zipfile
+
+# Shape types of Polygon, PolygonZ and PolygonM, the Z and M values are ignored
+POLYGON_TYPES = (5, 15, 25)
+NULL_TYPE = 0
+
+# WGS 84 ellipsoid
+SEMI_MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+
+
+def ReadFiles(files):
+    """Returns (polygons, records) of a shapefile, given {filename: contents} of its parts.
+
+    polygons are the GeoJSON polygons of all shapes, records the attributes of
+    every shape from the .dbf (empty without one). The parts can be the files
+    themselves or a .zip holding them. Raises ValueError when the shapefile is
+    incomplete or not supported.
+    """
+    parts = {}
+    for filename, data in files.items():
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.zip':
+            parts.update(ReadZip(data))
+        else:
+            parts[extension] = data
+    if '.shp' not in parts:
+        raise ValueError('A shapefile needs at least its .shp file')
+    transform = ReadProjection(parts.get('.prj'))
+    polygons = []
+    for rings in ReadShapes(parts['.shp']):
+        polygons.extend(GroupRings([[transform(x, y) for x, y in ring] for ring in rings]))
+    if not polygons:
+        raise ValueError('The shapefile holds no polygons')
+    if transform is _LongitudeLatitude and not all(-180 <= x <= 180 and -90 <= y <= 90 for polygon in polygons
+                                                  for ring in polygon for x, y in ring):
+        raise ValueError('Coordinates are not in degrees, the .prj file is missing')
+    return polygons, ReadRecords(parts['.dbf']) if '.dbf' in parts else []
+
+
+def ReadZip(data):
+    """Returns {extension: contents} of the first shapefile in a .zip."""
+    try:
+        archive = zipfile.ZipFile(StringIO.StringIO(data))
+        names = archive.namelist()
+    except zipfile.BadZipfile:
+        raise ValueError('Not a valid .zip file')
+    shp = next((name for name in names if name.lower().endswith('.shp')), None)
+    if shp is None:
+        return {}
+    base = os.path.splitext(shp)[0]
+    return {os.path.splitext(name)[1].lower(): archive.read(name) for name in names
+            if os.path.splitext(name)[0] == base}
+
+
+def ReadShapes(data):
+    """Yields the rings of every polygon record of a .shp file, as lists of (x, y)."""
+    if len(data) < 100 or struct.unpack('>i', data[:4])[0] != 9994:
+        raise ValueError('Not a valid .shp file')
+    shape_type = struct.unpack('<i', data[32:36])[0]
+    if shape_type not in POLYGON_TYPES:
+        raise ValueError('Only polygon shapefiles are supported')
+    offset = 100
+    while offset + 8 <= len(data):
+        length = struct.unpack('>i', data[offset + 4:offset + 8])[0] * 2  # In 16 bit words
+        record = data[offset + 8:offset + 8 + length]
+        offset += 8 + length
+        if len(record) < 4 or struct.unpack('<i', record[:4])[0] == NULL_TYPE:
+            continue
+        part_count, point_count = struct.unpack('<2i', record[36:44])
+        parts = struct.unpack('<{}i'.format(part_count), record[44:44 + 4 * part_count])
+        start = 44 + 4 * part_count
+        coordinates = struct.unpack('<{}d'.format(2 * point_count), record[start:start + 16 * point_count])
+        points = zip(coordinates[::2], coordinates[1::2])
+        yield [points[first:last] for first, last in zip(parts, parts[1:] + (point_count,))]
+
+
+def ReadRecords(data):
+    """Returns the attributes of every shape in a .dbf file, as a list of dicts."""
+    record_count, header_length, record_length = struct.unpack('<I2H', data[4:12])
+    fields = []
+    for offset in range(32, header_length - 1, 32):
+        name, field_type, size = struct.unpack('<11sc4xB', data[offset:offset + 17])
+        fields.append((name.split('\0')[0], field_type, size))
+    records = []
+    for index in range(record_count):
+        offset = header_length + index * record_length
+        if data[offset:offset + 1] == '*':  # Deleted
+            continue
+        position = offset + 1
+        record = {}
+        for name, field_type, size in fields:
+            value = data[position:position + size].strip()
+            position += size
+            if field_type in 'NF' and value:
+                try:
+                    value = float(value) if '.' in value else int(value)
+                except ValueError:
+                    pass
+            record[name] = value.decode('latin-1') if isinstance(value, str) else value
+        records.append(record)
+    return records
+
+
+def GroupRings(rings):
+    """Groups the rings of a shape into GeoJSON polygons.
+
+    Outer rings are clockwise and holes counter-clockwise, a hole belongs to
+    the outer ring that contains it.
+    """
+    polygons = []
+    holes = []
+    for ring in rings:
+        if len(ring) < 4:
+            continue
+        ring = [list(point) for point in ring]
+        if _SignedArea(ring) < 0:
+            polygons.append([ring])
+        else:
+            holes.append(ring)
+    if not polygons:  # Wound the wrong way, take them as outer rings
+        return [[hole] for hole in holes]
+    for hole in holes:
+        outer = next((polygon for polygon in polygons if _Contains(polygon[0], hole[0])), polygons[-1])
+        outer.append(hole)
+    return polygons
+
+
+###############################################################################
+#                                 Projections.                                #
+###############################################################################
+
+
+def ReadProjection(prj):
+    """Returns a function (x, y) -> [longitude, latitude] for the WKT coordinate system of a .prj file.
+
+    Without a .prj the coordinates are taken as longitude/latitude.
+    """
+    if not prj:
+        return _LongitudeLatitude
+    wkt = prj.strip()
+    if 'WGS' not in wkt.upper().replace(' ', '_') or '84' not in wkt:
+        raise ValueError('Only coordinate systems on WGS 84 are supported')
+    if wkt.upper().startswith('GEOGCS'):
+        return _LongitudeLatitude
+    projection = re.search(r'PROJECTION\["([^"]+)"', wkt)
+    if not projection or projection.group(1).lower() != 'transverse_mercator':
+        raise ValueError('Only longitude/latitude and UTM shapefiles are supported')
+    parameters = {name.lower(): float(value) for name, value in
+                  re.findall(r'PARAMETER\["([^"]+)",\s*([-+\d.eE]+)\]', wkt)}
+    unit = re.findall(r'UNIT\["[^"]+",\s*([-+\d.eE]+)', wkt)
+    if unit and abs(float(unit[-1]) - 1) > 1e-9:
+        raise ValueError('Only projections in meters are supported')
+    return TransverseMercator(parameters.get('central_meridian', 0.0), parameters.get('latitude_of_origin', 0.0),
+                              parameters.get('scale_factor', 1.0), parameters.get('false_easting', 0.0),
+                              parameters.get('false_northing', 0.0))
+
+
+def _LongitudeLatitude(x, y):
+    return [x, y]
+
+
+def TransverseMercator(central_meridian, latitude_of_origin, scale_factor, false_easting, false_northing):
+    """Inverse Transverse Mercator on WGS 84, Snyder's series (Map Projections, USGS 1987, page 63)."""
+    a = SEMI_MAJOR_AXIS
+    e2 = FLATTENING * (2 - FLATTENING)
+    ep2 = e2 / (1 - e2)
+    e1 = (1 - math.sqrt(1 - e2)) / (1 + math.sqrt(1 - e2))
+    meridian_factor = a * (1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256)
+    lon0 = math.radians(central_meridian)
+    m0 = _MeridianDistance(math.radians(latitude_of_origin), a, e2)
+
+    def Transform(x, y):
+        mu = (m0 + (y - false_northing) / scale_factor) / meridian_factor
+        phi1 = (mu + (3 * e1 / 2 - 27 * e1 ** 3 / 32) * math.sin(2 * mu) +
+                (21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32) * math.sin(4 * mu) +
+                (151 * e1 ** 3 / 96) * math.sin(6 * mu) + (1097 * e1 ** 4 / 512) * math.sin(8 * mu))
+        sin1, cos1, tan1 = math.sin(phi1), math.cos(phi1), math.tan(phi1)
+        c1 = ep2 * cos1 ** 2
+        t1 = tan1 ** 2
+        n1 = a / math.sqrt(1 - e2 * sin1 ** 2)
+        r1 = a * (1 - e2) / (1 - e2 * sin1 ** 2) ** 1.5
+        d = (x - false_easting) / (n1 * scale_factor)
+        latitude = phi1 - (n1 * tan1 / r1) * (
+            d ** 2 / 2 - (5 + 3 * t1 + 10 * c1 - 4 * c1 ** 2 - 9 * ep2) * d ** 4 / 24 +
+            (61 + 90 * t1 + 298 * c1 + 45 * t1 ** 2 - 252 * ep2 - 3 * c1 ** 2) * d ** 6 / 720)
+        longitude = lon0 + (d - (1 + 2 * t1 + c1) * d ** 3 / 6 +
+                            (5 - 2 * c1 + 28 * t1 - 3 * c1 ** 2 + 8 * ep2 + 24 * t1 ** 2) * d ** 5 / 120) / cos1
+        return [math.degrees(longitude), math.degrees(latitude)]
+
+    return Transform
+
+
+def _MeridianDistance(phi, a, e2):
+    return a * ((1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256) * phi -
+                (3 * e2 / 8 + 3 * e2 ** 2 / 32 + 45 * e2 ** 3 / 1024) * math.sin(2 * phi) +
+                (15 * e2 ** 2 / 256 + 45 * e2 ** 3 / 1024) * math.sin(4 * phi) -
+                (35 * e2 ** 3 / 3072) * math.sin(6 * phi))
+
+
+def _SignedArea(ring):
+    """Shoelace area, positive for counter-clockwise rings."""
+    return sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:])) / 2
+
+
+def _Contains(ring, point):
+    """Even-odd test of a point against a ring."""
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
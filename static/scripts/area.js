@@ -2,25 +2,25 @@ area = {};
 
 $(function () {
 
-    //Get GeoJSON for all countries
+    //Get the names of all areas from their coarsest boundaries
     area.regions = [];
     area.districts = [];
     area.basins = [];
-    $.getJSON('static/polygons/myanmar_state_region_boundaries.json', function (json) {
-        json.features.forEach(function (feature) {
-            area.regions.push(feature.properties.ST);
+    $.getJSON(area.getLayerUrl('regions', area.ZOOM_LEVELS[0]), function (topology) {
+        topology.objects.regions.geometries.forEach(function (geometry) {
+            area.regions.push(geometry.properties.ST);
         });
     });
 
-    $.getJSON('static/polygons/myanmar_district_boundaries.json', function (json) {
-        json.features.forEach(function (feature) {
-            area.districts.push(feature.properties.DT);
+    $.getJSON(area.getLayerUrl('districts', area.ZOOM_LEVELS[0]), function (topology) {
+        topology.objects.districts.geometries.forEach(function (geometry) {
+            area.districts.push(geometry.properties.DT);
         });
     });
 
-    $.getJSON('static/polygons/myanmar_basins_boundaries.json', function (json) {
-        json.features.forEach(function (feature) {
-            area.basins.push(feature.properties.Name);
+    $.getJSON(area.getLayerUrl('basins', area.ZOOM_LEVELS[0]), function (topology) {
+        topology.objects.basins.geometries.forEach(function (geometry) {
+            area.basins.push(geometry.properties.Name);
         });
     });
 
@@ -63,11 +63,9 @@ area.loadFeatures = function (type, callback) {
     //Set auto complete
     switch (type) {
         case 'country':
-            myanmar.instance.map.data.loadGeoJson('static/polygons/myanmar_country_boundaries.json');
             areaField.prop('disabled', true);
             break;
         case 'districts':
-            myanmar.instance.map.data.loadGeoJson('static/polygons/myanmar_district_boundaries.json');
             areaField.prop('disabled', false);
             areaField.autocomplete({
                 source: area.districts,
@@ -75,7 +73,6 @@ area.loadFeatures = function (type, callback) {
             });
             break;
         case 'regions':
-            myanmar.instance.map.data.loadGeoJson('static/polygons/myanmar_state_region_boundaries.json');
             areaField.prop('disabled', false);
             areaField.autocomplete({
                 source: area.regions,
@@ -83,7 +80,6 @@ area.loadFeatures = function (type, callback) {
             });
             break;
         case 'basins':
-            myanmar.instance.map.data.loadGeoJson('static/polygons/myanmar_basins_boundaries.json');
             areaField.prop('disabled', false);
             areaField.autocomplete({
                 source: area.basins,
@@ -92,14 +88,117 @@ area.loadFeatures = function (type, callback) {
             break;
     }
     //Set all to unselected style
-    myanmar.instance.map.data.setStyle(function (feature) {
+    myanmar.instance.map.data.setStyle(myanmar.App.UNSELECTED_STYLE);
+
+    //Load finer boundaries when zooming in
+    if (!area.zoomListener) {
+        area.zoomListener = myanmar.instance.map.addListener('idle', area.handleZoom);
+    }
+    area.loadLayer(type, area.getLevel(), callback);
+};
+
+/**
+ * Adds the boundaries of the area type at the zoom level to the map
+ * @param type
+ * @param level
+ * @param callback called once they are added
+ */
+area.loadLayer = function (type, level, callback) {
+    area.type = type;
+    area.level = level;
+    $.getJSON(area.getLayerUrl(type, level), function (topology) {
+        //Another layer was asked for in the meantime
+        if (area.type !== type || area.level !== level) {
+            return;
+        }
+        myanmar.instance.map.data.addGeoJson(area.toGeoJson(topology));
         if (callback != null) {
             callback();
         }
-        return myanmar.App.UNSELECTED_STYLE;
     });
+};
+
+/**
+ * Replaces the boundaries by those of the current zoom level, keeping the selected areas
+ */
+area.handleZoom = function () {
+    const level = area.getLevel();
+    if (area.type == null || level === area.level) {
+        return;
+    }
+    const selected = area.getSelectedAreas();
+    const previous = [];
+    myanmar.instance.map.data.forEach(function (feature) {
+        previous.push(feature);
+    });
+    area.loadLayer(area.type, level, function () {
+        previous.forEach(function (feature) {
+            myanmar.instance.map.data.remove(feature);
+        });
+        selected.forEach(function (name) {
+            area.activate(area.getAreaFeature(name));
+        });
+    });
+};
+
+/**
+ * Returns the boundary level for the zoom of the map, the first one at or above it
+ */
+area.getLevel = function () {
+    const zoom = myanmar.instance.map.getZoom();
+    for (let i = 0; i < area.ZOOM_LEVELS.length; i++) {
+        if (area.ZOOM_LEVELS[i] >= zoom) {
+            return area.ZOOM_LEVELS[i];
+        }
+    }
+    return area.ZOOM_LEVELS[area.ZOOM_LEVELS.length - 1];
+};
 
+area.getLayerUrl = function (type, level) {
+    return '/boundaries/' + type + '/' + level + '?v=' + area.version;
+};
 
+/**
+ * Converts a TopoJSON topology (see topology.py) to a GeoJSON FeatureCollection
+ * @param topology
+ * @returns {{type: string, features: Array}}
+ */
+area.toGeoJson = function (topology) {
+    const scale = topology.transform.scale;
+    const translate = topology.transform.translate;
+    //Arcs are delta encoded, quantized coordinates
+    const arcs = topology.arcs.map(function (arc) {
+        let x = 0, y = 0;
+        return arc.map(function (point) {
+            x += point[0];
+            y += point[1];
+            return [x * scale[0] + translate[0], y * scale[1] + translate[1]];
+        });
+    });
+    const toRing = function (indexes) {
+        let ring = [];
+        indexes.forEach(function (index) {
+            const arc = index >= 0 ? arcs[index] : arcs[~index].slice().reverse();
+            ring = ring.concat(ring.length ? arc.slice(1) : arc);
+        });
+        return ring;
+    };
+    const name = Object.keys(topology.objects)[0];
+    return {
+        type: 'FeatureCollection',
+        features: topology.objects[name].geometries.map(function (geometry) {
+            return {
+                type: 'Feature',
+                properties: geometry.properties,
+                geometry: {
+                    type: 'MultiPolygon',
+                    coordinates: geometry.arcs.map(function (polygon) {
+                        return polygon.map(toRing);
+                    })
+                }
+            };
+        })
+    };
 };
 
 /**
@@ -137,12 +236,7 @@ area.add = function (feature) {
 
     const title = area.getName(feature);
 
-
-    //Draw on map
-    myanmar.instance.map.data.overrideStyle(feature, myanmar.App.SELECTED_STYLE);
-
-    //Set to active
-    feature.setProperty('active', 'true');
+    area.activate(feature);
 
     //Add to table
     var tableContent = '<tr><td class="area-name">' + title + '</td><td><button class="btn btn-danger remove-area">Remove</button></td></tr>';
@@ -151,6 +245,15 @@ area.add = function (feature) {
 };
 
 
+/**
+ * Draws the feature as selected and marks it active
+ */
+area.activate = function (feature) {
+    myanmar.instance.map.data.overrideStyle(feature, myanmar.App.SELECTED_STYLE);
+    feature.setProperty('active', 'true');
+};
+
+
 /**
  * Returns name of feature using the current selected filtering type
  * @param feature
@@ -195,3 +298,6 @@ area.getSelectedAreas = function () {
     });
     return names;
 };
+
+//Zoom levels with boundaries, see topology.ZOOM_LEVELS
+area.ZOOM_LEVELS = [5, 7, 9, 11];
@@ -4,8 +4,12 @@ function bs_input_file() {
             if (!$(this).prev().hasClass('input-ghost')) {
                 var element = $("<input type='file' class='input-ghost' style='display:none; height:0; width:0;'>");
                 element.attr("name", $(this).attr("name"));
+                element.attr("multiple", $(this).attr("multiple"));
+                element.attr("accept", $(this).attr("accept"));
                 element.change(function () {
-                    element.next(element).find('input').val((element.val()).split('\\').pop());
+                    element.next(element).find('input').val($.map(element[0].files, function (file) {
+                        return file.name;
+                    }).join(', '));
                 });
                 $(this).find("button.btn-choose").click(function () {
                     element.click();
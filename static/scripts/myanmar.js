@@ -1,6 +1,7 @@
 myanmar = {};
 
-myanmar.boot = function (key) {
+myanmar.boot = function (key, boundariesVersion) {
+    area.version = boundariesVersion;
     // Load external libraries.
     //google.load('visualization', '1', {packages: ["corechart"]});
     google.load('maps', '3', {'other_params': 'key=' + key + '&libraries=drawing'});
@@ -42,6 +43,9 @@ myanmar.App = function () {
     //Validates the shape file link
     $('.check-shapefile').on('click', this.validateShapefile.bind(this));
 
+    //Uploads a local shape file
+    $('.input-ghost').on('change', this.uploadShapefile.bind(this));
+
     //Add functionality to buttons
     $('#overlay-button').on('click', function (event) {
         myanmar.instance.createOverlay();
@@ -99,8 +103,9 @@ myanmar.App.prototype.createMap = function () {
 
 /**
  * Adds Rainfall Overlay to map using currently set Dates and targetRegion
+ * @param attempt number of times the server was busy before, see retryWhenBusy
  */
-myanmar.App.prototype.createOverlay = function () {
+myanmar.App.prototype.createOverlay = function (attempt) {
     const startDate = $('#startDate').val();
     const endDate = $('#endDate').val();
     const button = $('#overlay-button');
@@ -125,6 +130,11 @@ myanmar.App.prototype.createOverlay = function () {
             myanmar.instance.clearOverlays();
         },
         error: function (data) {
+            if (myanmar.App.retryWhenBusy(data, attempt, error, function (next) {
+                myanmar.instance.createOverlay(next);
+            })) {
+                return;
+            }
             button.html('error');
             error.show().html('Error obtaining data!');
         }
@@ -152,8 +162,9 @@ myanmar.App.prototype.createOverlay = function () {
 
 /**
  * Get Graph data for targetRegion
+ * @param attempt number of times the server was busy before, see retryWhenBusy
  */
-myanmar.App.prototype.createGraph = function () {
+myanmar.App.prototype.createGraph = function (attempt) {
     const startDate = $('#startDate').val();
     const endDate = $('#endDate').val();
     const button = $('#graph-button');
@@ -167,32 +178,146 @@ myanmar.App.prototype.createGraph = function () {
     if (!this.checkSelections(product, statistic, timestep)) {
         return;
     }
-    $.ajax({
-        url: '/graph?startDate=' + startDate + '&endDate=' + endDate + '&method=' + this.selectionMethod
-            + '&product=' + product + '&statistic=' + statistic + '&target=' + target + '&areaType=' + areaType + '&timestep=' + timestep,
-        method: 'GET',
-        beforeSend: function () {
-            buttons.disableDownload();
-            buttons.setDownloadButton('graph');
-            error.hide();
-            button.html('Loading Graph...');
-        }, error: function (data) {
-            button.html('error');
-            error.show().html(data['error']);
+    const url = '/graph?startDate=' + startDate + '&endDate=' + endDate + '&method=' + this.selectionMethod
+        + '&product=' + product + '&statistic=' + statistic + '&target=' + target + '&areaType=' + areaType
+        + '&timestep=' + timestep + '&stream=ndjson';
+    buttons.disableDownload();
+    buttons.setDownloadButton('graph');
+    error.hide();
+    button.html('Loading Graph...');
+
+    //Draw every series as soon as it arrives
+    const series = {};
+    let columns = [];
+    myanmar.App.streamRecords(url, (function (record) {
+        switch (record['type']) {
+            case 'header':
+                this.chartTitle = record['title'];
+                columns = record['columns'];
+                break;
+            case 'series':
+                series[record['name']] = record['data'];
+                this.chartData = myanmar.App.mergeSeries(columns, series);
+                this.showChart();
+                break;
+            case 'end':
+                button.html(myanmar.App.GRAPH_BASE_BUTTON_NAME);
+                const failed = Object.keys(record['errors']).map(function (name) {
+                    return name + ': ' + record['errors'][name];
+                });
+                if (record['error']) {
+                    failed.unshift(record['error']);
+                }
+                if (failed.length > 0) {
+                    error.show().html(failed.join('<br>'));
+                }
+                if (Object.keys(series).length > 0) {
+                    buttons.activateDownload();
+                }
+                break;
         }
-    }).done((function (data) {
-        if (data['error']) {
-            button.html(myanmar.App.GRAPH_BASE_BUTTON_NAME);
-            error.show().html(data['error']);
+    }).bind(this), function (xhr) {
+        if (myanmar.App.retryWhenBusy(xhr, attempt, error, function (next) {
+            myanmar.instance.createGraph(next);
+        })) {
+            return;
+        }
+        button.html('error');
+        error.show().html('Error obtaining data!');
+    });
+};
+
+/**
+ * Calls retry after the Retry-After of a request the server refused because Earth Engine is busy (503)
+ * @param xhr the failed request
+ * @param attempt number of times the server was busy before
+ * @param error element to show the countdown in
+ * @param retry function (attempt) that sends the request again
+ * @returns {boolean} whether the request is retried
+ */
+myanmar.App.retryWhenBusy = function (xhr, attempt, error, retry) {
+    attempt = attempt || 0;
+    if (!xhr || xhr.status !== 503 || attempt >= myanmar.App.BUSY_RETRIES) {
+        return false;
+    }
+    const seconds = parseInt(xhr.getResponseHeader('Retry-After'), 10) || myanmar.App.BUSY_RETRY_AFTER;
+    error.show().html('Earth Engine is busy, retrying in ' + seconds + ' seconds...');
+    setTimeout(function () {
+        retry(attempt + 1);
+    }, seconds * 1000);
+    return true;
+};
+
+/**
+ * Requests an NDJSON stream and calls onRecord for every record as soon as its line is complete
+ * @param url
+ * @param onRecord
+ * @param onError
+ */
+myanmar.App.streamRecords = function (url, onRecord, onError) {
+    const xhr = new XMLHttpRequest();
+    let parsed = 0;
+    const parse = function () {
+        const text = xhr.responseText;
+        let end = text.indexOf('\n', parsed);
+        while (end !== -1) {
+            const line = text.substring(parsed, end);
+            parsed = end + 1;
+            if (line.length > 0) {
+                onRecord(JSON.parse(line));
+            }
+            end = text.indexOf('\n', parsed);
+        }
+    };
+    xhr.open('GET', url);
+    xhr.onprogress = parse;
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            onError(xhr);
         } else {
-            button.html(myanmar.App.GRAPH_BASE_BUTTON_NAME);
-            this.chartTitle = data['title'];
-            console.log(data);
-            buttons.activateDownload();
-            this.chartData = data['chart_data'];
-            this.showChart();
+            parse();
         }
-    }).bind(this));
+    };
+    xhr.onerror = onError;
+    xhr.send();
+};
+
+/**
+ * Builds chart rows from series of [date, value] pairs aligned on their dates, columns that did not arrive yet
+ * are left out and dates a series does not have are null
+ * @param columns ['Date', name, ...]
+ * @param series {name: [[date, value], ...]}
+ * @returns {Array}
+ */
+myanmar.App.mergeSeries = function (columns, series) {
+    const names = columns.slice(1).filter(function (name) {
+        return series[name] !== undefined;
+    });
+    const dates = [];
+    const values = {};
+    names.forEach(function (name, column) {
+        series[name].forEach(function (point) {
+            if (values[point[0]] === undefined) {
+                dates.push(point[0]);
+                values[point[0]] = names.map(function () {
+                    return null;
+                });
+            }
+            values[point[0]][column] = point[1];
+        });
+    });
+    //Labels are dd-MM-YYYY, MM-YYYY or YYYY, reversed they sort chronologically
+    const sortKey = function (date) {
+        return date.split('-').reverse().join('');
+    };
+    dates.sort(function (a, b) {
+        return sortKey(a) < sortKey(b) ? -1 : sortKey(a) > sortKey(b) ? 1 : 0;
+    });
+    const rows = dates.map(function (date) {
+        return [date].concat(values[date]);
+    });
+    rows.unshift(['Date'].concat(names));
+    return rows;
 };
 
 /**
@@ -452,6 +577,36 @@ myanmar.App.prototype.validateShapefile = function () {
 
 };
 
+/**
+ * Uploads the chosen shapefile parts (or a .zip of them), the returned id is used as the shapefile link
+ */
+myanmar.App.prototype.uploadShapefile = function (event) {
+    var data = new FormData();
+    $.each(event.target.files, function (index, file) {
+        data.append('file', file);
+    });
+    $.ajax({
+        url: '/shapefile',
+        method: 'POST',
+        data: data,
+        processData: false,
+        contentType: false,
+        beforeSend: function () {
+            $('.validated-shapefile').hide();
+        }, error: function (data) {
+            $('#error-message').show().html(data['error']);
+        }
+    }).done((function (data) {
+        if (data['error']) {
+            $('#error-message').show().html(data['error']);
+        } else if (data['success'] === 'true') {
+            console.log('Uploaded Shapefile with ' + data['features'] + ' features');
+            $('#shapefile-link').val(data['id']);
+            $('.validated-shapefile').show();
+        }
+    }).bind(this));
+};
+
 /**
  * Exports the chart data to CSV cuz dataTableToCSV is fucking gone...
  * @returns {*|string}
@@ -494,6 +649,10 @@ myanmar.App.INACTIVE_STYLE = {
 myanmar.App.OVERLAY_BASE_BUTTON_NAME = 'Create Overlay';
 myanmar.App.GRAPH_BASE_BUTTON_NAME = 'Create Graph';
 
+// Requests the server refuses while Earth Engine is busy are sent again at most BUSY_RETRIES times
+myanmar.App.BUSY_RETRIES = 5;
+myanmar.App.BUSY_RETRY_AFTER = 5;
+
 myanmar.App.DEFAULT_CENTER = {lng: 96.95112549402336, lat: 18.00746449851361};
 myanmar.App.DEFAULT_ZOOM = 6;
 myanmar.App.MAX_ZOOM = 14;
@@ -0,0 +1,242 @@
+"""Precomputed time series for the standard areas.
+
+The areas in the country, regions, districts and basins sets, the PRODUCTS and
+their timesteps are a small, finite set, so their series are computed ahead of
+time by the job at the bottom of this file instead of live in EE on every
+cache miss. The store is a directory that is deployed with the app:
+
+    store/index.json    column key -> {'start': 'yyyy-mm-dd', 'count': n, 'file': name, 'scale': meters}
+    store/<file>.bin    the column, count float64 values, NaN where EE returned null
+
+A column key is '<area_type>/<area>/<product>/<statistic>/<timestep>'. Columns
+start on the first day of a month (or year) so queries that start on the first
+day of a timestep line up with them. They are reduced at the product's scale,
+without the time limit of a request.
+
+Run from the app directory, with the App Engine SDK on the PYTHONPATH and
+config.py in place (the job uses the same EE account as the app):
+
+    python store.py               # Computes missing columns and appends new months
+    python store.py --timesteps month
+"""
+
+import array
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+
+STORE_DIR = os.path.join(os.path.dirname(__file__), 'store')
+INDEX_FILE = 'index.json'
+
+# What the job precomputes, graphs in the app always use the sum statistic.
+STORE_AREA_TYPES = ('country', 'regions', 'districts', 'basins')
+STORE_STATISTICS = ('sum',)
+STORE_TIMESTEPS = ('month', 'year')
+STORE_START = datetime.date(2000, 1, 1)
+
+# Number of timesteps the job asks EE for at once
+JOB_CHUNK_SIZE = {'day': 366, 'month': 120, 'year': 20}
+
+_INDEX = None
+_COLUMNS = {}
+_LOCK = threading.Lock()
+
+
+def ColumnKey(area_type, name, product_name, statistic, timestep):
+    return '/'.join([area_type, name, product_name, statistic, timestep])
+
+
+def Lookup(area_type, name, product_name, statistic, timestep, steps, advance, scale):
+    """Returns {step index: value} for the given steps the store covers at the given scale.
+
+    steps are datetime.date's, advance is the function used to generate them
+    (server.AdvanceDate), used to check a step lines up with the column.
+    """
+    key = ColumnKey(area_type, name, product_name, statistic, timestep)
+    column = _GetIndex().get(key)
+    if column is None or column.get('scale') != scale or not steps:
+        return {}
+    start = _ParseDate(column['start'])
+    offset = _StepOffset(start, steps[0], timestep)
+    if offset is None or advance(start, offset, timestep) != steps[0]:
+        return {}
+    values = _GetColumn(key, column)
+    covered = {}
+    for index in range(len(steps)):
+        if 0 <= offset + index < len(values):
+            value = values[offset + index]
+            covered[index] = None if value != value else value  # NaN is a null from EE
+    return covered
+
+
+def Preload():
+    """Reads the index, used to do so before the first request."""
+    _GetIndex()
+
+
+def _GetIndex():
+    global _INDEX
+    with _LOCK:
+        if _INDEX is None:
+            _INDEX = ReadIndex()
+        return _INDEX
+
+
+def _GetColumn(key, column):
+    with _LOCK:
+        if key not in _COLUMNS:
+            _COLUMNS[key] = ReadColumn(column)
+        return _COLUMNS[key]
+
+
+def ReadIndex(store_dir=STORE_DIR):
+    path = os.path.join(store_dir, INDEX_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['columns']
+
+
+def WriteIndex(columns, store_dir=STORE_DIR):
+    path = os.path.join(store_dir, INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'columns': columns}, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def ReadColumn(column, store_dir=STORE_DIR):
+    values = array.array('d')
+    with open(os.path.join(store_dir, column['file']), 'rb') as f:
+        values.fromfile(f, column['count'])
+    if sys.byteorder == 'big':  # Columns are stored little endian
+        values.byteswap()
+    return values
+
+
+def AppendColumn(column, values, store_dir=STORE_DIR):
+    """Appends values (None for nulls) to the column file and updates its count."""
+    data = array.array('d', [float('nan') if value is None else value for value in values])
+    if sys.byteorder == 'big':
+        data.byteswap()
+    with open(os.path.join(store_dir, column['file']), 'ab') as f:
+        data.tofile(f)
+    column['count'] += len(values)
+
+
+def _ParseDate(date):
+    return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+
+def _StepOffset(start, step, timestep):
+    """Number of timesteps between the start of a column and the given step."""
+    if timestep == 'day':
+        return (step - start).days
+    months = (step.year - start.year) * 12 + step.month - start.month
+    if timestep == 'year':
+        return months // 12 if months % 12 == 0 else None
+    return months
+
+
+###############################################################################
+#                               Precompute job.                               #
+###############################################################################
+
+
+def RunJob(timesteps=STORE_TIMESTEPS, area_types=STORE_AREA_TYPES, store_dir=STORE_DIR):
+    """Computes every missing column and appends the timesteps completed since the last run."""
+    import server  # The job needs EE, the app does not need the job
+
+    server.InitializeEE()
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    columns = ReadIndex(store_dir)
+    for area_type in area_types:
+        for name in server.GetAreaNames(area_type):
+            region = server.GetAreaGeometry(name, area_type)
+            for statistic in STORE_STATISTICS:
+                for timestep in timesteps:
+                    _RefreshArea(server, columns, area_type, name, region, statistic, timestep, store_dir)
+                    WriteIndex(columns, store_dir)
+
+
+def _RefreshArea(server, columns, area_type, name, region, statistic, timestep, store_dir):
+    """Brings the columns of every product for one area up to the last completed timestep."""
+    pending = {}
+    for product_name, product in server.PRODUCTS.items():
+        key = ColumnKey(area_type, name, product_name, statistic, timestep)
+        if key not in columns:
+            columns[key] = {
+                'start': STORE_START.isoformat(),
+                'count': 0,
+                'file': hashlib.md5(key.encode('utf-8')).hexdigest() + '.bin'
+            }
+            open(os.path.join(store_dir, columns[key]['file']), 'wb').close()
+        columns[key].setdefault('scale', product['scale'])  # The default reduce settings of SeriesSpec
+        pending[product_name] = columns[key]
+
+    while pending:
+        # All products of the area are fetched in one EE call per chunk
+        series = []
+        chunk_start = {}
+        for product_name, column in pending.items():
+            start = server.AdvanceDate(_ParseDate(column['start']), column['count'], timestep)
+            if not server.IsCompleteTimeStep(start, timestep, server.PRODUCTS[product_name]):
+                continue
+            chunk_start[product_name] = start
+            series.append(server.SeriesSpec(product_name, region, server.PRODUCTS[product_name],
+                                            server.GetAreaRegionKey(name, area_type), (area_type, name)))
+        pending = {product_name: pending[product_name] for product_name in chunk_start}
+        if not pending:
+            break
+
+        collections = []
+        counts = {}
+        for index, spec in enumerate(series):
+            start = chunk_start[spec['name']]
+            count = 0
+            while count < JOB_CHUNK_SIZE[timestep] and server.IsCompleteTimeStep(
+                    server.AdvanceDate(start, count, timestep), timestep, spec['product']):
+                count += 1
+            counts[index] = count
+            collections.append(server.CalculateSeriesFeatures(index, start, count, spec, timestep, statistic))
+        print('Computing {} {} ({}) from {}'.format(area_type, name, timestep, min(chunk_start.values())))
+        try:
+            features = server.CallWithBackoff(
+                lambda: server.ee.FeatureCollection(collections).flatten().getInfo()['features'])
+        except server.ee.EEException as ex:
+            if not server.IsTooLargeError(ex):
+                raise
+            # Every product on its own, split into chunks that fit within the deadline
+            print('Too large, fetching {} products one by one'.format(len(series)))
+            features = [feature for index, spec in enumerate(series)
+                        for feature in server.FetchSeriesAdaptive(
+                            index, [server.AdvanceDate(chunk_start[spec['name']], step, timestep)
+                                    for step in range(counts[index])], spec, timestep, statistic)]
+
+        values = {index: [None] * count for index, count in counts.items()}
+        for feature in features:
+            properties = feature['properties']
+            values[int(properties['series'])][int(properties['step'])] = properties.get('value')
+        for index, spec in enumerate(series):
+            AppendColumn(pending[spec['name']], values[index], store_dir)
+            if counts[index] < JOB_CHUNK_SIZE[timestep]:  # Reached the last completed timestep
+                del pending[spec['name']]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Precomputes the series of the standard areas.')
+    parser.add_argument('--timesteps', default=','.join(STORE_TIMESTEPS))
+    parser.add_argument('--area-types', default=','.join(STORE_AREA_TYPES))
+    parser.add_argument('--store', default=STORE_DIR)
+    args = parser.parse_args()
+    # Chunk sizes learned by server.FetchSeriesAdaptive are kept in memcache
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    RunJob(args.timesteps.split(','), args.area_types.split(','), args.store)
@@ -0,0 +1,340 @@
+"""Simplified, quantized TopoJSON of the area boundaries, one layer per zoom level.
+
+The GeoJSON files in static/polygons are several megabytes each, far more
+detail than the map can show. The boundaries are turned into a topology, so a
+border shared by two areas is stored (and simplified) once and neighbours keep
+fitting together. Every arc is simplified to a pixel at the layer's zoom
+level, then the coordinates are quantized to half a pixel and delta encoded.
+
+The layers are built ahead of time by the job at the bottom of this file into
+BOUNDARIES_DIR, which is deployed with the app. Layers that were not built are
+built from static/polygons on first use. Run from the app directory:
+
+    python topology.py                      # Builds every layer
+    python topology.py --area-types districts
+
+Area types that have no GeoJSON in static/polygons (districts) are fetched
+from their EE asset by the job, with the App Engine SDK on the PYTHONPATH and
+config.py in place.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import StringIO
+import threading
+
+import geometry
+
+BOUNDARIES_DIR = os.path.join(os.path.dirname(__file__), 'boundaries')
+INDEX_FILE = 'index.json'
+
+# Zoom levels with a layer, a request for another zoom gets the first level
+# at or above it (or the finest one).
+ZOOM_LEVELS = (5, 7, 9, 11)
+
+# Properties kept per area type, the browser looks areas up by these
+LAYER_PROPERTIES = {
+    'country': ('Name', 'ST'),
+    'regions': ('ST',),
+    'districts': ('DT',),
+    'basins': ('Name',),
+}
+
+_LAYERS = {}
+_VERSION = []
+_LOCK = threading.Lock()
+
+
+def GetLevel(zoom):
+    return next((level for level in ZOOM_LEVELS if level >= zoom), ZOOM_LEVELS[-1])
+
+
+def GetTolerance(level):
+    """Degrees of longitude per pixel at the zoom level (256 pixel tiles)."""
+    return 360.0 / (256 * 2 ** level)
+
+
+def GetLayer(area_type, zoom):
+    """Returns the layer for the zoom level as a dict with 'body', 'gzip' and 'etag', or None.
+
+    Layers are read from BOUNDARIES_DIR, or built from static/polygons, once
+    per instance. Only layers of the area types in LAYER_PROPERTIES exist,
+    and only layers that exist are kept.
+    """
+    if area_type not in LAYER_PROPERTIES:
+        return None
+    key = (area_type, GetLevel(zoom))
+    with _LOCK:
+        if key not in _LAYERS:
+            layer = _LoadLayer(*key)
+            if layer is None:
+                return None
+            _LAYERS[key] = layer
+        return _LAYERS[key]
+
+
+def GetVersion():
+    """Hash of the built layers, used to version layer URLs.
+
+    Without built layers it is a hash of the sources the layers are built from.
+    """
+    with _LOCK:
+        if not _VERSION:
+            index = ReadIndex()
+            if not index:
+                paths = [os.path.join(geometry.POLYGONS_DIR, filename) for filename, _ in geometry.AREA_FILES.values()]
+                index = {'levels': ZOOM_LEVELS, 'properties': LAYER_PROPERTIES,
+                         'sources': [os.path.getsize(path) for path in sorted(paths) if os.path.exists(path)]}
+            _VERSION.append(hashlib.md5(json.dumps(index, sort_keys=True)).hexdigest()[:12])
+        return _VERSION[0]
+
+
+def ReadIndex(boundaries_dir=BOUNDARIES_DIR):
+    path = os.path.join(boundaries_dir, INDEX_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def GetLayerFile(area_type, level):
+    return '{}.{}.json'.format(area_type, level)
+
+
+def _LoadLayer(area_type, level, boundaries_dir=BOUNDARIES_DIR):
+    path = os.path.join(boundaries_dir, GetLayerFile(area_type, level))
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return _Encode(f.read())
+    features = ReadFeatures(area_type)
+    if not features:
+        return None
+    return _Encode(json.dumps(BuildLayer(features, area_type, level), separators=(',', ':')))
+
+
+def _Encode(body):
+    compressed = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        f.write(body)
+    return {
+        'body': body,
+        'gzip': compressed.getvalue(),
+        'etag': hashlib.md5(body).hexdigest()
+    }
+
+
+def ReadFeatures(area_type):
+    """Returns the GeoJSON features of the area type from static/polygons, None if it is not there."""
+    if area_type not in geometry.AREA_FILES:
+        return None
+    path = os.path.join(geometry.POLYGONS_DIR, geometry.AREA_FILES[area_type][0])
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['features']
+
+
+###############################################################################
+#                                  Topology.                                  #
+###############################################################################
+
+
+def BuildLayer(features, area_type, level):
+    """Returns the TopoJSON of the features, simplified and quantized for the zoom level.
+
+    Areas split over several features are merged into a single MultiPolygon.
+    """
+    names = []
+    properties = {}
+    polygons = {}
+    name_property = geometry.AREA_FILES[area_type][1]
+    for feature in features:
+        name = feature['properties'][name_property]
+        if name not in polygons:
+            names.append(name)
+            properties[name] = {key: feature['properties'].get(key) for key in LAYER_PROPERTIES[area_type]}
+        polygons.setdefault(name, []).extend(geometry.GetPolygons(feature['geometry']))
+
+    arcs, shapes = BuildTopology([polygons[name] for name in names])
+    tolerance = GetTolerance(level)
+    scale = tolerance / 2
+    points = [point for arc in arcs for point in arc]
+    origin = (min(point[0] for point in points), min(point[1] for point in points))
+
+    # Simplify and quantize every arc, an arc that collapses takes its ring with it
+    quantized = []
+    for arc in arcs:
+        if arc[0] == arc[-1]:  # A ring without neighbours
+            arc = geometry.Simplify(arc, tolerance)
+        else:
+            arc = geometry.SimplifyLine(arc, tolerance)
+        quantized.append(_Quantize(arc, origin, scale) if arc is not None else None)
+
+    used = {}
+    geometries = []
+    for name, shape in zip(names, shapes):
+        coordinates = []
+        for polygon in shape:
+            rings = [ring for ring in polygon if _RingSize(ring, quantized) >= 4]
+            if rings and rings[0] is polygon[0]:  # Holes without their outer ring are dropped
+                coordinates.append([[_MapArc(index, used) for index in ring] for ring in rings])
+        if not coordinates:  # Everything collapsed, keep the area as its bounding box
+            box = _GetBox(polygons[name])
+            quantized.append(_Quantize(box, origin, scale))
+            coordinates = [[[_MapArc(len(quantized) - 1, used)]]]
+        geometries.append({'type': 'MultiPolygon', 'arcs': coordinates, 'properties': properties[name]})
+
+    encoded = [None] * len(used)
+    for index, position in used.items():
+        encoded[position] = _DeltaEncode(quantized[index])
+    return {
+        'type': 'Topology',
+        'transform': {'scale': [scale, scale], 'translate': list(origin)},
+        'objects': {area_type: {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': encoded
+    }
+
+
+def BuildTopology(shapes):
+    """Splits the rings of the shapes into arcs that are shared between neighbours.
+
+    shapes is a list of lists of GeoJSON polygons. Returns (arcs, shapes) where
+    arcs is a list of point lists and every ring of the shapes is replaced by a
+    list of arc indexes, ~index for an arc that is used reversed. Rings are cut
+    at junctions, the points where the neighbours of a border change.
+    """
+    rings = [[tuple(point[:2]) for point in ring[:-1]] for shape in shapes for polygon in shape for ring in polygon]
+
+    # A point is a junction when it is passed with different neighbours
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        for index, point in enumerate(ring):
+            pair = frozenset((ring[index - 1], ring[(index + 1) % len(ring)]))
+            if neighbours.setdefault(point, pair) != pair:
+                junctions.add(point)
+
+    arcs = []
+    arc_indexes = {}
+    ring_arcs = []
+    for ring in rings:
+        cuts = [index for index, point in enumerate(ring) if point in junctions]
+        if len(ring) < 3:
+            ring_arcs.append([])
+            continue
+        if not cuts:  # Start rings without junctions at their smallest point, to find them shared
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            parts = [ring + ring[:1]]
+        else:
+            ring = ring[cuts[0]:] + ring[:cuts[0]]
+            cuts = [index - cuts[0] for index in cuts] + [len(ring)]
+            ring = ring + ring[:1]
+            parts = [ring[first:last + 1] for first, last in zip(cuts, cuts[1:])]
+        ring_arcs.append([_GetArcIndex(part, arcs, arc_indexes) for part in parts])
+
+    # Put the arc indexes back in the structure of the shapes
+    position = 0
+    result = []
+    for shape in shapes:
+        result.append([])
+        for polygon in shape:
+            result[-1].append(ring_arcs[position:position + len(polygon)])
+            position += len(polygon)
+    return arcs, result
+
+
+def _GetArcIndex(part, arcs, arc_indexes):
+    key = tuple(part)
+    if key in arc_indexes:
+        return arc_indexes[key]
+    reverse = tuple(reversed(part))
+    if reverse in arc_indexes:
+        return ~arc_indexes[reverse]
+    arc_indexes[key] = len(arcs)
+    arcs.append(list(part))
+    return arc_indexes[key]
+
+
+def _Quantize(arc, origin, scale):
+    quantized = []
+    for x, y in arc:
+        point = [int(round((x - origin[0]) / scale)), int(round((y - origin[1]) / scale))]
+        if not quantized or point != quantized[-1]:
+            quantized.append(point)
+    if len(quantized) == 1:  # Keep both ends of an arc, rings need them to connect
+        quantized.append(list(quantized[0]))
+    return quantized
+
+
+def _DeltaEncode(arc):
+    encoded = [arc[0]]
+    encoded.extend([x2 - x1, y2 - y1] for (x1, y1), (x2, y2) in zip(arc, arc[1:]))
+    return encoded
+
+
+def _RingSize(ring, quantized):
+    """Number of points of a ring made of the given arcs, 0 when one of them collapsed."""
+    arcs = [quantized[index if index >= 0 else ~index] for index in ring]
+    if any(arc is None for arc in arcs):
+        return 0
+    return sum(len(arc) - 1 for arc in arcs) + 1
+
+
+def _MapArc(index, used):
+    """Index of the arc in the output, where only arcs that are used are kept."""
+    arc = index if index >= 0 else ~index
+    if arc not in used:
+        used[arc] = len(used)
+    return used[arc] if index >= 0 else ~used[arc]
+
+
+def _GetBox(polygons):
+    points = [point for polygon in polygons for point in polygon[0]]
+    min_x, min_y = min(p[0] for p in points), min(p[1] for p in points)
+    max_x, max_y = max(p[0] for p in points), max(p[1] for p in points)
+    return [(min_x, min_y), (max_x, min_y), (max_x, max_y), (min_x, max_y), (min_x, min_y)]
+
+
+###############################################################################
+#                                  Build job.                                 #
+###############################################################################
+
+
+def RunJob(area_types=tuple(LAYER_PROPERTIES), boundaries_dir=BOUNDARIES_DIR):
+    """Builds every zoom level of the area types and writes their index."""
+    if not os.path.exists(boundaries_dir):
+        os.makedirs(boundaries_dir)
+    index = ReadIndex(boundaries_dir)
+    for area_type in area_types:
+        features = ReadFeatures(area_type) or _FetchFeatures(area_type)
+        for level in ZOOM_LEVELS:
+            body = json.dumps(BuildLayer(features, area_type, level), separators=(',', ':'))
+            filename = GetLayerFile(area_type, level)
+            with open(os.path.join(boundaries_dir, filename), 'wb') as f:
+                f.write(body)
+            index[filename] = hashlib.md5(body).hexdigest()
+            print('Built {} ({} bytes)'.format(filename, len(body)))
+    with open(os.path.join(boundaries_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+
+def _FetchFeatures(area_type):
+    import server  # Only the job needs EE for this
+
+    print('Fetching {} from EE'.format(area_type))
+    server.InitializeEE()
+    stdt, path = server.GetAreaAsset(area_type)
+    return server.ee.FeatureCollection(path).getInfo()['features']
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Builds the simplified boundary layers.')
+    parser.add_argument('--area-types', default=','.join(sorted(LAYER_PROPERTIES)))
+    parser.add_argument('--output', default=BOUNDARIES_DIR)
+    args = parser.parse_args()
+    RunJob(args.area_types.split(','), args.output)